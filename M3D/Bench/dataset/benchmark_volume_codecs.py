@@ -0,0 +1,128 @@
+"""
+Size and read throughput of the volume shard codecs against one .npy file per volume.
+
+    python -m Bench.dataset.benchmark_volume_codecs --valid_path ../valid_path.csv --num_volumes 200
+    python -m Bench.dataset.benchmark_volume_codecs --shape 1 32 256 256 --num_volumes 200
+
+Volumes are packed with every codec (and with zstd when zstandard is installed) into a temporary directory, then
+read back as the datasets do: loaded, decoded and converted to a float32 tensor. With --cold the pages of the files
+are dropped from the page cache before every read pass (posix_fadvise, Linux), otherwise the reads are warm.
+Without --valid_path/--glob, smooth random volumes in [0, 1] of --shape are generated.
+"""
+import io
+import os
+import glob
+import time
+import shutil
+import contextlib
+import importlib.util
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from .volume_codecs import CODECS
+from .volume_shards import ShardReader, pack_volumes
+
+
+def drop_page_cache(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def synthetic_volumes(output_dir, num_volumes, shape, seed=0):
+    # Low-frequency noise in [0, 1], closer to a preprocessed scan than white noise for the compressors.
+    generator = torch.Generator().manual_seed(seed)
+    paths = []
+    for i in range(num_volumes):
+        coarse = torch.rand((1, shape[0]) + tuple(max(s // 8, 1) for s in shape[1:]), generator=generator)
+        volume = torch.nn.functional.interpolate(coarse, size=tuple(shape[1:]), mode='trilinear')[0]
+        path = os.path.join(output_dir, f"volume_{i:05d}.npy")
+        np.save(path, volume.numpy().astype(np.float32))
+        paths.append(path)
+    return paths
+
+
+def read_all(load, keys):
+    start = time.perf_counter()
+    nbytes = 0
+    for key in keys:
+        # Copied like the collate function does, a raw shard volume is only a view until its pages are read.
+        volume = torch.tensor(np.asarray(load(key)), dtype=torch.float)
+        nbytes += volume.numel() * 4
+    return time.perf_counter() - start, nbytes
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the volume shard codecs.")
+    parser.add_argument('--valid_path', type=str, default=None)
+    parser.add_argument('--glob', type=str, default=None)
+    parser.add_argument('--shape', type=int, nargs='+', default=[1, 32, 256, 256])
+    parser.add_argument('--num_volumes', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--cold', action="store_true")
+    parser.add_argument('--work_dir', type=str, default=None, help="Where the shards are written, a temporary directory by default.")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        if args.valid_path is not None:
+            paths = pd.read_csv(args.valid_path)['Path'].tolist()[:args.num_volumes]
+        elif args.glob is not None:
+            paths = sorted(glob.glob(args.glob, recursive=True))[:args.num_volumes]
+        else:
+            os.makedirs(os.path.join(work_dir, "npy"))
+            paths = synthetic_volumes(os.path.join(work_dir, "npy"), args.num_volumes, args.shape)
+
+        compressions = [None]
+        if importlib.util.find_spec("zstandard") is not None:
+            compressions.append("zstd")
+        else:
+            print("zstandard is not installed, zstd is skipped")
+
+        configs = [("npy files", None, None)] + [(codec, codec, compression)
+                                                 for compression in compressions for codec in CODECS]
+        print(f"{len(paths)} volumes, {'cold' if args.cold else 'warm'} page cache")
+        print(f"{'storage':>16} {'size (MB)':>10} {'ratio':>6} {'pack (s)':>9} {'read (s)':>9} {'volumes/s':>10} {'MB/s':>8}")
+        raw_size = sum(os.path.getsize(path) for path in paths)
+        for name, codec, compression in configs:
+            if codec is None:
+                files, pack_seconds = paths, 0.0
+                new_loader = lambda: np.load
+            else:
+                name = codec + ("+" + compression if compression else "")
+                shard_dir = os.path.join(work_dir, name)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    pack_volumes(paths, shard_dir, codec=codec, compression=compression, shard_size=1 << 30)
+                pack_seconds = time.perf_counter() - start
+                files = sorted(glob.glob(os.path.join(shard_dir, "*")))
+                # A new reader per pass: the maps of a reader keep their pages in the page cache.
+                new_loader = lambda: ShardReader(shard_dir).get
+            size = sum(os.path.getsize(path) for path in files)
+
+            times = []
+            for _ in range(args.repeats):
+                if args.cold:
+                    drop_page_cache(files)
+                seconds, nbytes = read_all(new_loader(), paths)
+                times.append(seconds)
+            seconds = min(times)
+            print(f"{name:>16} {size / 1e6:>10.1f} {raw_size / size:>6.2f} {pack_seconds:>9.2f} {seconds:>9.3f} "
+                  f"{len(paths) / seconds:>10.1f} {nbytes / 1e6 / seconds:>8.0f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
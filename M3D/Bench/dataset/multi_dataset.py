@@ -16,19 +16,33 @@ from ..utils import mask2box
 from .dataset_info import dataset_info
 from .prompt_templates import Caption_templates, PosREC_templates, PosREG_templates, Seg_templates
 from .term_dictionary import term_dict
+from .tokenization import ImagePromptTokenizer
+from .volume_provider import VolumeProvider
+from .rad_manifest import build_rad_prompt, subtask_of, load_manifest_split, load_token_index
 
 class RADDataset(Dataset):
     def __init__(self, args, tokenizer, close_ended=True, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
         self.close_ended = close_ended
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
-
-
-        if mode == "train":
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
+
+
+        # With a manifest (see rad_manifest.py) prompts are pre-rendered and pre-tokenized, the CSV path only selects
+        # the task/subtask and None selects the whole split.
+        self.token_index = None
+        manifest_dir = getattr(args, 'rad_manifest', None)
+        if manifest_dir is not None and mode in ("train", "test"):
+            csv_path = args.vqa_data_train_path if mode == "train" else args.vqa_data_test_path
+            task, subtask = subtask_of(csv_path) if csv_path is not None else (None, None)
+            self.data_list = load_manifest_split(manifest_dir, mode, task, subtask)
+            self.token_index = load_token_index(manifest_dir, tokenizer, args.proj_out_num, args.max_length)
+        elif mode == "train":
             self.data_list = pd.read_csv(args.vqa_data_train_path)
         elif mode == "validation":
             self.data_list = pd.read_csv(args.vqa_data_val_path, nrows=2048)
@@ -70,6 +84,32 @@ class RADDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def build_prompt(self, data):
+        # Returns the question (with choices, without image tokens) and the answer of one CSV row.
+        if self.token_index is not None:
+            return data['Prompt'], data['AnswerText']
+        return build_rad_prompt(data)
+
+    def prompt_lengths(self):
+        # Token length of every prompt (question_len, as in __getitem__) without the image tokens, which are the same
+        # for all prompts. The manifest and CSV paths give the same lengths, so batches are bucketed the same way.
+        if self.token_index is not None:
+            question_len = self.token_index['question_len'][self.data_list['manifest_row'].to_numpy()]
+        else:
+            question_len = [self.prompt_tokenizer.length(self.image_tokens + ' ' + self.build_prompt(data)[0], self.args.max_length)
+                            for _, data in self.data_list.iterrows()]
+        return (np.asarray(question_len) - self.args.proj_out_num).tolist()
+
+    def indexed_tokens(self, manifest_row):
+        # Same tensors as tokenizing with padding="max_length" (right padding), read from the token index.
+        start, end = self.token_index['offsets'][manifest_row], self.token_index['offsets'][manifest_row + 1]
+        input_id = torch.full((self.args.max_length,), self.tokenizer.pad_token_id, dtype=torch.long)
+        input_id[:end - start] = torch.from_numpy(self.token_index['ids'][start:end].astype(np.int64))
+        attention_mask = torch.zeros(self.args.max_length, dtype=torch.long)
+        attention_mask[:end - start] = 1
+        question_len = torch.tensor(int(self.token_index['question_len'][manifest_row]))
+        return input_id, attention_mask, question_len
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -77,43 +117,25 @@ class RADDataset(Dataset):
                 data = self.data_list.iloc[idx]
                 volume_name = data['VolumeName']
                 image_abs_path = self.data_root_df.at[volume_name, 'Path']
-                question = data["Question"]
-                image = np.load(image_abs_path)
+                image = self.volumes.load(image_abs_path)
                 image = self.transform(image)
-                if all(x in data for x in ["Choice A", "Choice B", "Choice C", "Choice D"]):
-                    choices = "Choices: A. {} B. {} C. {} D. {}".format(
-                        data["Choice A"], data["Choice B"], data["Choice C"], data["Choice D"]
-                    )
-                    answer = "{}. {}".format(data["AnswerChoice"], data["Answer"])
-                elif all(x in data for x in ["Choice A", "Choice B"]):
-                    choices = "Choices: A. {} B. {}".format(data["Choice A"], data["Choice B"])
-                    answer = "{}. {}".format(data["AnswerChoice"], data["Answer"])
-                else:
-                    choices = ""
-                    answer = str(data["Answer"])
+                question, answer = self.build_prompt(data)
 
-                if choices:
-                    question = question + '\n' + choices + '\nAnswer:'
+                question = self.image_tokens + ' ' + question
+                if self.token_index is not None:
+                    input_id, attention_mask, question_len = self.indexed_tokens(int(data['manifest_row']))
                 else:
-                    question = question + '\nAnswer:'
+                    text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
-                question = self.image_tokens + ' ' + question
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt",
-                )
+                    input_id = text_tensor["input_ids"][0]
+                    attention_mask = text_tensor["attention_mask"][0]
 
-                input_id = text_tensor["input_ids"][0]
-                attention_mask = text_tensor["attention_mask"][0]
+                    question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 valid_len = torch.sum(attention_mask)
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
-
                 label = input_id.clone()
                 label[:question_len] = -100
                 if self.tokenizer.pad_token_id == self.tokenizer.eos_token_id:
@@ -131,20 +153,28 @@ class RADDataset(Dataset):
                     'question': question,
                     'answer': answer,
                     'question_aspect': data["QuestionAspect"],
+                    'volume_name': volume_name,
+                    # The row actually returned, the results of a test run are written and resumed by it.
+                    'index': idx,
                 }
 
                 if self.close_ended:
                     ret['answer_choice'] = data["AnswerChoice"]
+                    ret['choices'] = [str(data.get(x, "-")) for x in ["Choice A", "Choice B", "Choice C", "Choice D"]]
                 return ret
 
             except Exception as e:
                 print(f"Error in __getitem__ at index {idx}: {e}")
+                if self.mode == "test":
+                    # No stand-in row when evaluating: the row stays not done and is retried by the next run.
+                    raise
                 idx = random.randint(0, len(self.data_list) - 1)
 
 
 class ITRDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
@@ -219,7 +249,7 @@ class ITRDataset(Dataset):
                 image_path = data["image"]
                 image_abs_path = os.path.join(self.data_root, image_path)
 
-                image = np.load(image_abs_path)  # nomalized 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized 0-1, C,D,H,W
                 # image = np.load(img_abs_path)[np.newaxis, ...]  # nomalized
                 image = self.transform(image)
 
@@ -255,11 +285,13 @@ class ITRDataset(Dataset):
 class CapDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         with open(args.cap_data_path, 'r') as file:
             self.json_file = json.load(file)
@@ -305,7 +337,7 @@ class CapDataset(Dataset):
                 image_path = data["image"]
                 image_abs_path = os.path.join(self.data_root, image_path)
 
-                image = np.load(image_abs_path)  # nomalized 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized 0-1, C,D,H,W
                 # image = np.load(img_abs_path)[np.newaxis, ...]  # nomalized
                 image = self.transform(image)
 
@@ -319,9 +351,7 @@ class CapDataset(Dataset):
 
                 question = self.image_tokens + prompt_question
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -330,11 +360,7 @@ class CapDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -364,12 +390,14 @@ class CapDataset(Dataset):
 class VQADataset(Dataset):
     def __init__(self, args, tokenizer, close_ended=True, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
         self.close_ended = close_ended
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         if mode == "train":
             self.data_list = pd.read_csv(args.vqa_data_train_path)
@@ -417,7 +445,7 @@ class VQADataset(Dataset):
                 data = self.data_list.iloc[idx]
                 image_abs_path = os.path.join(self.args.data_root, data["Image Path"])
 
-                image = np.load(image_abs_path)  # nomalized, 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized, 0-1, C,D,H,W
                 # image = np.load(img_path)[np.newaxis, ...]  # nomalized
 
                 image = self.transform(image)
@@ -433,9 +461,7 @@ class VQADataset(Dataset):
 
 
                 question = self.image_tokens + ' ' + question
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt",
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -444,10 +470,7 @@ class VQADataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -478,6 +501,7 @@ class VQADataset(Dataset):
 class PosRECDataset(Dataset):
     def __init__(self, args, tokenizer, tag="0000", description=True, mode='train'):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
 
         self.tag = tag
@@ -487,6 +511,7 @@ class PosRECDataset(Dataset):
         self.dataset_info = dataset_info
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
         self.box_tokens = ["<bx_start>", "<bx_end>"]
 
         root_path = args.seg_data_path
@@ -558,8 +583,8 @@ class PosRECDataset(Dataset):
             image_path = data['image']
             seg_path = data['label']
 
-            image_array = np.load(image_path) #1*32*256*256, normalized
-            seg_array = np.load(seg_path)
+            image_array = self.volumes.load(image_path) #1*32*256*256, normalized
+            seg_array = self.volumes.load(seg_path)
             cls_id = int(os.path.basename(seg_path).split('_')[1].split('.')[0])
 
             try:
@@ -602,10 +627,7 @@ class PosRECDataset(Dataset):
                         question = self.image_tokens + ' ' + question
                         answer = random.choice(self.des_no_answers).format(cls_list[cls_id])
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length",
-                    return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -614,10 +636,7 @@ class PosRECDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -649,6 +668,7 @@ class PosRECDataset(Dataset):
 class PosREGDataset(Dataset):
     def __init__(self, args, tokenizer, tag="0000", description=True, mode='train'):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
 
         self.tag = tag
@@ -658,6 +678,7 @@ class PosREGDataset(Dataset):
         self.dataset_info = dataset_info
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
         self.box_tokens = ["<bx_start>", "<bx_end>"]
 
         root_path = args.seg_data_path
@@ -733,8 +754,8 @@ class PosREGDataset(Dataset):
             image_path = data['image']
             seg_path = data['label']
 
-            image_array = np.load(image_path) #1*32*256*256, normalized
-            seg_array = np.load(seg_path)
+            image_array = self.volumes.load(image_path) #1*32*256*256, normalized
+            seg_array = self.volumes.load(seg_path)
             cls_id = int(os.path.basename(seg_path).split('_')[1].split('.')[0])
 
 
@@ -777,10 +798,7 @@ class PosREGDataset(Dataset):
                         question = self.image_tokens + ' ' + question
                         answer = random.choice(self.des_no_answers).format(cls_list[cls_id])
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length",
-                    return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -789,10 +807,7 @@ class PosREGDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -824,6 +839,7 @@ class PosREGDataset(Dataset):
 class SegDataset(Dataset):
     def __init__(self, args, tokenizer, tag="0000", description=False, mode='train'):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
 
         self.tag = tag
@@ -832,6 +848,7 @@ class SegDataset(Dataset):
         self.dataset_info = dataset_info
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         root_path = args.seg_data_path
         if mode == "train":
@@ -902,8 +919,8 @@ class SegDataset(Dataset):
             image_path = data['image']
             seg_path = data['label']
 
-            image_array = np.load(image_path) #1*32*256*256, normalized
-            seg_array = np.load(seg_path)
+            image_array = self.volumes.load(image_path) #1*32*256*256, normalized
+            seg_array = self.volumes.load(seg_path)
             cls_id = int(os.path.basename(seg_path).split('_')[1].split('.')[0])
 
             try:
@@ -942,10 +959,7 @@ class SegDataset(Dataset):
                         question = self.image_tokens + ' ' + question
                         answer = random.choice(self.des_no_answers).format(cls_list[cls_id])
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length",
-                    return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -954,10 +968,7 @@ class SegDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -990,10 +1001,12 @@ class SegDataset(Dataset):
 class RefSegDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
         self.mode = mode
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         self.data_list = pd.read_csv(args.refseg_data_path, engine='python')
 
@@ -1038,10 +1051,10 @@ class RefSegDataset(Dataset):
                 data = self.data_list.iloc[idx]
                 image_path = os.path.join(self.args.data_root, data["Image"])
 
-                image_array = np.load(image_path)  # 1*32*256*256, normalized
+                image_array = self.volumes.load(image_path)  # 1*32*256*256, normalized
 
                 seg_path = os.path.join(self.args.data_root, data["Mask"])
-                seg_array = np.load(seg_path)
+                seg_array = self.volumes.load(seg_path)
                 seg_array = (seg_array == data["Mask_ID"]).astype(np.int8)
 
                 item = {
@@ -1060,9 +1073,7 @@ class RefSegDataset(Dataset):
                 answer = data["Answer"]
 
                 self.tokenizer.padding_side = "right"
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -1071,10 +1082,7 @@ class RefSegDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -0,0 +1,155 @@
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from .rad_tasks import discover_subtasks, task_key
+from .tokenization import ImagePromptTokenizer, load_tokenizer
+
+
+MANIFEST_NAME = "manifest.csv"
+CHOICE_COLUMNS = ["Choice A", "Choice B", "Choice C", "Choice D"]
+
+
+def build_rad_prompt(data):
+    # Returns the question (with choices, without image tokens) and the answer of one 3D-RAD CSV row.
+    question = data["Question"]
+    if all(x in data for x in CHOICE_COLUMNS):
+        choices = "Choices: A. {} B. {} C. {} D. {}".format(
+            data["Choice A"], data["Choice B"], data["Choice C"], data["Choice D"]
+        )
+        answer = "{}. {}".format(data["AnswerChoice"], data["Answer"])
+    elif all(x in data for x in ["Choice A", "Choice B"]):
+        choices = "Choices: A. {} B. {}".format(data["Choice A"], data["Choice B"])
+        answer = "{}. {}".format(data["AnswerChoice"], data["Answer"])
+    else:
+        choices = ""
+        answer = str(data["Answer"])
+
+    if choices:
+        question = question + '\n' + choices + '\nAnswer:'
+    else:
+        question = question + '\nAnswer:'
+    return question, answer
+
+
+def subtask_of(csv_path):
+    """(task, subtask) of a subtask CSV path, e.g. "3DRAD/test/task6/e.csv" or ".../Task6_Longitudinal_Temporal_Diagnosis/e.csv" -> ("task6", "e")."""
+    return task_key(os.path.dirname(os.path.abspath(csv_path))), os.path.splitext(os.path.basename(csv_path))[0]
+
+
+def build_manifest(rad_root, splits=("train", "test")):
+    """
+    One table with every question of the given splits (rad_root/{split}/Task*/*.csv).
+
+    Keeps the CSV columns and adds split, task, subtask, close_ended, source_row and the rendered Prompt/AnswerText.
+    """
+    frames = []
+    for split in splits:
+        for subtask in discover_subtasks(os.path.join(rad_root, split)):
+            df = pd.read_csv(subtask['path'])
+            df.insert(0, 'source_row', np.arange(len(df)))
+            df.insert(0, 'close_ended', subtask['close_ended'])
+            df.insert(0, 'subtask', subtask['subtask'])
+            df.insert(0, 'task', subtask['task'])
+            df.insert(0, 'split', split)
+            prompts = [build_rad_prompt(row) for _, row in df.iterrows()]
+            df['Prompt'] = [question for question, _ in prompts]
+            df['AnswerText'] = [answer for _, answer in prompts]
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def tokenizer_tag(tokenizer, proj_out_num, max_length):
+    # Identifies a token index: the same tokenizer and prompt settings always map to the same file.
+    key = json.dumps([tokenizer.name_or_path, type(tokenizer).__name__, len(tokenizer), proj_out_num, max_length])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+def build_token_index(manifest, tokenizer, proj_out_num, max_length):
+    """
+    Tokenize every manifest row exactly like RADDataset.__getitem__ does (image tokens + ' ' + prompt + ' ' + answer,
+    truncated to max_length, before padding).
+
+    Returns ragged arrays: ids (int32, all rows concatenated), offsets (int64, len(manifest) + 1) and
+    question_len (int32, tokens of image tokens + ' ' + prompt).
+    """
+    prompt_tokenizer = ImagePromptTokenizer(tokenizer, proj_out_num)
+    ids, lengths, question_len = [], [], []
+    for prompt, answer in zip(manifest['Prompt'], manifest['AnswerText']):
+        question = prompt_tokenizer.image_tokens + ' ' + prompt
+        row_ids = tokenizer.prepare_for_model(prompt_tokenizer.input_ids(question + ' ' + answer),
+                                              max_length=max_length, truncation=True)['input_ids']
+        ids.extend(row_ids)
+        lengths.append(len(row_ids))
+        question_len.append(prompt_tokenizer.length(question, max_length))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return {
+        'ids': np.asarray(ids, dtype=np.int32),
+        'offsets': offsets,
+        'question_len': np.asarray(question_len, dtype=np.int32),
+    }
+
+
+def token_index_path(manifest_dir, tokenizer, proj_out_num, max_length):
+    return os.path.join(manifest_dir, f"tokens_{tokenizer_tag(tokenizer, proj_out_num, max_length)}.npz")
+
+
+def load_manifest_split(manifest_dir, split, task=None, subtask=None):
+    """Rows of one split (optionally one task/subtask), with their row number in the full manifest as 'manifest_row'."""
+    manifest = pd.read_csv(os.path.join(manifest_dir, MANIFEST_NAME), keep_default_na=False)
+    manifest['manifest_row'] = np.arange(len(manifest))
+    mask = manifest['split'] == split
+    if task is not None:
+        mask &= manifest['task'] == task
+    if subtask is not None:
+        mask &= manifest['subtask'].astype(str) == subtask
+    return manifest[mask].reset_index(drop=True)
+
+
+def load_token_index(manifest_dir, tokenizer, proj_out_num, max_length):
+    path = token_index_path(manifest_dir, tokenizer, proj_out_num, max_length)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No token index for this tokenizer in {manifest_dir}, build it with "
+                                f"python -m Bench.dataset.rad_manifest --tokenizer {tokenizer.name_or_path}")
+    with np.load(path) as index:
+        return {key: index[key] for key in index.files}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Compile the 3D-RAD CSVs into one manifest with pre-tokenized prompts.")
+    parser.add_argument('--rad_root', type=str, default="../3DRAD")
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "test"])
+    parser.add_argument('--output_dir', type=str, default="../3DRAD/manifest")
+    parser.add_argument('--tokenizer', type=str, nargs='*', default=[],
+                        help="Tokenizers (model paths) to build a token index for.")
+    parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--max_length', type=int, default=512)
+    parser.add_argument('--use_fast_tokenizer', action="store_true")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = build_manifest(args.rad_root, args.splits)
+    manifest.to_csv(os.path.join(args.output_dir, MANIFEST_NAME), index=False)
+    print(f"{len(manifest)} questions, {manifest.groupby(['split', 'task', 'subtask']).ngroups} subtasks")
+
+    # Read back the way RADDataset does, so the token index sees exactly the same strings.
+    manifest = pd.read_csv(os.path.join(args.output_dir, MANIFEST_NAME), keep_default_na=False)
+    for name in args.tokenizer:
+        tokenizer = load_tokenizer(name, use_fast=args.use_fast_tokenizer, model_max_length=args.max_length,
+                                   padding_side="right", trust_remote_code=True)
+        index = build_token_index(manifest, tokenizer, args.proj_out_num, args.max_length)
+        path = token_index_path(args.output_dir, tokenizer, args.proj_out_num, args.max_length)
+        np.savez(path, **index)
+        print(f"{name}: {len(index['ids'])} tokens -> {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import re
+import glob
+import json
+
+
+# Task directories in 3DRAD/ are named "Task1_Image_Observation", ..., while results
+# and evaluate_result.py use the short keys "task1", ..., "task6".
+TASK_DIRS = {
+    'task1': 'Task1_Image_Observation',
+    'task2': 'Task2_Anomaly_Detection',
+    'task3': 'Task3_Medical_Computation',
+    'task4': 'Task4_Existence_Detection',
+    'task5': 'Task5_Static_Temporal_Diagnosis',
+    'task6': 'Task6_Longitudinal_Temporal_Diagnosis',
+}
+
+# Same split as eval_3DRAD.sh and evaluate_result.py: task1-4 are scored as open-ended, task5-6 as close-ended.
+CLOSE_ENDED_TASKS = ('task5', 'task6')
+
+
+def task_key(task_dir):
+    """Map a task directory name (e.g. "Task6_Longitudinal_Temporal_Diagnosis") to its short key ("task6")."""
+    match = re.match(r'[Tt]ask(\d+)', os.path.basename(os.path.normpath(task_dir)))
+    if match is None:
+        raise ValueError(f"Cannot infer task from directory name: {task_dir}")
+    return f"task{int(match.group(1))}"
+
+
+def discover_subtasks(rad_root, tasks=None):
+    """
+    Find every subtask CSV under rad_root/Task*/.
+
+    Returns a list of dicts with keys task, subtask, path and close_ended, sorted by task then subtask.
+    """
+    subtasks = []
+    for path in glob.glob(os.path.join(rad_root, 'Task*', '**', '*.csv'), recursive=True):
+        task_dir = os.path.relpath(path, rad_root).split(os.sep)[0]
+        task = task_key(task_dir)
+        if tasks is not None and task not in tasks:
+            continue
+        subtasks.append({
+            'task': task,
+            'subtask': os.path.splitext(os.path.basename(path))[0],
+            'path': path,
+            'close_ended': task in CLOSE_ENDED_TASKS,
+        })
+    subtasks.sort(key=lambda x: (int(x['task'][4:]), x['subtask']))
+    return subtasks
+
+
+def load_manifest(manifest_path, tasks=None):
+    """
+    Load a JSON subtask manifest:
+        [{"task": "task1", "subtask": "Anatomical_observation", "path": "Task1_Image_Observation/Anatomical_observation.csv"}, ...]
+
+    Relative paths are resolved against the manifest's directory. "close_ended" is optional and defaults to the
+    task-level split above.
+    """
+    with open(manifest_path, 'r') as f:
+        entries = json.load(f)
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    subtasks = []
+    for entry in entries:
+        task = entry['task']
+        if tasks is not None and task not in tasks:
+            continue
+        path = entry['path']
+        if not os.path.isabs(path):
+            path = os.path.join(manifest_dir, path)
+        subtasks.append({
+            'task': task,
+            'subtask': entry.get('subtask', os.path.splitext(os.path.basename(path))[0]),
+            'path': path,
+            'close_ended': entry.get('close_ended', task in CLOSE_ENDED_TASKS),
+        })
+    return subtasks
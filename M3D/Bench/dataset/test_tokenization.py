@@ -0,0 +1,90 @@
+"""
+ImagePromptTokenizer against plain tokenizer calls, on a tiny SentencePiece LLaMA tokenizer trained in the test, so
+it runs without a checkpoint. test_tokenizer_parity.py compares slow and fast tokenizers of a real checkpoint.
+"""
+import io
+
+import pytest
+
+from .rad_manifest import build_rad_prompt
+from .tokenization import ImagePromptTokenizer, add_lamed_tokens
+
+
+spm = pytest.importorskip("sentencepiece")
+LlamaTokenizer = pytest.importorskip("transformers").LlamaTokenizer
+
+NUM_IMAGE_TOKENS = 8
+
+ROWS = [
+    {"Question": "What abnormality is seen in the left lung?", "Answer": "Ground-glass opacity in the lower lobe."},
+    {"Question": "What is the diameter of the ascending aorta?", "Answer": "38 mm"},
+    {"Question": "Is there  arterial wall calcification?", "Choice A": "Yes", "Choice B": "No",
+     "AnswerChoice": "A", "Answer": "Yes"},
+    {"Question": "How has the nodule changed since the previous scan (12.03.2021)?",
+     "Choice A": "Increased", "Choice B": "Decreased", "Choice C": "Stable", "Choice D": "Resolved",
+     "AnswerChoice": "C", "Answer": "Stable"},
+    {"Question": "Which lobe contains the 4x5 cm mass?\n", "Answer": "Right upper lobe [SEG]"},
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    corpus = [text for row in ROWS for text in build_rad_prompt(row)] * 4
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(corpus), model_writer=model, vocab_size=400, hard_vocab_limit=False,
+        model_type="bpe", byte_fallback=True, unk_id=0, bos_id=1, eos_id=2, pad_id=-1, minloglevel=2,
+    )
+    path = tmp_path_factory.mktemp("tokenizer") / "tokenizer.model"
+    path.write_bytes(model.getvalue())
+    tokenizer = add_lamed_tokens(LlamaTokenizer(str(path)))
+    tokenizer.pad_token = tokenizer.unk_token
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def prompts():
+    image_tokens = "<im_patch>" * NUM_IMAGE_TOKENS
+    return [(image_tokens + ' ' + question, answer) for question, answer in map(build_rad_prompt, ROWS)]
+
+
+def max_lengths(tokenizer, text):
+    # Around the full length (truncation boundary) and inside the image tokens.
+    length = len(tokenizer(text)['input_ids'])
+    return [2, NUM_IMAGE_TOKENS, length - 1, length, length + 1, length + 8]
+
+
+def test_spliced_ids_match_the_tokenizer(tokenizer, prompts):
+    prompt_tokenizer = ImagePromptTokenizer(tokenizer, NUM_IMAGE_TOKENS)
+    assert prompt_tokenizer.splice
+    for question, answer in prompts:
+        for text in (question + ' ' + answer, question):
+            assert prompt_tokenizer.input_ids(text) == tokenizer(text, add_special_tokens=False)['input_ids']
+
+
+def test_encode_and_length(tokenizer, prompts):
+    prompt_tokenizer = ImagePromptTokenizer(tokenizer, NUM_IMAGE_TOKENS)
+    for question, answer in prompts:
+        text = question + ' ' + answer
+        for max_length in max_lengths(tokenizer, text):
+            expected = tokenizer(text, max_length=max_length, truncation=True, padding="max_length", return_tensors="pt")
+            encoded = prompt_tokenizer.encode(text, max_length)
+            assert encoded['input_ids'].tolist() == expected['input_ids'].tolist()
+            assert encoded['attention_mask'].tolist() == expected['attention_mask'].tolist()
+        for max_length in max_lengths(tokenizer, question):
+            expected = tokenizer(question, max_length=max_length, truncation=True)['attention_mask']
+            assert prompt_tokenizer.length(question, max_length) == sum(expected)
+
+
+@pytest.mark.parametrize("padding_side", ["left", "right"])
+def test_batch_encode(tokenizer, prompts, padding_side):
+    prompt_tokenizer = ImagePromptTokenizer(tokenizer, NUM_IMAGE_TOKENS)
+    texts = [question for question, _ in prompts]
+    tokenizer.padding_side = padding_side
+    try:
+        expected = tokenizer(texts, padding=True, return_tensors="pt")
+    finally:
+        tokenizer.padding_side = "right"
+    encoded = prompt_tokenizer.batch_encode(texts, padding_side=padding_side)
+    assert encoded['input_ids'].tolist() == expected['input_ids'].tolist()
+    assert encoded['attention_mask'].tolist() == expected['attention_mask'].tolist()
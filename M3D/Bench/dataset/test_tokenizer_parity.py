@@ -0,0 +1,74 @@
+"""
+Slow vs fast LaMed tokenizer on a fixed set of 3D-RAD prompts.
+
+    M3D_TOKENIZER_PATH=<local M3D-LaMed checkpoint> python -m pytest Bench/dataset/test_tokenizer_parity.py
+
+Skipped when M3D_TOKENIZER_PATH is not set or has no tokenizer files. Run tokenizer_parity.py for the whole dataset.
+"""
+import os
+
+import pytest
+
+from .rad_manifest import build_rad_prompt
+from .tokenization import ImagePromptTokenizer, load_tokenizer
+
+
+TOKENIZER_PATH = os.environ.get("M3D_TOKENIZER_PATH")
+PROJ_OUT_NUM = 256
+MAX_LENGTH = 512
+
+# One row of every kind of 3D-RAD CSV (open-ended, yes/no, four choices) plus spacing, digits and units.
+ROWS = [
+    {"Question": "What abnormality is seen in the left lung?", "Answer": "Ground-glass opacity in the lower lobe."},
+    {"Question": "What is the diameter of the ascending aorta?", "Answer": "38 mm"},
+    {"Question": "Is there  arterial wall calcification?", "Choice A": "Yes", "Choice B": "No",
+     "AnswerChoice": "A", "Answer": "Yes"},
+    {"Question": "How has the nodule changed since the previous scan (12.03.2021)?",
+     "Choice A": "Increased", "Choice B": "Decreased", "Choice C": "Stable", "Choice D": "Resolved",
+     "AnswerChoice": "C", "Answer": "Stable"},
+    {"Question": "Which lobe contains the 4x5 cm mass?\n", "Answer": "Right upper lobe [SEG]"},
+]
+
+
+def has_tokenizer_files(path):
+    return path is not None and os.path.isdir(path) and any(
+        os.path.exists(os.path.join(path, name)) for name in ("tokenizer.model", "tokenizer.json"))
+
+
+pytestmark = pytest.mark.skipif(not has_tokenizer_files(TOKENIZER_PATH),
+                                reason="set M3D_TOKENIZER_PATH to a local checkpoint with tokenizer files")
+
+
+@pytest.fixture(scope="module")
+def tokenizers():
+    kwargs = dict(model_max_length=MAX_LENGTH, padding_side="right", trust_remote_code=True)
+    return load_tokenizer(TOKENIZER_PATH, use_fast=False, **kwargs), load_tokenizer(TOKENIZER_PATH, use_fast=True, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def prompts():
+    image_tokens = "<im_patch>" * PROJ_OUT_NUM
+    return [(image_tokens + ' ' + question, answer) for question, answer in map(build_rad_prompt, ROWS)]
+
+
+def test_special_token_ids(tokenizers):
+    slow, fast = tokenizers
+    assert len(slow) == len(fast)
+    for token in ["<im_patch>", "<bx_start>", "<bx_end>", "[SEG]"]:
+        assert slow.convert_tokens_to_ids(token) == fast.convert_tokens_to_ids(token)
+
+
+def test_input_ids(tokenizers, prompts):
+    slow, fast = (ImagePromptTokenizer(tokenizer, PROJ_OUT_NUM) for tokenizer in tokenizers)
+    for question, answer in prompts:
+        for text in (question + ' ' + answer, question, answer):
+            # encode() without the padding
+            slow_ids = slow.tokenizer.prepare_for_model(slow.input_ids(text), max_length=MAX_LENGTH, truncation=True)
+            fast_ids = fast.tokenizer.prepare_for_model(fast.input_ids(text), max_length=MAX_LENGTH, truncation=True)
+            assert slow_ids["input_ids"] == fast_ids["input_ids"]
+
+
+def test_question_lengths(tokenizers, prompts):
+    slow, fast = (ImagePromptTokenizer(tokenizer, PROJ_OUT_NUM) for tokenizer in tokenizers)
+    for question, _ in prompts:
+        assert slow.length(question, MAX_LENGTH) == fast.length(question, MAX_LENGTH)
@@ -0,0 +1,71 @@
+import os
+import sys
+import argparse
+
+import pandas as pd
+
+from .rad_tasks import discover_subtasks
+from .rad_manifest import build_rad_prompt
+from .tokenization import load_tokenizer
+
+
+def rad_corpus(rad_root, splits, max_per_subtask=None):
+    """(question, answer) of every 3D-RAD question, rendered as RADDataset does."""
+    corpus = []
+    for split in splits:
+        for subtask in discover_subtasks(os.path.join(rad_root, split)):
+            df = pd.read_csv(subtask['path'], nrows=max_per_subtask)
+            corpus.extend(build_rad_prompt(row) for _, row in df.iterrows())
+    return corpus
+
+
+def compare(slow, fast, texts, **kwargs):
+    """Texts whose input ids differ between the two tokenizers."""
+    return [text for text in texts if slow(text, **kwargs)['input_ids'] != fast(text, **kwargs)['input_ids']]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Check that the fast tokenizer gives the same ids as the slow one on 3D-RAD.")
+    parser.add_argument('--model_name_or_path', type=str, default="GoodBaiBai88/M3D-LaMed-Llama-2-7B")
+    parser.add_argument('--rad_root', type=str, default="../3DRAD")
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "test"])
+    parser.add_argument('--max_per_subtask', type=int, default=None, help="Only check the first rows of every subtask CSV.")
+    parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--max_length', type=int, default=512)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    kwargs = dict(model_max_length=args.max_length, padding_side="right", trust_remote_code=True)
+    slow = load_tokenizer(args.model_name_or_path, use_fast=False, **kwargs)
+    fast = load_tokenizer(args.model_name_or_path, use_fast=True, **kwargs)
+    assert len(slow) == len(fast), f"vocab size differs: slow {len(slow)}, fast {len(fast)}"
+    for token in ["<im_patch>", "<bx_start>", "<bx_end>", "[SEG]"]:
+        assert slow.convert_tokens_to_ids(token) == fast.convert_tokens_to_ids(token), f"{token} id differs"
+
+    image_tokens = "<im_patch>" * args.proj_out_num
+    corpus = rad_corpus(args.rad_root, args.splits, args.max_per_subtask)
+    # The dataset inputs (question + answer and question alone) and the plain texts decoding and scoring use.
+    texts = {
+        'question + answer': [image_tokens + ' ' + question + ' ' + answer for question, answer in corpus],
+        'question': [image_tokens + ' ' + question for question, _ in corpus],
+        'answer': [answer for _, answer in corpus],
+        'seg': [question + ' [SEG] ' + answer for question, answer in corpus],
+    }
+
+    failed = False
+    for name, items in texts.items():
+        mismatches = compare(slow, fast, items, max_length=args.max_length, truncation=True)
+        print(f"{name}: {len(items) - len(mismatches)}/{len(items)} identical")
+        if mismatches:
+            failed = True
+            text = mismatches[0]
+            print("  first mismatch:", repr(text[-200:]))
+            print("  slow:", slow.convert_ids_to_tokens(slow(text)['input_ids'])[-20:])
+            print("  fast:", fast.convert_ids_to_tokens(fast(text)['input_ids'])[-20:])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+
+
+class BERTScoreCache:
+    """
+    BERTScore with an on-disk cache of the contextual token embeddings of every scored string.
+
+    Embeddings are content addressed by (scorer model, number of layers, sha1 of the stripped text) and stored in
+    one append-only float32 file per scorer, read back with np.memmap. Only strings never seen before go through
+    the model, which pays off on 3D-RAD where the same references recur across volumes and subtasks.
+
+    compute() has the same interface and values as evaluate's "bertscore" (no idf, no baseline rescaling), so it can
+    replace it in the metrics dict of scoring.py and evaluate_result.py. Only one process should write a cache_dir
+    at a time.
+    """
+    def __init__(self, cache_dir, model_type=None, num_layers=None, lang="en", batch_size=64, device=None):
+        from bert_score.utils import lang2model, model2layers
+
+        self.model_type = model_type if model_type is not None else lang2model[lang]
+        self.num_layers = num_layers if num_layers is not None else model2layers[self.model_type]
+        self.batch_size = batch_size
+        self.device = device
+        self.model = None
+        self.tokenizer = None
+
+        self.cache_dir = os.path.join(cache_dir, f"{self.model_type.replace('/', '--')}_L{self.num_layers}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.data_path = os.path.join(self.cache_dir, "embeddings.f32")
+        self.weight_path = os.path.join(self.cache_dir, "weights.f32")
+        self.index_path = os.path.join(self.cache_dir, "index.jsonl")
+        self.meta_path = os.path.join(self.cache_dir, "meta.json")
+
+        self.hidden_size = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.hidden_size = json.load(f)["hidden_size"]
+        self.index = self._load_index()
+        self.num_rows = sum(length for _, length in self.index.values())
+        self._data = None
+        self._weights = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _load_index(self):
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    # A line cut by a crash is dropped, its rows are simply encoded again.
+                    if not line.endswith("\n"):
+                        break
+                    entry = json.loads(line)
+                    index[entry["key"]] = (entry["offset"], entry["length"])
+        return index
+
+    @staticmethod
+    def text_key(text):
+        # bert_score strips every sentence before encoding it.
+        return hashlib.sha1(str(text).strip().encode("utf-8")).hexdigest()
+
+    def _load_model(self):
+        import torch
+        from bert_score.utils import get_model, get_tokenizer
+
+        if self.device is None:
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.tokenizer = get_tokenizer(self.model_type, use_fast=False)
+        self.model = get_model(self.model_type, self.num_layers).to(self.device)
+
+    def _encode(self, texts):
+        """Token embeddings and weights (0 for CLS/SEP, as bert_score without idf) of texts."""
+        from bert_score.utils import get_bert_embedding
+
+        if self.model is None:
+            self._load_model()
+        idf_dict = defaultdict(lambda: 1.0)
+        idf_dict[self.tokenizer.sep_token_id] = 0
+        idf_dict[self.tokenizer.cls_token_id] = 0
+
+        results = []
+        # Similar lengths in a batch keep padding low, the embeddings do not depend on the batch.
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        for start in range(0, len(order), self.batch_size):
+            batch = [texts[i] for i in order[start:start + self.batch_size]]
+            embeddings, masks, weights = get_bert_embedding(batch, self.model, self.tokenizer, idf_dict,
+                                                            device=self.device)
+            for j in range(len(batch)):
+                length = int(masks[j].sum())
+                results.append((embeddings[j, :length].float().cpu().numpy(), weights[j, :length].float().cpu().numpy()))
+        encoded = [None] * len(texts)
+        for i, result in zip(order, results):
+            encoded[i] = result
+        return encoded
+
+    def _append(self, keys, encoded):
+        if self.hidden_size is None:
+            self.hidden_size = encoded[0][0].shape[1]
+            with open(self.meta_path, 'w') as f:
+                json.dump({"model_type": self.model_type, "num_layers": self.num_layers,
+                           "hidden_size": self.hidden_size}, f)
+
+        # Data first, index last: the index never points at rows that are not on disk.
+        with open(self.data_path, 'ab') as data_file, open(self.weight_path, 'ab') as weight_file:
+            data_file.truncate(self.num_rows * self.hidden_size * 4)
+            weight_file.truncate(self.num_rows * 4)
+            for embeddings, weights in encoded:
+                data_file.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+                weight_file.write(np.ascontiguousarray(weights, dtype=np.float32).tobytes())
+            data_file.flush()
+            weight_file.flush()
+            os.fsync(data_file.fileno())
+            os.fsync(weight_file.fileno())
+
+        with open(self.index_path, 'a') as f:
+            for key, (embeddings, _) in zip(keys, encoded):
+                self.index[key] = (self.num_rows, len(embeddings))
+                f.write(json.dumps({"key": key, "offset": self.num_rows, "length": len(embeddings)}) + "\n")
+                self.num_rows += len(embeddings)
+        self._data = None
+        self._weights = None
+
+    def _arrays(self):
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.float32, mode='r',
+                                   shape=(self.num_rows, self.hidden_size))
+            self._weights = np.memmap(self.weight_path, dtype=np.float32, mode='r', shape=(self.num_rows,))
+        return self._data, self._weights
+
+    def embed(self, texts):
+        """(embeddings, weights) of every text, encoding only the unique texts that are not cached."""
+        keys = [self.text_key(text) for text in texts]
+        if not keys:
+            return []
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in self.index or key in missing:
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing[key] = str(text)
+        if missing:
+            self._append(list(missing.keys()), self._encode(list(missing.values())))
+
+        data, weights = self._arrays()
+        results = []
+        for key in keys:
+            offset, length = self.index[key]
+            results.append((data[offset:offset + length], weights[offset:offset + length]))
+        return results
+
+    def compute(self, predictions, references, lang="en", batch_size=None, **kwargs):
+        """Same arguments and outputs as evaluate's bertscore.compute, for single references."""
+        if batch_size is not None:
+            self.batch_size = batch_size
+        references = [ref[0] if isinstance(ref, (list, tuple)) else ref for ref in references]
+        hyps = self.embed(predictions)
+        refs = self.embed(references)
+
+        precision, recall, f1 = [], [], []
+        for (hyp, hyp_weights), (ref, ref_weights) in zip(hyps, refs):
+            hyp = hyp / np.linalg.norm(hyp, axis=-1, keepdims=True)
+            ref = ref / np.linalg.norm(ref, axis=-1, keepdims=True)
+            sim = hyp @ ref.T
+            # An empty sentence (only CLS and SEP, whose weights are 0) gives a NaN score, as in bert_score.
+            with np.errstate(invalid="ignore", divide="ignore"):
+                p = float((sim.max(axis=1) * hyp_weights).sum() / hyp_weights.sum())
+                r = float((sim.max(axis=0) * ref_weights).sum() / ref_weights.sum())
+                f = 2 * p * r / (p + r) if p + r != 0 else float("nan")
+            # bert_score zeroes P of an empty candidate, R of an empty reference and F wherever it is NaN.
+            precision.append(0.0 if len(hyp) == 2 else p)
+            recall.append(0.0 if len(ref) == 2 else r)
+            f1.append(0.0 if np.isnan(f) else f)
+        return {"precision": precision, "recall": recall, "f1": f1, "hashcode": f"{self.model_type}_L{self.num_layers}_cached"}
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        return (f"bertscore cache: {self.hits} hits, {self.misses} encoded, hit rate {hit_rate:.2%}, "
+                f"{len(self.index)} strings cached")
@@ -0,0 +1,138 @@
+import torch
+import torch.nn.functional as F
+
+
+CHOICE_LETTERS = ["A", "B", "C", "D"]
+
+
+def letter_token_ids(tokenizer, letters=CHOICE_LETTERS):
+    """
+    Id of the first token of each option letter as it follows "Answer:" in a prompt,
+    found by tokenizing the prompt end with and without the letter.
+    """
+    prefix = tokenizer("Answer:", add_special_tokens=False)['input_ids']
+    ids = []
+    for letter in letters:
+        full = tokenizer("Answer: " + letter, add_special_tokens=False)['input_ids']
+        if full[:len(prefix)] != prefix or len(full) == len(prefix):
+            raise ValueError(f"Cannot find the token id of option {letter} with this tokenizer.")
+        ids.append(full[len(prefix)])
+    return ids
+
+
+def valid_letters(choices):
+    # Options filled with "-" are absent (e.g. Task4 only has A and B).
+    return [i for i, choice in enumerate(choices) if str(choice).strip() not in ("", "-", "nan")]
+
+
+def _position_ids(attention_mask):
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return position_ids
+
+
+@torch.inference_mode()
+def score_letters(model, tokenizer, image, input_ids, attention_mask, choices, image_keys=None, letter_ids=None):
+    """
+    Pick an option per question from the next-token distribution over the option letters after a single
+    prefill pass over image tokens + question, instead of generating an answer.
+
+    Args:
+        input_ids, attention_mask: the prompts (image tokens + question, as returned by RADDataset) left padded,
+            as tokenize_questions in eval_3DRAD.py gives them; attention_mask may be None for a single prompt
+        choices: per question, the list of the 4 option texts
+
+    Returns:
+        list of (letter index, confidence), the confidence is the softmax over the valid letters
+    """
+    if letter_ids is None:
+        letter_ids = letter_token_ids(tokenizer)
+
+    input_ids = input_ids.to(device=model.device)
+    attention_mask = torch.ones_like(input_ids) if attention_mask is None else attention_mask.to(device=model.device)
+
+    _, _, _, _, inputs_embeds, _ = model.prepare_inputs_for_multimodal(
+        input_ids, None, attention_mask, None, None, image, image_keys)
+    outputs = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                    position_ids=_position_ids(attention_mask), use_cache=False)
+    next_token_logits = outputs.logits[:, -1, :].float()
+
+    results = []
+    for i, row_choices in enumerate(choices):
+        letters = valid_letters(row_choices)
+        logits = next_token_logits[i, [letter_ids[k] for k in letters]]
+        probs = torch.softmax(logits, dim=-1)
+        best = int(torch.argmax(probs))
+        results.append((letters[best], float(probs[best])))
+    return results
+
+
+def tokenize_options(prompt_tokenizer, questions, choices):
+    """
+    Inputs of score_options: the (question, option) sequences right padded ("option_input_id",
+    "option_attention_mask") and per sequence its question, option letter and question length ("option_rows",
+    "option_question_len"). Only uses the tokenizer, so it runs in the Prefetcher prepare hook.
+
+    Args:
+        prompt_tokenizer: ImagePromptTokenizer, which splices the image tokens of the questions in
+    """
+    rows, texts = [], []
+    for i, (question, row_choices) in enumerate(zip(questions, choices)):
+        for k in valid_letters(row_choices):
+            rows.append((i, k))
+            texts.append(question + ' ' + "{}. {}".format(CHOICE_LETTERS[k], row_choices[k]))
+    encoded = prompt_tokenizer.batch_encode(texts)
+    question_len = prompt_tokenizer.batch_encode(questions)["attention_mask"].sum(-1)
+    return {
+        "option_input_id": encoded["input_ids"],
+        "option_attention_mask": encoded["attention_mask"],
+        "option_rows": torch.tensor(rows, dtype=torch.long),
+        "option_question_len": question_len[[i for i, _ in rows]],
+    }
+
+
+@torch.inference_mode()
+def score_options(model, image, inputs, image_keys=None):
+    """
+    Pick the option whose full answer text ("A. <option>", the training answer format) has the highest
+    summed log-probability after image tokens + question.
+
+    The image is encoded once per question and all (question, option) sequences are scored in one forward pass.
+
+    Args:
+        inputs: the sequences of every question and valid option, as returned by tokenize_options
+
+    Returns:
+        list of (letter index, confidence), the confidence is the softmax over the options' summed log-probabilities
+    """
+    image_features = model.encode_images(image, image_keys)
+    num_image_tokens = image_features.shape[1]
+
+    # Bookkeeping stays on the host, only the ids and the mask go to the model.
+    sequences = [(i, k, length, question_len) for (i, k), length, question_len in zip(
+        inputs["option_rows"].tolist(), inputs["option_attention_mask"].sum(-1).tolist(),
+        inputs["option_question_len"].tolist())]
+    input_ids = inputs["option_input_id"].to(device=model.device)
+    attention_mask = inputs["option_attention_mask"].to(device=model.device)
+
+    # Right padded, so the image tokens are at positions 1..num_image_tokens of every sequence.
+    inputs_embeds = model.get_model().embed_tokens(input_ids)
+    rows = torch.tensor([i for i, _, _, _ in sequences], device=image_features.device)
+    inputs_embeds[:, 1:1 + num_image_tokens] = image_features[rows].to(dtype=inputs_embeds.dtype)
+
+    outputs = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=False)
+    log_probs = F.log_softmax(outputs.logits[:, :-1, :].float(), dim=-1)
+    token_log_probs = log_probs.gather(-1, input_ids[:, 1:, None]).squeeze(-1)
+
+    scores = {}
+    for j, (i, k, length, question_len) in enumerate(sequences):
+        # Tokens question_len..length-1 are the answer, predicted from the previous position.
+        scores.setdefault(i, []).append((k, float(token_log_probs[j, question_len - 1:length - 1].sum())))
+
+    results = []
+    for i in range(len(image)):
+        letters = [k for k, _ in scores[i]]
+        probs = torch.softmax(torch.tensor([score for _, score in scores[i]]), dim=-1)
+        best = int(torch.argmax(probs))
+        results.append((letters[best], float(probs[best])))
+    return results
@@ -0,0 +1,79 @@
+import numpy as np
+import torch
+
+from Bench.dataset.multi_dataset import RADDataset
+from Bench.dataset.volume_codecs import CODECS, encode_volume, decode_volume
+from Bench.eval.eval_3DRAD import get_parser, seed_everything, load_model
+
+
+def round_trip(array, codec, compression):
+    """The volume as a shard stores it and reads it back."""
+    chunks, entry = encode_volume(array, codec, compression)
+    buffer = np.frombuffer(b"".join(bytes(chunk) for chunk in chunks), dtype=np.uint8)
+    return decode_volume(buffer, entry)
+
+
+def parse_args(args=None):
+    parser = get_parser()
+    parser.description = "Compare model outputs on 3D-RAD volumes stored with each shard codec against the raw volumes."
+    parser.add_argument('--codecs', type=str, nargs='+', default=[c for c in CODECS if c != "raw"], choices=CODECS)
+    parser.add_argument('--compression', type=str, default=None, choices=["zstd"],
+                        help="Also round-trip through zstd (lossless, only checks the decoder).")
+    parser.add_argument('--num_samples', type=int, default=64)
+    parser.add_argument('--fidelity_new_tokens', type=int, default=32,
+                        help="Greedy tokens generated to compare the answers.")
+    return parser.parse_args(args)
+
+
+@torch.inference_mode()
+def model_outputs(model, tokenizer, image, question, max_new_tokens):
+    # Image features, next-token logits of the prompt and the greedy answer of one question.
+    image = image.unsqueeze(0).to(device=model.device)
+    input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=model.device)
+    features = model.encode_images(image)
+    logits = model(images=image, input_ids=input_id).logits[0, -1].float()
+    generation = model.generate(image, input_id, max_new_tokens=max_new_tokens, do_sample=False)
+    return features.float(), logits, tokenizer.batch_decode(generation, skip_special_tokens=True)[0]
+
+
+def main():
+    seed_everything(42)
+    args = parse_args()
+    tokenizer, model = load_model(args)
+    dataset = RADDataset(args, tokenizer=tokenizer, close_ended=args.close_ended, mode='test')
+    rows = np.random.permutation(len(dataset))[:args.num_samples]
+
+    stats = {codec: {'voxel_max_err': 0.0, 'psnr': [], 'feature_max_err': 0.0, 'logit_max_err': 0.0,
+                     'top1_agree': 0, 'answer_agree': 0} for codec in args.codecs}
+    for row in rows:
+        data = dataset.data_list.iloc[row]
+        array = np.load(dataset.data_root_df.at[data['VolumeName'], 'Path'])
+        question, _ = dataset.build_prompt(data)
+        question = dataset.image_tokens + ' ' + question
+
+        reference = dataset.transform(array)
+        ref_features, ref_logits, ref_answer = model_outputs(model, tokenizer, reference, question, args.fidelity_new_tokens)
+        for codec in args.codecs:
+            image = dataset.transform(round_trip(array, codec, args.compression))
+            features, logits, answer = model_outputs(model, tokenizer, image, question, args.fidelity_new_tokens)
+            s = stats[codec]
+            err = (image - reference).abs().max().item()
+            mse = ((image - reference) ** 2).mean().item()
+            data_range = (reference.max() - reference.min()).item()
+            s['voxel_max_err'] = max(s['voxel_max_err'], err)
+            s['psnr'].append(float('inf') if mse == 0 else 10 * np.log10(data_range ** 2 / mse))
+            s['feature_max_err'] = max(s['feature_max_err'], (features - ref_features).abs().max().item())
+            s['logit_max_err'] = max(s['logit_max_err'], (logits - ref_logits).abs().max().item())
+            s['top1_agree'] += int(logits.argmax() == ref_logits.argmax())
+            s['answer_agree'] += int(answer == ref_answer)
+
+    print(f"{len(rows)} questions, compression={args.compression}")
+    print(f"{'codec':>8} {'voxel max err':>14} {'min PSNR (dB)':>14} {'feature max err':>16} {'logit max err':>14} "
+          f"{'top-1 agree':>12} {'answer agree':>13}")
+    for codec, s in stats.items():
+        print(f"{codec:>8} {s['voxel_max_err']:>14.3g} {min(s['psnr']):>14.1f} {s['feature_max_err']:>16.3g} "
+              f"{s['logit_max_err']:>14.3g} {s['top1_agree'] / len(rows):>12.1%} {s['answer_agree'] / len(rows):>13.1%}")
+
+
+if __name__ == "__main__":
+    main()
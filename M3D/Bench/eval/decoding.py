@@ -0,0 +1,77 @@
+import os
+import re
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+# 3D-RAD answers are a single short line ("A. <option>", "Right hilar region.", "30x13 mm", "Yes"),
+# so decoding can stop at the first newline and needs far fewer tokens than the 256 default.
+DECODING_PROFILES = {
+    'task1': {'max_new_tokens': 64, 'stop_strings': ["\n"]},
+    'task2': {'max_new_tokens': 64, 'stop_strings': ["\n"]},
+    'task3': {'max_new_tokens': 32, 'stop_strings': ["\n"]},
+    'task4': {'max_new_tokens': 16, 'stop_strings': ["\n"]},
+    'task5': {'max_new_tokens': 64, 'stop_strings': ["\n"]},
+    'task6': {'max_new_tokens': 64, 'stop_strings': ["\n"]},
+    # Close-ended answers only need the option letter: stop at the period right after it.
+    'choice_letter': {'max_new_tokens': 8, 'stop_strings': ["A.", "B.", "C.", "D."]},
+}
+
+
+def infer_task(path):
+    # Task of a 3D-RAD subtask CSV from its directory, e.g. ".../Task3_Medical_Computation/Diameter.csv" -> "task3".
+    match = re.match(r'[Tt]ask(\d+)', os.path.basename(os.path.dirname(os.path.abspath(path))))
+    return f"task{int(match.group(1))}" if match is not None else None
+
+
+def get_decoding_profile(name, task=None, max_new_tokens=256):
+    """
+    Resolve a decoding profile to {'max_new_tokens', 'stop_strings'}.
+
+    name is "auto" (profile of task, if there is one), "none" (max_new_tokens and no stop strings,
+    the previous behaviour) or a key of DECODING_PROFILES.
+    """
+    if name == "auto":
+        name = task if task in DECODING_PROFILES else "none"
+    if name == "none":
+        return {'max_new_tokens': max_new_tokens, 'stop_strings': []}
+    if name not in DECODING_PROFILES:
+        raise ValueError(f"Unknown decoding profile {name}, expected auto, none or one of {list(DECODING_PROFILES)}")
+    return dict(DECODING_PROFILES[name])
+
+
+class StopOnStrings(StoppingCriteria):
+    """
+    Stops each row once its generated text contains one of stop_strings.
+
+    Works whether generate() returns the prompt or not: the generated part is everything after the length of
+    input_ids at the first call, which holds exactly one new token. Create a new instance for every generate() call.
+    """
+    def __init__(self, tokenizer, stop_strings):
+        self.tokenizer = tokenizer
+        self.stop_strings = list(stop_strings)
+        self.start = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.start is None:
+            self.start = input_ids.shape[1] - 1
+        texts = self.tokenizer.batch_decode(input_ids[:, self.start:], skip_special_tokens=True)
+        # Leading whitespace is not an answer yet, a newline there must not stop the row.
+        return torch.tensor([any(s in text.lstrip() for s in self.stop_strings) for text in texts],
+                            dtype=torch.bool, device=input_ids.device)
+
+
+def stopping_criteria(tokenizer, profile):
+    if not profile['stop_strings']:
+        return None
+    return StoppingCriteriaList([StopOnStrings(tokenizer, profile['stop_strings'])])
+
+
+def truncate_at_stop(text, stop_strings):
+    # Cut a decoded answer right after the first stop string (generation may overrun it within the last token).
+    text = text.lstrip()
+    ends = [text.find(s) + len(s) for s in stop_strings if s in text]
+    if ends:
+        text = text[:min(ends)]
+    return text.strip()
@@ -1,23 +1,28 @@
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '6'
-import csv
 import random
 import numpy as np
+import pandas as pd
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import argparse
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from tqdm import tqdm
+from transformers import AutoModelForCausalLM
 
 from Bench.dataset.multi_dataset import RADDataset
+from Bench.dataset.tokenization import ImagePromptTokenizer, load_tokenizer
+from Bench.dataset.samplers import LengthBucketBatchSampler, VolumeGroupedBatchSampler, volume_reads
 from Bench.eval.metrics import compute_exact_match, qa_f1_score
 # If the model is not from huggingface but local, please uncomment and import the model architecture.
 from LaMed.src.model.language_model import *
-import evaluate
-bleu = evaluate.load("bleu")
-bertscore = evaluate.load("bertscore")
-meteor = evaluate.load("meteor")
-rouge = evaluate.load("rouge")
+from LaMed.src.model.feature_cache import VisionFeatureCache
+from LaMed.src.model.prefix_cache import PrefixKVCache
+from Bench.eval.scoring import load_open_metrics, score_open_csv
+from Bench.eval.resumable_csv import ResumableCSVWriter, question_hash
+from Bench.eval.results_store import ResultsStore
+from Bench.eval.decoding import DECODING_PROFILES, get_decoding_profile, infer_task, stopping_criteria, truncate_at_stop
+from Bench.eval.choice_scoring import CHOICE_LETTERS, letter_token_ids, score_letters, score_options, tokenize_options
+from Bench.eval.prefetch import Prefetcher
+
 
 def seed_everything(seed):
     torch.manual_seed(seed)
@@ -29,27 +34,81 @@ def seed_everything(seed):
     torch.cuda.manual_seed_all(seed)
 
 
-def parse_args(args=None):
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_name_or_path', type=str, default="GoodBaiBai88/M3D-LaMed-Llama-2-7B")
     parser.add_argument('--max_length', type=int, default=512)
+    parser.add_argument('--use_fast_tokenizer', action="store_true",
+                        help="Use the fast (Rust) tokenizer, check it with Bench/dataset/tokenizer_parity.py first.")
     parser.add_argument('--max_new_tokens', type=int, default=256)
     parser.add_argument('--do_sample', type=bool, default=False)
     parser.add_argument('--top_p', type=float, default=None)
     parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--decoding_profile', type=str, default="auto", choices=["auto", "none"] + list(DECODING_PROFILES),
+                        help="auto picks the token budget and stop strings of the task, none decodes up to --max_new_tokens.")
+    parser.add_argument('--task', type=str, default=None,
+                        help="Task key (task1..task6) of the subtask, inferred from the CSV directory when not given.")
     # parser.add_argument('--device', type=str, default="cuda", choices=["cuda", "cpu"])
 
     # data
     parser.add_argument('--data_root', type=str, default="../valid_path.csv")
     parser.add_argument('--vqa_data_test_path', type=str,
                         default="../3DRAD/test/task6/e.csv")
+    parser.add_argument('--rad_manifest', type=str, default=None,
+                        help="Directory built by Bench/dataset/rad_manifest.py, prompts are then read pre-tokenized.")
     parser.add_argument('--close_ended', action="store_true")
+    parser.add_argument('--close_scoring', type=str, default="generate", choices=["generate", "letter", "option"],
+                        help="Close-ended answers: free generation, next-token logits of the option letters, "
+                             "or summed log-probability of each full option.")
     parser.add_argument('--output_dir', type=str,
                         default="../results/7b/task6/e/")
 
     parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--volume_mmap', action="store_true",
+                        help="Memory-map the .npy volumes, so DataLoader workers share them through the page cache.")
+    parser.add_argument('--volume_shards', type=str, default=None,
+                        help="Directory of packed volumes (Bench/dataset/volume_shards.py), read instead of the .npy files.")
+    parser.add_argument('--volume_shard_root', type=str, default=None, help="The --root the shards were packed with.")
+
+    # batching, greedy outputs are the same as with batch_size=1
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--length_bucketing', action="store_true",
+                        help="Batch prompts of similar token length together (only with --batch_size > 1).")
+    parser.add_argument('--num_workers', type=int, default=32)
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Batches tokenized and copied to the GPU ahead of the model on a background thread, 0 disables.")
+    parser.add_argument('--no_resume', action="store_true",
+                        help="Start the output CSV over instead of skipping the rows a previous run already wrote.")
+
+    # open-ended scoring runs after generation, over the whole subtask
+    parser.add_argument('--bert_batch_size', type=int, default=64, help="Batch size of the BERTScore pass.")
+    parser.add_argument('--bertscore_cache_dir', type=str, default=None,
+                        help="Directory of the BERTScore embedding cache, reused across subtasks and runs.")
+
+    # columnar results store shared by all models (see results_store.py)
+    parser.add_argument('--results_store', type=str, default=None,
+                        help="Also append the predictions and per-row metrics of every subtask to this store.")
+    parser.add_argument('--results_model', type=str, default=None,
+                        help="Model name in the results store, the last part of --model_name_or_path by default.")
+
+    # per-volume vision feature cache, 0 disables the memory tier
+    parser.add_argument('--feature_cache_size', type=int, default=0,
+                        help="Number of volumes whose projected image features are kept in memory.")
+    parser.add_argument('--feature_cache_dir', type=str, default=None,
+                        help="Optional directory for the on-disk feature cache tier.")
+
+    # key/values of the BOS + image token prefix, reused by all questions about a volume
+    parser.add_argument('--prefix_cache_size', type=int, default=0,
+                        help="Number of volumes whose image prefix key/values are kept, 0 disables the cache.")
+    parser.add_argument('--group_by_volume', action="store_true",
+                        help="Evaluate the questions about the same volume one after the other, "
+                             "the default with --feature_cache_size or --prefix_cache_size unless --length_bucketing.")
+
+    return parser
 
-    return parser.parse_args(args)
+
+def parse_args(args=None):
+    return get_parser().parse_args(args)
 
 
 def postprocess_text(preds, labels):
@@ -58,21 +117,16 @@ def postprocess_text(preds, labels):
     return preds, labels
 
 
-def main():
-    seed_everything(42)
-    args = parse_args()
-    print("model_name_or_path: ", args.model_name_or_path)
-    print("vqa_data_test_path: ", args.vqa_data_test_path)
-    print("output_dir: ", args.output_dir)
-    print("close_ended: ", args.close_ended)
+def load_metrics(args=None):
+    return load_open_metrics(getattr(args, 'bertscore_cache_dir', None))
 
-    # device = torch.device(args.device)
 
-    tokenizer = AutoTokenizer.from_pretrained(
+def load_model(args):
+    tokenizer = load_tokenizer(
         args.model_name_or_path,
+        use_fast=args.use_fast_tokenizer,
         model_max_length=args.max_length,
         padding_side="right",
-        use_fast=False,
         trust_remote_code=True,
     )
     model = AutoModelForCausalLM.from_pretrained(
@@ -84,101 +138,236 @@ def main():
     # model = model.to(device=device)
     print(model.config.max_position_embeddings)
 
-    test_dataset = RADDataset(args, tokenizer=tokenizer, close_ended=args.close_ended, mode='test')
-
-    test_dataloader = DataLoader(
-        test_dataset,
-        batch_size=1,
-        num_workers=32,
+    if args.feature_cache_size > 0 or args.feature_cache_dir is not None:
+        model.set_feature_cache(VisionFeatureCache(
+            max_items=args.feature_cache_size,
+            cache_dir=args.feature_cache_dir,
+            namespace=args.model_name_or_path,
+        ))
+    if args.prefix_cache_size > 0:
+        model.set_prefix_cache(PrefixKVCache(max_items=args.prefix_cache_size))
+    return tokenizer, model
+
+
+def build_dataloader(args, test_dataset, indices):
+    # indices are the dataset rows still to evaluate, all of them unless a previous run is resumed.
+    # Also returns the volume names in the order the dataloader visits them.
+    subset = Subset(test_dataset, indices)
+    volume_names = test_dataset.data_list['VolumeName'].tolist()
+    subset_volumes = [volume_names[i] for i in indices]
+    # The feature and prefix caches only pay off when the questions about a volume come together.
+    caching = args.feature_cache_size > 0 or args.prefix_cache_size > 0
+    batch_sampler = None
+    if args.group_by_volume or (caching and not args.length_bucketing):
+        batch_sampler = VolumeGroupedBatchSampler(subset_volumes, args.batch_size)
+    elif args.length_bucketing and args.batch_size > 1:
+        lengths = test_dataset.prompt_lengths()
+        batch_sampler = LengthBucketBatchSampler([lengths[i] for i in indices], args.batch_size)
+
+    order = [i for batch in batch_sampler for i in batch] if batch_sampler is not None else range(len(indices))
+    reads, volumes, per_volume = volume_reads(subset_volumes, order)
+    print(f"volume reads: {reads} for {volumes} volumes ({per_volume:.2f} per volume)")
+    visited = [subset_volumes[i] for i in order]
+    if batch_sampler is not None:
+        return DataLoader(
+            subset,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_workers,
+            pin_memory=True,
+        ), visited
+    return DataLoader(
+        subset,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
         pin_memory=True,
         shuffle=False,
         drop_last=False,
-    )
+    ), visited
+
+
+def tokenize_questions(prompt_tokenizer, sample):
+    """
+    Adds the prompt ids of a batch to the sample ("input_id", and "attention_mask" for more than one question).
+    Rows are left padded, so that every row's prompt ends right before the first generated token. Runs on the
+    prefetch thread, so the padding is done by ImagePromptTokenizer.batch_encode instead of switching
+    tokenizer.padding_side.
+    """
+    questions = sample["question"]
+    encoded = prompt_tokenizer.batch_encode(questions, padding_side="left")
+    sample["input_id"] = encoded["input_ids"]
+    if len(questions) > 1:
+        sample["attention_mask"] = encoded["attention_mask"]
+    return sample
+
+
+def batch_choices(sample):
+    # The collated "choices" are per option, regroup them per question.
+    return [[c[i] for c in sample["choices"]] for i in range(len(sample["question"]))]
+
+
+def tokenize_choices(args, prompt_tokenizer, sample):
+    """prepare function of close-ended scoring: the prompts for "letter", the (question, option) sequences for "option"."""
+    if args.close_scoring == "letter":
+        return tokenize_questions(prompt_tokenizer, sample)
+    sample.update(tokenize_options(prompt_tokenizer, sample["question"], batch_choices(sample)))
+    return sample
+
+
+def generate_batch(args, model, tokenizer, sample, profile=None):
+    if "input_id" not in sample:
+        sample = tokenize_questions(ImagePromptTokenizer(tokenizer, args.proj_out_num), sample)
+    image = sample["image"].to(device=model.device)
+    input_id = sample["input_id"].to(device=model.device)
+    attention_mask = sample["attention_mask"].to(device=model.device) if "attention_mask" in sample else None
+
+    if profile is None:
+        profile = get_decoding_profile("none", max_new_tokens=args.max_new_tokens)
+
+    with torch.inference_mode():
+        generation = model.generate(image, input_id, attention_mask=attention_mask,
+                                    image_keys=sample["volume_name"],
+                                    max_new_tokens=profile['max_new_tokens'],
+                                    stopping_criteria=stopping_criteria(tokenizer, profile),
+                                    do_sample=args.do_sample, top_p=args.top_p,
+                                    temperature=args.temperature)
+    generated_texts = tokenizer.batch_decode(generation, skip_special_tokens=True)
+    if profile['stop_strings']:
+        generated_texts = [truncate_at_stop(text, profile['stop_strings']) for text in generated_texts]
+    return generated_texts
+
+
+def score_choices_batch(args, model, tokenizer, sample, letter_ids):
+    image = sample["image"].to(device=model.device)
+    choices = batch_choices(sample)
+    if args.close_scoring == "letter":
+        if "input_id" not in sample:
+            sample = tokenize_questions(ImagePromptTokenizer(tokenizer, args.proj_out_num), sample)
+        results = score_letters(model, tokenizer, image, sample["input_id"], sample.get("attention_mask"), choices,
+                                image_keys=sample["volume_name"], letter_ids=letter_ids)
+    else:
+        if "option_input_id" not in sample:
+            sample.update(tokenize_options(ImagePromptTokenizer(tokenizer, args.proj_out_num), sample["question"], choices))
+        results = score_options(model, image, sample, image_keys=sample["volume_name"])
+    preds = ["{}. {}".format(CHOICE_LETTERS[k], choices[i][k]) for i, (k, _) in enumerate(results)]
+    return preds, [confidence for _, confidence in results]
+
+
+def evaluate_subtask(args, model, tokenizer, metrics):
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.unk_token if tokenizer.unk_token is not None else tokenizer.eos_token
+
+    test_dataset = RADDataset(args, tokenizer=tokenizer, close_ended=args.close_ended, mode='test')
+    question_hashes = [question_hash(test_dataset.build_prompt(test_dataset.data_list.iloc[i])[0])
+                       for i in range(len(test_dataset))]
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
+    task = args.task if args.task is not None else infer_task(args.vqa_data_test_path)
+    profile = get_decoding_profile(args.decoding_profile, task, args.max_new_tokens)
+    print(f"decoding: max_new_tokens={profile['max_new_tokens']}, stop_strings={profile['stop_strings']}")
+
+    scoring = args.close_ended and args.close_scoring != "generate"
+    letter_ids = letter_token_ids(tokenizer) if scoring and args.close_scoring == "letter" else None
+
     if args.close_ended:
         output_path = os.path.join(args.output_dir, "eval_close_vqa.csv")
-        with open(output_path, mode='w') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow(["Question Aspect", "Question", "Answer", "Answer Choice", "Pred", "Correct"])
-            cc = 0
-            for sample in tqdm(test_dataloader):
-                question = sample["question"]
-                question_aspect = sample["question_aspect"]
-                answer_choice = sample["answer_choice"]
-                answer = sample['answer']
-
-                image = sample["image"].to(device=model.device)
-
-                input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=model.device)
-
-                with torch.inference_mode():
-                    generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens,
-                                                do_sample=args.do_sample, top_p=args.top_p,
-                                                temperature=args.temperature)
-                generated_texts = tokenizer.batch_decode(generation, skip_special_tokens=True)
-
-                if answer_choice[0] + '.' in generated_texts[0]:
-                    correct = 1
+        header = ["Question Aspect", "Question", "Answer", "Answer Choice", "Pred", "Correct"]
+        if scoring:
+            header.append("Confidence")
+    else:
+        # Generation only writes raw predictions, the metrics are computed afterwards for the whole subtask.
+        output_path = os.path.join(args.output_dir, "eval_open_pred.csv")
+        header = ["Question Aspect", "Question", "Answer", "Pred"]
+
+    # Rows are written as their batch finishes, in visiting order, the Row column gives their dataset order.
+    with ResumableCSVWriter(output_path, header, resume=not args.no_resume, question_hashes=question_hashes) as outfile:
+        indices = [i for i in range(len(test_dataset)) if not outfile.is_done(i, question_hashes[i])]
+        if len(indices) < len(test_dataset):
+            print(f"Resuming {output_path}: {len(test_dataset) - len(indices)} rows done, {len(indices)} left")
+        test_dataloader, visited = build_dataloader(args, test_dataset, indices)
+
+        # Prompts are tokenized on the prefetch thread, with the image tokens spliced in by the dataset's ImagePromptTokenizer.
+        prompt_tokenizer = test_dataset.prompt_tokenizer
+        if scoring:
+            prepare = lambda sample: tokenize_choices(args, prompt_tokenizer, sample)
+        else:
+            prepare = lambda sample: tokenize_questions(prompt_tokenizer, sample)
+        prefetcher = Prefetcher(test_dataloader, model.device, args.prefetch_depth, prepare=prepare)
+
+        cc = 0
+        for sample in prefetcher:
+            if scoring:
+                generated_texts, confidences = score_choices_batch(args, model, tokenizer, sample, letter_ids)
+            else:
+                generated_texts = generate_batch(args, model, tokenizer, sample, profile)
+
+            for i, generated_text in enumerate(generated_texts):
+                index = int(sample["index"][i])
+                question = sample["question"][i]
+                question_aspect = sample["question_aspect"][i]
+                answer = sample['answer'][i]
+
+                if args.close_ended:
+                    answer_choice = sample["answer_choice"][i]
+                    if answer_choice + '.' in generated_text:
+                        correct = 1
+                    else:
+                        correct = 0
+
+                    if cc == 0:
+                        print(question)
+                        print(answer)
+                        print(generated_text)
+
+                    row = [question_aspect, question, answer, answer_choice, generated_text, correct]
+                    if scoring:
+                        row.append(confidences[i])
                 else:
-                    correct = 0
-
-                if cc == 0:
-                    print(question[0])
-                    print(answer[0])
-                    print(generated_texts[0])
+                    row = [question_aspect, question, answer, generated_text]
 
-                writer.writerow(
-                    [question_aspect, question[0], answer[0], answer_choice[0], generated_texts[0], correct])
+                outfile.writerow([index, question_hashes[index]] + row)
                 cc += 1
-    else:
-        output_path = os.path.join(args.output_dir, "eval_open_vqa.csv")
-        with open(output_path, mode='w') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow(["Question Aspect", "Question", "Answer", "Pred", "bleu", "rouge1", "meteor", "bert_f1"])
-            for sample in tqdm(test_dataloader):
-                question = sample["question"]
-                question_aspect = sample['question_aspect']
-                answer = sample['answer']
-
-                image = sample["image"].to(device=model.device)
-                input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=model.device)
-                # print(model.device)
-                # print(image.device)
-                # print(input_id.device)
-                with torch.inference_mode():
-                    generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens,
-                                                do_sample=args.do_sample, top_p=args.top_p,
-                                                temperature=args.temperature)
-                generated_texts = tokenizer.batch_decode(generation, skip_special_tokens=True)
-
-                result = dict()
-                decoded_preds, decoded_labels = postprocess_text(generated_texts, answer)
-                # 过滤掉空预测
-                filtered = [(pred, refs) for pred, refs in zip(decoded_preds, decoded_labels) if pred.strip() != ""]
-                if not filtered:
-                    continue  # 如果全部空，直接跳过这一轮
-
-                decoded_preds, decoded_labels = zip(*filtered)
-
-                bleu_score = bleu.compute(predictions=decoded_preds, references=decoded_labels, max_order=1)
-                result["bleu"] = bleu_score['bleu']
-
-                rouge_score = rouge.compute(predictions=decoded_preds, references=decoded_labels,
-                                             rouge_types=['rouge1'])
-                result["rouge1"] = rouge_score['rouge1']
-
-                meteor_score = meteor.compute(predictions=decoded_preds, references=decoded_labels)
-                result["meteor"] = meteor_score['meteor']
-
-                bert_score = bertscore.compute(predictions=decoded_preds, references=decoded_labels, lang="en")
-                result["bert_f1"] = sum(bert_score['f1']) / len(bert_score['f1'])
-
-                writer.writerow(
-                    [question_aspect, question[0], answer[0], generated_texts[0], result["bleu"], result["rouge1"],
-                     result["meteor"], result["bert_f1"]])
+            outfile.flush()
+        print(prefetcher.report())
+
+    if not args.close_ended:
+        # 过滤掉空预测
+        result_path = os.path.join(args.output_dir, "eval_open_vqa.csv")
+        scored = score_open_csv(output_path, result_path, metrics,
+                                bert_batch_size=args.bert_batch_size, drop_empty=True)
+
+    if args.results_store is not None:
+        if args.close_ended:
+            scored = pd.read_csv(output_path, dtype={"Pred": str, "Answer": str}, keep_default_na=False)
+            scored = scored.sort_values("Row", kind="stable", ignore_index=True)
+        decoding = dict(profile, do_sample=args.do_sample, top_p=args.top_p, temperature=args.temperature,
+                        batch_size=args.batch_size, close_scoring=args.close_scoring if args.close_ended else None)
+        ResultsStore(args.results_store).append(
+            args.results_model or os.path.basename(os.path.normpath(args.model_name_or_path)),
+            task or "unknown", os.path.splitext(os.path.basename(args.vqa_data_test_path))[0], scored,
+            model_path=args.model_name_or_path, decoding=decoding)
+
+    if getattr(model, 'feature_cache', None) is not None:
+        print(model.feature_cache.report())
+    if getattr(model, 'prefix_cache', None) is not None:
+        print(model.prefix_cache.report())
+    return visited
+
+
+def main():
+    seed_everything(42)
+    args = parse_args()
+    print("model_name_or_path: ", args.model_name_or_path)
+    print("vqa_data_test_path: ", args.vqa_data_test_path)
+    print("output_dir: ", args.output_dir)
+    print("close_ended: ", args.close_ended)
+
+    # device = torch.device(args.device)
+
+    tokenizer, model = load_model(args)
+    metrics = load_metrics(args)
+    evaluate_subtask(args, model, tokenizer, metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import os
+import copy
+import time
+
+from Bench.dataset.rad_tasks import discover_subtasks, load_manifest
+from Bench.dataset.samplers import volume_reads
+from Bench.eval.eval_3DRAD import get_parser, seed_everything, load_model, load_metrics, evaluate_subtask
+
+
+def parse_args(args=None):
+    parser = get_parser()
+    parser.description = "Evaluate every 3D-RAD subtask in a single process, loading the model and metrics once."
+    parser.add_argument('--rad_root', type=str, default="../3DRAD/test",
+                        help="Root with Task*/ subtask CSVs, used when --manifest is not given.")
+    parser.add_argument('--manifest', type=str, default=None,
+                        help="JSON list of {task, subtask, path[, close_ended]} entries to evaluate.")
+    parser.add_argument('--tasks', type=str, nargs='+', default=None,
+                        help="Restrict evaluation to these tasks, e.g. task1 task5.")
+    parser.add_argument('--output_root', type=str, default="../results/7b",
+                        help="Results are written to {output_root}/{task}/{subtask}/.")
+    return parser.parse_args(args)
+
+
+def main():
+    seed_everything(42)
+    args = parse_args()
+
+    if args.manifest is not None:
+        subtasks = load_manifest(args.manifest, tasks=args.tasks)
+    else:
+        subtasks = discover_subtasks(args.rad_root, tasks=args.tasks)
+    if not subtasks:
+        raise ValueError(f"No subtasks found (manifest={args.manifest}, rad_root={args.rad_root}, tasks={args.tasks})")
+
+    print("model_name_or_path: ", args.model_name_or_path)
+    print("output_root: ", args.output_root)
+    print("subtasks: ", len(subtasks))
+
+    tokenizer, model = load_model(args)
+    metrics = load_metrics(args)
+
+    # The questions about a volume are spread over the subtasks, the order of the whole run tells how often
+    # volumes are read again (cache_size is what the in-memory feature cache holds).
+    visited = []
+    for i, subtask in enumerate(subtasks):
+        print(f"--------------Evaluate {subtask['task']} {subtask['subtask']} ({i + 1}/{len(subtasks)})------------")
+        subtask_args = copy.copy(args)
+        subtask_args.vqa_data_test_path = subtask['path']
+        subtask_args.output_dir = os.path.join(args.output_root, subtask['task'], subtask['subtask'])
+        subtask_args.close_ended = subtask['close_ended']
+        subtask_args.task = subtask['task']
+
+        start = time.time()
+        visited += evaluate_subtask(subtask_args, model, tokenizer, metrics)
+        print(f"Finished {subtask['task']} {subtask['subtask']} in {time.time() - start:.1f}s")
+
+    for cache_size in sorted({1, max(args.feature_cache_size, 1)}):
+        reads, volumes, per_volume = volume_reads(visited, range(len(visited)), cache_size)
+        print(f"volume reads of the run (cache of {cache_size} volumes): {reads} for {volumes} volumes "
+              f"({per_volume:.2f} per volume)")
+
+
+if __name__ == "__main__":
+    main()
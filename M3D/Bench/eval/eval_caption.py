@@ -6,7 +6,7 @@ import torch
 from torch.utils.data import DataLoader
 import argparse
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from tqdm import tqdm
+from Bench.eval.prefetch import Prefetcher, tokenize_prompts
 from Bench.dataset.multi_dataset import CapDataset
 # If the model is not from huggingface but local, please uncomment and import the model architecture.
 # from LaMed.src.model.language_model import *
@@ -45,6 +45,13 @@ def parse_args(args=None):
     parser.add_argument('--output_dir', type=str, default="./LaMed/output/LaMed-finetune-0000/eval_caption/")
 
     parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--volume_mmap', action="store_true",
+                        help="Memory-map the .npy volumes, so DataLoader workers share them through the page cache.")
+    parser.add_argument('--volume_shards', type=str, default=None,
+                        help="Directory of packed volumes (Bench/dataset/volume_shards.py), read instead of the .npy files.")
+    parser.add_argument('--volume_shard_root', type=str, default=None, help="The --root the shards were packed with.")
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Batches copied to the GPU ahead of the model on a background thread, 0 disables.")
 
     return parser.parse_args(args)
 
@@ -83,6 +90,7 @@ def main():
             shuffle=False,
             drop_last=False,
     )  
+    test_loader = Prefetcher(test_dataloader, device, args.prefetch_depth, prepare=tokenize_prompts(tokenizer))
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -91,11 +99,11 @@ def main():
     with open(output_path, mode='w') as outfile:
         writer = csv.writer(outfile)
         writer.writerow(["Question", "Ground Truth", "pred", "bleu", "rouge1", "meteor", "bert_f1"])
-        for sample in tqdm(test_dataloader):
+        for sample in test_loader:
             question = sample["question"]
             answer = sample['answer']
 
-            input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=device)
+            input_id = sample["input_id"].to(device=device)
             image = sample["image"].to(device=device)
 
             generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens, do_sample=args.do_sample, top_p=args.top_p, temperature=args.temperature)
@@ -5,6 +5,7 @@ from torch.utils.data import DataLoader
 import argparse
 from transformers import AutoTokenizer
 from tqdm import tqdm
+from Bench.eval.prefetch import Prefetcher
 from Bench.dataset.multi_dataset import ITRDataset
 from LaMed.src.model.CLIP import *
 
@@ -30,6 +31,8 @@ def parse_args(args=None):
     parser.add_argument('--cap_data_path', type=str, default="./Data/data/M3D_Cap_npy/M3D_Cap_eh.json")
     parser.add_argument('--output_dir', type=str, default="./LaMed/output/CLIP/eval_itr/")
     parser.add_argument('--save_output', type=bool, default=False)
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Batches copied to the GPU ahead of the model on a background thread, 0 disables.")
 
     return parser.parse_args(args)
 
@@ -76,7 +79,7 @@ def main():
 
     txt_feats_all = []
     img_feats_all = []
-    for sample in tqdm(test_dataloader):
+    for sample in Prefetcher(test_dataloader, device, args.prefetch_depth):
         input_id = sample["input_id"].to(device=device)
         attention_mask = sample["attention_mask"].to(device=device)
         image = sample["image"].to(device=device)
@@ -6,9 +6,10 @@ import argparse
 import torch
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from tqdm import tqdm
+from Bench.eval.prefetch import Prefetcher, tokenize_prompts
 from Bench.dataset.multi_dataset import PosRECTestDataset, PosREGTestDataset
 from Bench.utils import extract_box_from_text, calculate_iou
+from Bench.eval.scoring import load_open_metrics, score_open_csv
 # If the model is not from huggingface but local, please uncomment and import the model architecture.
 # from LaMed.src.model.language_model import *
 import matplotlib.pyplot as plt
@@ -16,10 +17,6 @@ import SimpleITK as sitk
 import evaluate
 
 accuracy = evaluate.load("accuracy")
-bleu = evaluate.load("bleu")
-bertscore = evaluate.load("bertscore")
-meteor = evaluate.load("meteor")
-rouge = evaluate.load("rouge")
 
 
 def seed_everything(seed):
@@ -51,6 +48,16 @@ def parse_args(args=None):
     parser.add_argument('--vis', type=bool, default=False)
 
     parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--volume_mmap', action="store_true",
+                        help="Memory-map the .npy volumes, so DataLoader workers share them through the page cache.")
+    parser.add_argument('--volume_shards', type=str, default=None,
+                        help="Directory of packed volumes (Bench/dataset/volume_shards.py), read instead of the .npy files.")
+    parser.add_argument('--volume_shard_root', type=str, default=None, help="The --root the shards were packed with.")
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Batches copied to the GPU ahead of the model on a background thread, 0 disables.")
+    parser.add_argument('--bert_batch_size', type=int, default=64, help="Batch size of the BERTScore pass.")
+    parser.add_argument('--bertscore_cache_dir', type=str, default=None,
+                        help="Directory of the BERTScore embedding cache, only unseen strings are encoded.")
 
     return parser.parse_args(args)
 
@@ -93,6 +100,7 @@ def main():
             shuffle=False,
             drop_last=False,
     )
+    test_loader = Prefetcher(test_dataloader, device, args.prefetch_depth, prepare=tokenize_prompts(tokenizer))
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -102,13 +110,13 @@ def main():
         with open(output_path, mode='w') as outfile:
             writer = csv.writer(outfile)
             writer.writerow(["idx", "Question Type", "Question", "Answer", "pred", "IOU"])
-            for id, sample in enumerate(tqdm(test_dataloader)):
+            for id, sample in enumerate(test_loader):
                 question = sample["question"]
                 question_type = sample["question_type"]
                 answer = sample['answer']
 
                 image = sample["image"].to(device=device)
-                input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=device)
+                input_id = sample["input_id"].to(device=device)
 
                 with torch.inference_mode():
                     generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens,
@@ -169,16 +177,17 @@ def main():
                         plt.savefig(os.path.join(path, str(i).zfill(desired_length) + 'image.png'), bbox_inches='tight', pad_inches=0)
                         plt.close()
     else:
-        output_path = os.path.join(args.output_dir, "eval_reg.csv")
-        with open(output_path, mode='w') as outfile:
+        # Generation only writes raw predictions, the metrics are computed afterwards in one pass.
+        pred_path = os.path.join(args.output_dir, "eval_reg_pred.csv")
+        with open(pred_path, mode='w') as outfile:
             writer = csv.writer(outfile)
-            writer.writerow(["idx", "Question", "Answer", "Pred", "bleu", "rouge1", "meteor", "bert_f1"])
-            for id, sample in enumerate(tqdm.tqdm(test_dataloader)):
+            writer.writerow(["idx", "Question", "Answer", "Pred"])
+            for id, sample in enumerate(test_loader):
                 question = sample["question"]
                 answer = sample['answer']
 
                 image = sample["image"].to(device=device)
-                input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=device)
+                input_id = sample["input_id"].to(device=device)
 
                 with torch.inference_mode():
                     generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens,
@@ -186,22 +195,11 @@ def main():
                                                 temperature=args.temperature)
                 generated_texts = tokenizer.batch_decode(generation, skip_special_tokens=True)
 
-                result = dict()
-                decoded_preds, decoded_labels = postprocess_text(generated_texts, answer)
-                bleu_score = bleu.compute(predictions=decoded_preds, references=decoded_labels, max_order=1)
-                result["bleu"] = bleu_score['bleu']
-
-                rouge_score = rouge.compute(predictions=decoded_preds, references=decoded_labels, rouge_types=['rouge1'])
-                result["rouge1"] = rouge_score['rouge1']
+                writer.writerow([id, question[0], answer[0], generated_texts[0]])
 
-                meteor_score = meteor.compute(predictions=decoded_preds, references=decoded_labels)
-                result["meteor"] = meteor_score['meteor']
-
-                bert_score = bertscore.compute(predictions=decoded_preds, references=decoded_labels, lang="en")
-                result["bert_f1"] = sum(bert_score['f1']) / len(bert_score['f1'])
-
-                writer.writerow(
-                    [id, question[0], answer[0], generated_texts[0], result["bleu"], result["rouge1"], result["meteor"], result["bert_f1"]])
+        output_path = os.path.join(args.output_dir, "eval_reg.csv")
+        score_open_csv(pred_path, output_path, load_open_metrics(args.bertscore_cache_dir),
+                       bert_batch_size=args.bert_batch_size)
 
 
 if __name__ == "__main__":
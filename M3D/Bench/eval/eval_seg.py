@@ -6,7 +6,7 @@ import argparse
 import torch
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from tqdm import tqdm
+from Bench.eval.prefetch import Prefetcher, tokenize_prompts
 from Bench.dataset.multi_dataset import SegDataset
 from Bench.eval.metrics import BinaryDice
 # If the model is not from huggingface but local, please uncomment and import the model architecture.
@@ -52,6 +52,13 @@ def parse_args(args=None):
 
     parser.add_argument('--seg_enable', type=bool, default=True)
     parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--volume_mmap', action="store_true",
+                        help="Memory-map the .npy volumes, so DataLoader workers share them through the page cache.")
+    parser.add_argument('--volume_shards', type=str, default=None,
+                        help="Directory of packed volumes (Bench/dataset/volume_shards.py), read instead of the .npy files.")
+    parser.add_argument('--volume_shard_root', type=str, default=None, help="The --root the shards were packed with.")
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Batches copied to the GPU ahead of the model on a background thread, 0 disables.")
 
     return parser.parse_args(args)
 
@@ -90,6 +97,7 @@ def main():
             shuffle=True,
             drop_last=False,
     )
+    test_loader = Prefetcher(test_dataloader, device, args.prefetch_depth, prepare=tokenize_prompts(tokenizer), keys=("image", "seg", "input_id"))
 
     metric_fn = BinaryDice()
 
@@ -101,7 +109,7 @@ def main():
         writer = csv.writer(outfile)
         writer.writerow(["idx", "Question Type", "Dataset Tag", "Question", "Answer", "Pred", "Dice"])
 
-        for id, sample in enumerate(tqdm(test_dataloader)):
+        for id, sample in enumerate(test_loader):
             tag = sample["tag"]
             question = sample["question"]
             question_type = sample["question_type"]
@@ -109,7 +117,7 @@ def main():
             image = sample["image"].to(device=device)
             seg = sample["seg"].to(device=device)
 
-            input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=device)
+            input_id = sample["input_id"].to(device=device)
 
             with torch.inference_mode():
                 generation, logits = model.generate(image, input_id, seg_enable=args.seg_enable, max_new_tokens=args.max_new_tokens, do_sample=args.do_sample, top_p=args.top_p, temperature=args.temperature)
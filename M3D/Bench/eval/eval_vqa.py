@@ -6,17 +6,12 @@ import torch
 from torch.utils.data import DataLoader
 import argparse
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from tqdm import tqdm
+from Bench.eval.prefetch import Prefetcher, tokenize_prompts
 from Bench.dataset.multi_dataset import VQADataset
 from Bench.eval.metrics import compute_exact_match, qa_f1_score
+from Bench.eval.scoring import load_open_metrics, score_open_csv
 # If the model is not from huggingface but local, please uncomment and import the model architecture.
 # from LaMed.src.model.language_model import *
-import evaluate
-
-bleu = evaluate.load("bleu")
-bertscore = evaluate.load("bertscore")
-meteor = evaluate.load("meteor")
-rouge = evaluate.load("rouge")
 
 
 def seed_everything(seed):
@@ -47,6 +42,16 @@ def parse_args(args=None):
     parser.add_argument('--output_dir', type=str, default="./LaMed/output/LaMed-Phi3-4B-finetune-0000/eval_vqa/")
 
     parser.add_argument('--proj_out_num', type=int, default=256)
+    parser.add_argument('--volume_mmap', action="store_true",
+                        help="Memory-map the .npy volumes, so DataLoader workers share them through the page cache.")
+    parser.add_argument('--volume_shards', type=str, default=None,
+                        help="Directory of packed volumes (Bench/dataset/volume_shards.py), read instead of the .npy files.")
+    parser.add_argument('--volume_shard_root', type=str, default=None, help="The --root the shards were packed with.")
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Batches copied to the GPU ahead of the model on a background thread, 0 disables.")
+    parser.add_argument('--bert_batch_size', type=int, default=64, help="Batch size of the BERTScore pass.")
+    parser.add_argument('--bertscore_cache_dir', type=str, default=None,
+                        help="Directory of the BERTScore embedding cache, only unseen strings are encoded.")
 
     return parser.parse_args(args)
 
@@ -86,6 +91,7 @@ def main():
             shuffle=False,
             drop_last=False,
     )  
+    test_loader = Prefetcher(test_dataloader, device, args.prefetch_depth, prepare=tokenize_prompts(tokenizer))
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -95,7 +101,7 @@ def main():
         with open(output_path, mode='w') as outfile:
             writer = csv.writer(outfile)
             writer.writerow(["Question Type", "Question", "Answer", "Answer Choice", "Pred", "Correct"])
-            for sample in tqdm(test_dataloader):
+            for sample in test_loader:
                 question = sample["question"]
                 question_type = sample["question_type"].item()
                 answer_choice = sample["answer_choice"]
@@ -103,7 +109,7 @@ def main():
 
                 image = sample["image"].to(device=device)
 
-                input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=device)
+                input_id = sample["input_id"].to(device=device)
 
                 with torch.inference_mode():
                     generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens,
@@ -118,17 +124,18 @@ def main():
 
                 writer.writerow([question_type, question[0], answer[0], answer_choice[0], generated_texts[0], correct])
     else:
-        output_path = os.path.join(args.output_dir, "eval_open_vqa.csv")
-        with open(output_path, mode='w') as outfile:
+        # Generation only writes raw predictions, the metrics are computed afterwards in one pass.
+        pred_path = os.path.join(args.output_dir, "eval_open_pred.csv")
+        with open(pred_path, mode='w') as outfile:
             writer = csv.writer(outfile)
-            writer.writerow(["Question Type", "Question", "Answer", "Pred", "bleu", "rouge1", "meteor", "bert_f1"])
-            for sample in tqdm(test_dataloader):
+            writer.writerow(["Question Type", "Question", "Answer", "Pred"])
+            for sample in test_loader:
                 question = sample["question"]
                 question_type = sample["question_type"].item()
                 answer = sample['answer']
 
                 image = sample["image"].to(device=device)
-                input_id = tokenizer(question, return_tensors="pt")['input_ids'].to(device=device)
+                input_id = sample["input_id"].to(device=device)
 
                 with torch.inference_mode():
                     generation = model.generate(image, input_id, max_new_tokens=args.max_new_tokens,
@@ -136,22 +143,11 @@ def main():
                                                 temperature=args.temperature)
                 generated_texts = tokenizer.batch_decode(generation, skip_special_tokens=True)
 
-                result = dict()
-                decoded_preds, decoded_labels = postprocess_text(generated_texts, answer)
-                bleu_score = bleu.compute(predictions=decoded_preds, references=decoded_labels, max_order=1)
-                result["bleu"] = bleu_score['bleu']
-
-                rouge_score = rouge.compute(predictions=decoded_preds, references=decoded_labels, rouge_types=['rouge1'])
-                result["rouge1"] = rouge_score['rouge1']
+                writer.writerow([question_type, question[0], answer[0], generated_texts[0]])
 
-                meteor_score = meteor.compute(predictions=decoded_preds, references=decoded_labels)
-                result["meteor"] = meteor_score['meteor']
-
-                bert_score = bertscore.compute(predictions=decoded_preds, references=decoded_labels, lang="en")
-                result["bert_f1"] = sum(bert_score['f1']) / len(bert_score['f1'])
-
-                writer.writerow(
-                    [question_type, question[0], answer[0], generated_texts[0], result["bleu"], result["rouge1"], result["meteor"], result["bert_f1"]])
+        output_path = os.path.join(args.output_dir, "eval_open_vqa.csv")
+        score_open_csv(pred_path, output_path, load_open_metrics(args.bertscore_cache_dir),
+                       bert_batch_size=args.bert_batch_size)
 
 if __name__ == "__main__":
     main()
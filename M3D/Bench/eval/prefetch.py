@@ -0,0 +1,155 @@
+import time
+import queue
+import threading
+
+import torch
+from tqdm import tqdm
+
+
+class Prefetcher:
+    """
+    Iterates a DataLoader on a background thread and stages the next `depth` batches on the device, so the model
+    does not wait for a batch to be tokenized and copied once it is done with the previous one.
+
+    For every batch the thread runs prepare(sample) (e.g. tokenization, adding an "input_id" tensor), pins the
+    tensors of `keys` (the DataLoader pins its own with pin_memory=True) and copies them to the device on a side CUDA
+    stream, without blocking. The loop gets the sample with those keys already on the device, the other values are
+    left as they are. The loop stream waits for the copy of a batch only when it gets the batch.
+
+    Stall counters: `stall` is the time the loop waited for a batch that was not staged yet (I/O bound when it
+    grows), `ahead` the time the thread waited for a free slot (the model is the bottleneck). With progress=True they
+    are shown in the tqdm bar. depth=0 stages every batch in the loop, like a plain DataLoader loop.
+    """
+    def __init__(self, dataloader, device, depth=2, prepare=None, keys=("image", "input_id", "attention_mask"),
+                 progress=True, desc=None):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.prepare = prepare
+        self.keys = keys
+        self.progress = progress
+        self.desc = desc
+        self.stall_seconds = 0.0
+        self.ahead_seconds = 0.0
+        self.stalls = 0
+        self.batches = 0
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _stage(self, sample):
+        if self.prepare is not None:
+            sample = self.prepare(sample)
+        event = None
+        if self.stream is None:
+            for key in self.keys:
+                if key in sample:
+                    sample[key] = sample[key].to(self.device)
+            return sample, event
+        with torch.cuda.stream(self.stream):
+            for key in self.keys:
+                if key in sample:
+                    tensor = sample[key]
+                    if not tensor.is_pinned():
+                        tensor = tensor.pin_memory()
+                    sample[key] = tensor.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return sample, event
+
+    def _put(self, slots, item, stop):
+        # Gives up when the loop is gone, so the thread never blocks on a full queue.
+        while not stop.is_set():
+            try:
+                slots.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, slots, stop):
+        try:
+            for sample in self.dataloader:
+                staged = self._stage(sample)
+                start = time.perf_counter()
+                if not self._put(slots, staged, stop):
+                    return
+                self.ahead_seconds += time.perf_counter() - start
+            self._put(slots, None, stop)
+        except BaseException as e:
+            self._put(slots, e, stop)
+
+    def _inline_batches(self):
+        iterator = iter(self.dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                staged = self._stage(next(iterator))
+            except StopIteration:
+                return
+            self._count(time.perf_counter() - start)
+            yield staged
+
+    def _batches(self):
+        if self.depth == 0:
+            yield from self._inline_batches()
+            return
+
+        slots = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(slots, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                staged = slots.get()
+                if staged is None:
+                    return
+                if isinstance(staged, BaseException):
+                    raise staged
+                self._count(time.perf_counter() - start)
+                yield staged
+        finally:
+            stop.set()
+            thread.join()
+
+    def _count(self, seconds):
+        self.batches += 1
+        self.stall_seconds += seconds
+        # Waits under a millisecond are the queue hand-off, not a stall.
+        self.stalls += seconds > 1e-3
+
+    def postfix(self):
+        return {'stall': f"{self.stall_seconds:.1f}s", 'stalls': self.stalls, 'ahead': f"{self.ahead_seconds:.1f}s"}
+
+    def report(self):
+        return (f"prefetch: {self.batches} batches, waited {self.stall_seconds:.1f}s for data ({self.stalls} stalls), "
+                f"staged batches waited {self.ahead_seconds:.1f}s for the model")
+
+    def __iter__(self):
+        bar = tqdm(total=len(self), desc=self.desc) if self.progress else None
+        try:
+            for sample, event in self._batches():
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for key in self.keys:
+                        if key in sample:
+                            # The copies were allocated on the side stream, keep them until the loop stream is done.
+                            sample[key].record_stream(current)
+                yield sample
+                if bar is not None:
+                    bar.update(1)
+                    bar.set_postfix(self.postfix(), refresh=False)
+        finally:
+            if bar is not None:
+                bar.close()
+
+
+def tokenize_prompts(tokenizer):
+    """prepare function for Prefetcher that tokenizes the question of a batch of one into "input_id"."""
+    def prepare(sample):
+        sample["input_id"] = tokenizer(sample["question"], return_tensors="pt")['input_ids']
+        return sample
+    return prepare
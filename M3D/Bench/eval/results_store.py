@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import subprocess
+
+import pandas as pd
+
+from Bench.eval.text_metrics import corpus_bleu1
+
+
+# CSV headers written by the eval scripts -> store columns.
+COLUMN_NAMES = {
+    "Row": "row",
+    "Question Hash": "question_hash",
+    "Question Aspect": "question_aspect",
+    "Question": "question",
+    "Answer": "answer",
+    "Answer Choice": "answer_choice",
+    "Pred": "pred",
+    "Correct": "correct",
+    "Confidence": "confidence",
+}
+
+TEXT_COLUMNS = ["question_hash", "question_aspect", "question", "answer", "answer_choice", "pred"]
+
+RUN_COLUMNS = ["run_id", "model", "task", "subtask", "created", "model_path", "git_hash", "decoding", "num_rows"]
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+    except ImportError as e:
+        raise ImportError("The results store needs pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+
+def _runs_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("run_id", pa.string()), ("model", pa.string()), ("task", pa.string()), ("subtask", pa.string()),
+        ("created", pa.float64()), ("model_path", pa.string()), ("git_hash", pa.string()),
+        ("decoding", pa.string()), ("num_rows", pa.int64()),
+    ])
+
+
+def git_hash(path=None):
+    # Commit of the code that produced a run, None outside of a git checkout.
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path or os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ResultsStore:
+    """
+    Parquet store of 3D-RAD predictions and per-row metrics for any number of models.
+
+    Layout under root:
+        rows/model=<model>/task=<task>/subtask=<subtask>/<run_id>.parquet   predictions + per-row metrics
+        runs/<run_id>.parquet                                                one row of run metadata
+
+    Every append is a new run. Queries only use the latest run of each (model, task, subtask), so re-evaluating a
+    subtask replaces its results without rewriting anything. Files are written to a temporary name and renamed.
+    """
+    def __init__(self, root):
+        _require_pyarrow()
+        self.root = root
+        self.rows_dir = os.path.join(root, "rows")
+        self.runs_dir = os.path.join(root, "runs")
+        os.makedirs(self.rows_dir, exist_ok=True)
+        os.makedirs(self.runs_dir, exist_ok=True)
+
+    @staticmethod
+    def _write(table, path):
+        import pyarrow.parquet as pq
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def append(self, model, task, subtask, df, model_path=None, decoding=None, git_commit=None):
+        """
+        Store the rows of one evaluated subtask (a DataFrame with the eval CSV headers or store column names).
+        Returns the run id.
+        """
+        import pyarrow as pa
+
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        rows = df.rename(columns=COLUMN_NAMES).copy()
+        for column in TEXT_COLUMNS:
+            if column in rows.columns:
+                rows[column] = rows[column].fillna("").astype(str)
+        rows["run_id"] = run_id
+        # Partition columns live in the directory names only.
+        rows = rows.drop(columns=[c for c in ("model", "task", "subtask") if c in rows.columns])
+
+        self._write(pa.Table.from_pandas(rows, preserve_index=False), self._rows_path(model, task, subtask, run_id))
+
+        run = {
+            "run_id": run_id,
+            "model": model,
+            "task": task,
+            "subtask": subtask,
+            "created": time.time(),
+            "model_path": model_path,
+            "git_hash": git_commit if git_commit is not None else git_hash(),
+            "decoding": json.dumps(decoding or {}, sort_keys=True),
+            "num_rows": len(rows),
+        }
+        self._write(pa.Table.from_pylist([run], schema=_runs_schema()), os.path.join(self.runs_dir, f"{run_id}.parquet"))
+        return run_id
+
+    def runs(self, latest=True):
+        import pyarrow.dataset as ds
+
+        if not os.listdir(self.runs_dir):
+            return pd.DataFrame(columns=RUN_COLUMNS)
+        runs = ds.dataset(self.runs_dir, format="parquet", schema=_runs_schema()).to_table().to_pandas()
+        if latest:
+            runs = runs.sort_values("created").groupby(["model", "task", "subtask"]).tail(1)
+        return runs.reset_index(drop=True)
+
+    def _rows_path(self, model, task, subtask, run_id):
+        return os.path.join(self.rows_dir, f"model={model}", f"task={task}", f"subtask={subtask}", f"{run_id}.parquet")
+
+    def load(self, models=None, tasks=None, columns=None):
+        """Rows of the latest run of every (model, task, subtask), optionally filtered by model and task."""
+        import pyarrow.parquet as pq
+
+        runs = self.runs(latest=True)
+        if models is not None:
+            runs = runs[runs["model"].isin(models)]
+        if tasks is not None:
+            runs = runs[runs["task"].isin(tasks)]
+        if runs.empty:
+            return pd.DataFrame()
+
+        # Open and close-ended subtasks have different columns, so the files are read one by one
+        # (only the requested columns) instead of through a single dataset schema.
+        frames = []
+        for run in runs.itertuples():
+            path = self._rows_path(run.model, run.task, run.subtask, run.run_id)
+            available = pq.read_schema(path).names
+            frame = pq.read_table(path, columns=[c for c in columns if c in available] if columns else None).to_pandas()
+            frame.insert(0, "subtask", run.subtask)
+            frame.insert(0, "task", run.task)
+            frame.insert(0, "model", run.model)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    def subtask_metrics(self, models=None, tasks=None):
+        """Per-subtask metrics, computed like evaluate_result.py: corpus BLEU-1, mean ROUGE-1/BERTScore F1, accuracy."""
+        rows = self.load(models, tasks)
+        if rows.empty:
+            return pd.DataFrame()
+        records = []
+        for (model, task, subtask), group in rows.groupby(["model", "task", "subtask"], observed=True):
+            record = {"model": model, "task": task, "subtask": subtask, "num_rows": len(group)}
+            if "correct" in group and group["correct"].notna().any():
+                record["accuracy"] = float(group["correct"].astype(float).mean())
+            if "bert_f1" in group and group["bert_f1"].notna().any():
+                preds = group["pred"].astype(str).str.strip().tolist()
+                answers = group["answer"].astype(str).str.strip().tolist()
+                record["bleu"] = corpus_bleu1(preds, answers)
+                record["rouge1"] = float(group["rouge1"].mean())
+                record["f1"] = float(group["bert_f1"].mean())
+            records.append(record)
+        return pd.DataFrame(records)
+
+    def leaderboard(self, models=None, tasks=None, metrics=("accuracy", "bleu", "rouge1", "f1")):
+        """Models x (task, metric) table, each task score being the mean over its subtasks."""
+        subtasks = self.subtask_metrics(models, tasks)
+        if subtasks.empty:
+            return subtasks
+        metrics = [m for m in metrics if m in subtasks.columns]
+        per_task = subtasks.groupby(["model", "task"])[metrics].mean()
+        return per_task.unstack("task").swaplevel(axis=1).sort_index(axis=1).dropna(axis=1, how="all")
+
+    def aspect_breakdown(self, models=None, tasks=None):
+        """Mean per-row metrics of every (model, task, question aspect)."""
+        rows = self.load(models, tasks)
+        if rows.empty:
+            return rows
+        metrics = [m for m in ("correct", "bleu", "rouge1", "meteor", "bert_f1") if m in rows.columns]
+        rows[metrics] = rows[metrics].apply(pd.to_numeric, errors="coerce")
+        breakdown = rows.groupby(["model", "task", "question_aspect"], observed=True)[metrics].agg("mean")
+        breakdown["num_rows"] = rows.groupby(["model", "task", "question_aspect"], observed=True).size()
+        return breakdown.rename(columns={"correct": "accuracy"}).dropna(axis=1, how="all")
+
+
+def import_results_dir(store, results_dir, model, model_path=None):
+    """Load an existing results/{model}/{task}/{subtask}/eval_*_vqa.csv tree into the store."""
+    imported = 0
+    for task in sorted(os.listdir(results_dir)):
+        task_dir = os.path.join(results_dir, task)
+        if not os.path.isdir(task_dir):
+            continue
+        for subtask in sorted(os.listdir(task_dir)):
+            for name in ("eval_open_vqa.csv", "eval_close_vqa.csv"):
+                path = os.path.join(task_dir, subtask, name)
+                if os.path.exists(path):
+                    store.append(model, task, subtask, pd.read_csv(path), model_path=model_path)
+                    imported += 1
+    return imported
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Query or fill the 3D-RAD results store.")
+    parser.add_argument('--store', type=str, required=True)
+    parser.add_argument('--models', type=str, nargs='+', default=None)
+    parser.add_argument('--tasks', type=str, nargs='+', default=None)
+    parser.add_argument('--aspects', action="store_true", help="Print the per-aspect breakdown.")
+    parser.add_argument('--import_dir', type=str, default=None,
+                        help="Import a results/{model} directory of eval CSVs as --models[0] first.")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = ResultsStore(args.store)
+    if args.import_dir is not None:
+        print(f"imported {import_results_dir(store, args.import_dir, args.models[0])} subtasks")
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(store.leaderboard(args.models, args.tasks).round(4))
+        if args.aspects:
+            print(store.aspect_breakdown(args.models, args.tasks).round(4))
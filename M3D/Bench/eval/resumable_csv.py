@@ -0,0 +1,120 @@
+import os
+import csv
+import hashlib
+
+
+ROW_COLUMNS = ["Row", "Question Hash"]
+
+
+def question_hash(question):
+    return hashlib.sha1(str(question).encode("utf-8")).hexdigest()[:16]
+
+
+def _read_complete_records(path, num_columns):
+    """
+    Parse an existing output CSV and return (records, end_offset), where end_offset is the byte offset right after
+    the last complete record. A record cut by a crash (no trailing newline, unterminated quote or missing columns)
+    ends the scan.
+    """
+    records = []
+    end_offset = 0
+    consumed = [0]
+    last_line = [""]
+
+    def lines(f):
+        for line in f:
+            consumed[0] += len(line.encode("utf-8"))
+            last_line[0] = line
+            yield line
+
+    with open(path, mode='r', encoding="utf-8", newline='') as f:
+        reader = csv.reader(lines(f), strict=True)
+        while True:
+            try:
+                record = next(reader)
+            except (StopIteration, csv.Error):
+                break
+            if len(record) != num_columns or not last_line[0].endswith("\n"):
+                break
+            records.append(record)
+            end_offset = consumed[0]
+    return records, end_offset
+
+
+def _current_records(records, question_hashes):
+    # The first record of every row whose question hash is still the one of the dataset.
+    kept, seen = [], set()
+    for record in records:
+        row = int(record[0])
+        if 0 <= row < len(question_hashes) and record[1] == question_hashes[row] and row not in seen:
+            kept.append(record)
+            seen.add(row)
+    return kept
+
+
+def _rewrite(path, records):
+    # Through a temporary file, so a crash leaves either the old or the new file.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode='w', encoding="utf-8", newline='') as f:
+        csv.writer(f).writerows(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ResumableCSVWriter:
+    """
+    Append-only CSV writer for long evaluation runs that can resume after a crash or preemption.
+
+    Every row starts with ROW_COLUMNS: the dataset row index and a hash of its question. Rows are written in the order
+    they are produced, readers that need dataset order sort by Row. When the output file already exists and resume
+    is True, a partially written last record is truncated and the rows already written are collected, so the caller
+    can skip them with is_done(). With question_hashes (the hash of every dataset row), records whose question changed
+    and repeated records of a row are dropped from the file, so the row is re-run and the file keeps one record per
+    Row. flush() fsyncs the file, call it once per batch.
+    """
+    def __init__(self, path, header, resume=True, question_hashes=None):
+        self.path = path
+        self.header = ROW_COLUMNS + list(header)
+        self.done = set()
+
+        records = []
+        if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            records, end_offset = _read_complete_records(path, len(self.header))
+            if records and records[0] != self.header:
+                raise ValueError(f"{path} has header {records[0]}, expected {self.header}. "
+                                 f"Remove it or run without resume.")
+            os.truncate(path, end_offset)
+            if question_hashes is not None:
+                kept = _current_records(records[1:], question_hashes)
+                if len(kept) < len(records) - 1:
+                    _rewrite(path, [records[0]] + kept)
+                records = [records[0]] + kept
+            for record in records[1:]:
+                self.done.add((int(record[0]), record[1]))
+
+        self.file = open(path, mode='a' if records else 'w', encoding="utf-8", newline='')
+        self.writer = csv.writer(self.file)
+        if not records:
+            self.writer.writerow(self.header)
+            self.flush()
+
+    def is_done(self, row, question_digest):
+        return (row, question_digest) in self.done
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,112 @@
+import os
+import argparse
+import pandas as pd
+import evaluate
+
+from Bench.eval.text_metrics import bleu1_scores, rouge1_scores
+from Bench.eval.bertscore_cache import BERTScoreCache
+
+
+OPEN_METRIC_COLUMNS = ["bleu", "rouge1", "meteor", "bert_f1"]
+
+
+def load_open_metrics(bertscore_cache_dir=None):
+    # BLEU-1 and ROUGE-1 are computed by text_metrics and METEOR by nltk (meteor_scores), only BERTScore comes from
+    # evaluate. With bertscore_cache_dir, BERTScore reuses the embeddings of strings scored before (BERTScoreCache).
+    return {
+        "bertscore": BERTScoreCache(bertscore_cache_dir) if bertscore_cache_dir is not None else evaluate.load("bertscore"),
+        "meteor": _require_meteor(),
+    }
+
+
+def _require_meteor():
+    # The nltk data evaluate's meteor downloads when it is loaded, only fetched when it is not installed yet.
+    try:
+        import nltk
+        from nltk.translate import meteor_score
+    except ImportError as e:
+        raise ImportError("METEOR needs nltk: pip install nltk") from e
+    nltk_version = tuple(int(part) for part in nltk.__version__.split(".")[:3] if part.isdigit())
+    punkt = "punkt_tab" if nltk_version >= (3, 9) else "punkt"
+    for resource, package in [("corpora/wordnet", "wordnet"), ("tokenizers/" + punkt, punkt), ("corpora/omw-1.4", "omw-1.4")]:
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            nltk.download(package, quiet=True)
+    return meteor_score, nltk.word_tokenize
+
+
+def meteor_scores(preds, references, meteor=None, alpha=0.9, beta=3, gamma=0.5):
+    """
+    Per-row METEOR of single-reference predictions (references are one-element lists), the same values as
+    evaluate's meteor called on one row at a time: nltk's METEOR on word_tokenize'd strings, with its defaults.
+    meteor is the "meteor" entry of load_open_metrics, loaded here when not given.
+    """
+    meteor_score, word_tokenize = meteor if meteor is not None else _require_meteor()
+    return [meteor_score.single_meteor_score(word_tokenize(r[0]), word_tokenize(p), alpha=alpha, beta=beta, gamma=gamma)
+            for p, r in zip(preds, references)]
+
+
+def score_open_predictions(preds, answers, metrics, bert_batch_size=64):
+    """
+    Per-row BLEU-1, ROUGE-1, METEOR and BERTScore F1 of single-reference predictions.
+
+    Gives the same values as calling each metric on one row at a time. BLEU-1 and ROUGE-1 come from text_metrics,
+    METEOR from nltk in one loop, BERTScore is computed in one call over all rows (in batches of bert_batch_size).
+    """
+    preds = [str(p).strip() for p in preds]
+    references = [[str(a).strip()] for a in answers]
+    if not preds:
+        return {column: [] for column in OPEN_METRIC_COLUMNS}
+
+    bleu = bleu1_scores(preds, references).tolist()
+    rouge1 = rouge1_scores(preds, references).tolist()
+
+    meteor = meteor_scores(preds, references, metrics.get("meteor"))
+    bert_f1 = metrics["bertscore"].compute(predictions=preds, references=references, lang="en",
+                                           batch_size=bert_batch_size)['f1']
+    if hasattr(metrics["bertscore"], "report"):
+        print(metrics["bertscore"].report())
+
+    return {"bleu": bleu, "rouge1": rouge1, "meteor": meteor, "bert_f1": list(bert_f1)}
+
+
+def score_open_csv(pred_path, output_path, metrics, bert_batch_size=64, drop_empty=False):
+    """
+    Read raw predictions written by an eval script (must have "Answer" and "Pred" columns), add the per-row
+    bleu/rouge1/meteor/bert_f1 columns and write the result to output_path.
+
+    drop_empty removes rows with an empty prediction, as the 3D-RAD eval always did.
+    """
+    df = pd.read_csv(pred_path, dtype=str, keep_default_na=False)
+    if "Row" in df.columns:
+        # Resumable eval scripts write rows as they finish, put them back in dataset order.
+        df = df.iloc[df["Row"].astype(int).argsort(kind="stable")].reset_index(drop=True)
+    if drop_empty:
+        df = df[df["Pred"].str.strip() != ""]
+
+    scores = score_open_predictions(df["Pred"].tolist(), df["Answer"].tolist(), metrics, bert_batch_size)
+    for column in OPEN_METRIC_COLUMNS:
+        df[column] = scores[column]
+
+    # Write to a temporary file first so a crash never leaves a half written result.
+    tmp_path = output_path + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    return df
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Score a raw open-ended prediction CSV.")
+    parser.add_argument('--pred_path', type=str, required=True)
+    parser.add_argument('--output_path', type=str, required=True)
+    parser.add_argument('--bert_batch_size', type=int, default=64)
+    parser.add_argument('--drop_empty', action="store_true")
+    parser.add_argument('--bertscore_cache_dir', type=str, default=None)
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    score_open_csv(args.pred_path, args.output_path, load_open_metrics(args.bertscore_cache_dir), args.bert_batch_size,
+                   args.drop_empty)
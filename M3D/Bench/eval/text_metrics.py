@@ -0,0 +1,153 @@
+"""
+Offline BLEU-1, ROUGE-1 and exact match for short single-reference answers.
+
+Scores match the HuggingFace `evaluate` metrics they replace:
+    - BLEU-1: evaluate "bleu" with max_order=1 (13a tokenization, brevity penalty, no smoothing).
+    - ROUGE-1 F: evaluate "rouge" / rouge_score without stemming. The corpus value is the exact mean of the
+      per-row scores, evaluate's default aggregator is a bootstrap estimate of that mean.
+    - Exact match: normalize_answer(pred) == normalize_answer(ref).
+
+Tokens of all rows are mapped to one shared vocabulary and clipped unigram matches are counted with NumPy,
+so only tokenization runs per row (and is cached for repeated strings). Only NumPy is needed.
+"""
+import re
+import string
+from functools import lru_cache
+
+import numpy as np
+
+
+# sacrebleu's 13a tokenizer, as vendored by evaluate's bleu.
+_13A_RULES = [
+    (re.compile(r'([\{-\~\[-\` -\&\(-\+\:-\@\/])'), r' \1 '),
+    (re.compile(r'([^0-9])([\.,])'), r'\1 \2 '),
+    (re.compile(r'([\.,])([^0-9])'), r' \1 \2'),
+    (re.compile(r'([0-9])(-)'), r'\1 \2 '),
+]
+
+# rouge_score's default tokenizer.
+_NON_ALPHANUM_RE = re.compile(r'[^a-z0-9]+')
+_SPACES_RE = re.compile(r'\s+')
+_VALID_TOKEN_RE = re.compile(r'^[a-z0-9]+$')
+
+_PUNCTUATION = set(string.punctuation)
+
+
+@lru_cache(maxsize=2 ** 16)
+def tokenize_13a(line):
+    line = line.replace("<skipped>", "")
+    line = line.replace("-\n", "")
+    line = line.replace("\n", " ")
+    if "&" in line:
+        line = line.replace("&quot;", '"')
+        line = line.replace("&amp;", "&")
+        line = line.replace("&lt;", "<")
+        line = line.replace("&gt;", ">")
+    line = f" {line} "
+    for pattern, repl in _13A_RULES:
+        line = pattern.sub(repl, line)
+    return tuple(line.split())
+
+
+@lru_cache(maxsize=2 ** 16)
+def tokenize_rouge(text):
+    text = _NON_ALPHANUM_RE.sub(" ", text.lower())
+    return tuple(token for token in _SPACES_RE.split(text) if _VALID_TOKEN_RE.match(token))
+
+
+def normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace (same as metrics.normalize_answer)."""
+    s = s.lower()
+    s = "".join(ch for ch in s if ch not in _PUNCTUATION)
+    s = re.sub(r"\b(a|an|the)\b", " ", s)
+    return " ".join(s.split())
+
+
+def _single_references(references):
+    # Accept ["ref", ...] as well as evaluate's [["ref"], ...] with exactly one reference per row.
+    refs = []
+    for ref in references:
+        if isinstance(ref, (list, tuple)):
+            if len(ref) != 1:
+                raise ValueError("Only a single reference per prediction is supported.")
+            ref = ref[0]
+        refs.append(str(ref))
+    return refs
+
+
+def unigram_overlap(pred_tokens, ref_tokens):
+    """
+    Clipped unigram matches between each pair of token sequences.
+
+    Returns (matches, pred_lengths, ref_lengths) as int64 arrays with one entry per row.
+    """
+    num_rows = len(pred_tokens)
+    vocab = {}
+    pred_ids = np.fromiter((vocab.setdefault(t, len(vocab)) for tokens in pred_tokens for t in tokens), dtype=np.int64)
+    ref_ids = np.fromiter((vocab.setdefault(t, len(vocab)) for tokens in ref_tokens for t in tokens), dtype=np.int64)
+    pred_lengths = np.fromiter((len(tokens) for tokens in pred_tokens), dtype=np.int64, count=num_rows)
+    ref_lengths = np.fromiter((len(tokens) for tokens in ref_tokens), dtype=np.int64, count=num_rows)
+
+    # One key per (row, token), counted separately for predictions and references.
+    vocab_size = max(len(vocab), 1)
+    pred_keys, pred_counts = np.unique(np.repeat(np.arange(num_rows), pred_lengths) * vocab_size + pred_ids,
+                                       return_counts=True)
+    ref_keys, ref_counts = np.unique(np.repeat(np.arange(num_rows), ref_lengths) * vocab_size + ref_ids,
+                                     return_counts=True)
+
+    common, pred_index, ref_index = np.intersect1d(pred_keys, ref_keys, assume_unique=True, return_indices=True)
+    clipped = np.minimum(pred_counts[pred_index], ref_counts[ref_index])
+    matches = np.bincount(common // vocab_size, weights=clipped, minlength=num_rows).astype(np.int64)
+    return matches, pred_lengths, ref_lengths
+
+
+def _brevity_penalty(pred_length, ref_length):
+    # Empty predictions (or references) score 0 instead of raising like evaluate does.
+    pred_length = np.asarray(pred_length, dtype=np.float64)
+    ref_length = np.asarray(ref_length, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = pred_length / ref_length
+        bp = np.where(ratio > 1.0, 1.0, np.exp(1.0 - 1.0 / ratio))
+    return np.where((pred_length > 0) & (ref_length > 0), bp, 0.0)
+
+
+def bleu1_scores(predictions, references):
+    """Per-row BLEU-1, the same as evaluate's bleu with max_order=1 on each row alone."""
+    refs = _single_references(references)
+    matches, pred_lengths, ref_lengths = unigram_overlap(
+        [tokenize_13a(str(p)) for p in predictions], [tokenize_13a(r) for r in refs])
+    precision = np.divide(matches, pred_lengths, out=np.zeros(len(matches)), where=pred_lengths > 0)
+    return precision * _brevity_penalty(pred_lengths, ref_lengths)
+
+
+def corpus_bleu1(predictions, references):
+    """Corpus BLEU-1 over all rows, the same as evaluate's bleu with max_order=1."""
+    refs = _single_references(references)
+    matches, pred_lengths, ref_lengths = unigram_overlap(
+        [tokenize_13a(str(p)) for p in predictions], [tokenize_13a(r) for r in refs])
+    total = pred_lengths.sum()
+    precision = matches.sum() / total if total > 0 else 0.0
+    return float(precision * _brevity_penalty(total, ref_lengths.sum()))
+
+
+def rouge1_scores(predictions, references):
+    """Per-row ROUGE-1 F measure, the same as evaluate's rouge with use_aggregator=False."""
+    refs = _single_references(references)
+    matches, pred_lengths, ref_lengths = unigram_overlap(
+        [tokenize_rouge(str(p)) for p in predictions], [tokenize_rouge(r) for r in refs])
+    precision = matches / np.maximum(pred_lengths, 1)
+    recall = matches / np.maximum(ref_lengths, 1)
+    denominator = precision + recall
+    return np.divide(2 * precision * recall, denominator, out=np.zeros(len(matches)), where=denominator > 0)
+
+
+def corpus_rouge1(predictions, references):
+    scores = rouge1_scores(predictions, references)
+    return float(scores.mean()) if len(scores) else 0.0
+
+
+def exact_match_scores(predictions, references):
+    """Per-row 1.0/0.0 exact match of the normalized answers."""
+    refs = _single_references(references)
+    return np.fromiter((normalize_answer(str(p)) == normalize_answer(r) for p, r in zip(predictions, refs)),
+                       dtype=np.float64, count=len(refs))
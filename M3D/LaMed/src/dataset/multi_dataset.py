@@ -15,12 +15,15 @@ from ..utils.utils import mask2box
 from .dataset_info import dataset_info
 from .prompt_templates import Caption_templates, PosREC_templates, PosREG_templates, Seg_templates
 from .term_dictionary import term_dict
+from .tokenization import ImagePromptTokenizer
+from .volume_provider import VolumeProvider
 
 
 
 class ITRDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
@@ -96,7 +99,7 @@ class ITRDataset(Dataset):
                 image_path = data["image"]
                 image_abs_path = os.path.join(self.data_root, image_path)
 
-                image = np.load(image_abs_path)  # nomalized 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized 0-1, C,D,H,W
                 # image = np.load(img_abs_path)[np.newaxis, ...]  # nomalized
                 image = self.transform(image)
 
@@ -132,11 +135,13 @@ class ITRDataset(Dataset):
 class CapDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         with open(args.cap_data_path, 'r') as file:
             self.json_file = json.load(file)
@@ -174,6 +179,9 @@ class CapDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [os.path.join(self.data_root, data["image"]) for data in self.data_list]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -182,7 +190,7 @@ class CapDataset(Dataset):
                 image_path = data["image"]
                 image_abs_path = os.path.join(self.data_root, image_path)
 
-                image = np.load(image_abs_path)  # nomalized 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized 0-1, C,D,H,W
                 # image = np.load(img_abs_path)[np.newaxis, ...]  # nomalized
                 image = self.transform(image)
 
@@ -196,9 +204,7 @@ class CapDataset(Dataset):
 
                 question = self.image_tokens + prompt_question
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -207,11 +213,7 @@ class CapDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -244,12 +246,14 @@ class CapDataset(Dataset):
 class VQADataset(Dataset):
     def __init__(self, args, tokenizer, close_ended=True, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
         self.close_ended = close_ended
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         if mode == "train":
             self.data_list = pd.read_csv(args.vqa_data_train_path)
@@ -290,6 +294,9 @@ class VQADataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [os.path.join(self.args.data_root, path) for path in self.data_list["Image Path"]]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -297,7 +304,7 @@ class VQADataset(Dataset):
                 data = self.data_list.iloc[idx]
                 image_abs_path = os.path.join(self.args.data_root, data["Image Path"])
 
-                image = np.load(image_abs_path)  # nomalized, 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized, 0-1, C,D,H,W
                 # image = np.load(img_path)[np.newaxis, ...]  # nomalized
 
                 image = self.transform(image)
@@ -313,9 +320,7 @@ class VQADataset(Dataset):
 
 
                 question = self.image_tokens + ' ' + question
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt",
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -324,10 +329,7 @@ class VQADataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -362,11 +364,13 @@ class VQADataset(Dataset):
 class VQAYNDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.data_root = args.data_root
         self.tokenizer = tokenizer
         self.mode = mode
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         if mode == "train":
             self.data_list = pd.read_csv(args.vqa_yn_data_train_path)
@@ -407,6 +411,9 @@ class VQAYNDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [os.path.join(self.args.data_root, path) for path in self.data_list["Image Path"]]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -414,7 +421,7 @@ class VQAYNDataset(Dataset):
                 data = self.data_list.iloc[idx]
                 image_abs_path = os.path.join(self.args.data_root, data["Image Path"])
 
-                image = np.load(image_abs_path)  # nomalized, 0-1, C,D,H,W
+                image = self.volumes.load(image_abs_path)  # nomalized, 0-1, C,D,H,W
                 # image = np.load(img_path)[np.newaxis, ...]  # nomalized
 
                 image = self.transform(image)
@@ -423,9 +430,7 @@ class VQAYNDataset(Dataset):
                 answer = str(data["Answer"])
 
                 question = self.image_tokens + ' ' + question
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt",
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -434,10 +439,7 @@ class VQAYNDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -472,6 +474,7 @@ class VQAYNDataset(Dataset):
 class PosRECDataset(Dataset):
     def __init__(self, args, tokenizer, tag="0000", description=True, mode='train'):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
 
         self.tag = tag
@@ -481,6 +484,7 @@ class PosRECDataset(Dataset):
         self.dataset_info = dataset_info
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
         self.box_tokens = ["<bx_start>", "<bx_end>"]
 
         root_path = args.seg_data_path
@@ -544,6 +548,9 @@ class PosRECDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [data['image'] for data in self.data_list]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -552,8 +559,8 @@ class PosRECDataset(Dataset):
             image_path = data['image']
             seg_path = data['label']
 
-            image_array = np.load(image_path) #1*32*256*256, normalized
-            seg_array = np.load(seg_path)
+            image_array = self.volumes.load(image_path) #1*32*256*256, normalized
+            seg_array = self.volumes.load(seg_path)
             cls_id = int(os.path.basename(seg_path).split('_')[1].split('.')[0])
 
             try:
@@ -596,10 +603,7 @@ class PosRECDataset(Dataset):
                         question = self.image_tokens + ' ' + question
                         answer = random.choice(self.des_no_answers).format(cls_list[cls_id])
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length",
-                    return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -608,10 +612,7 @@ class PosRECDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -645,6 +646,7 @@ class PosRECDataset(Dataset):
 class PosREGDataset(Dataset):
     def __init__(self, args, tokenizer, tag="0000", description=True, mode='train'):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
 
         self.tag = tag
@@ -654,6 +656,7 @@ class PosREGDataset(Dataset):
         self.dataset_info = dataset_info
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
         self.box_tokens = ["<bx_start>", "<bx_end>"]
 
         root_path = args.seg_data_path
@@ -722,6 +725,9 @@ class PosREGDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [data['image'] for data in self.data_list]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -730,8 +736,8 @@ class PosREGDataset(Dataset):
             image_path = data['image']
             seg_path = data['label']
 
-            image_array = np.load(image_path) #1*32*256*256, normalized
-            seg_array = np.load(seg_path)
+            image_array = self.volumes.load(image_path) #1*32*256*256, normalized
+            seg_array = self.volumes.load(seg_path)
             cls_id = int(os.path.basename(seg_path).split('_')[1].split('.')[0])
 
             try:
@@ -773,10 +779,7 @@ class PosREGDataset(Dataset):
                         question = self.image_tokens + ' ' + question
                         answer = random.choice(self.des_no_answers).format(cls_list[cls_id])
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length",
-                    return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -785,10 +788,7 @@ class PosREGDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -823,6 +823,7 @@ class PosREGDataset(Dataset):
 class SegDataset(Dataset):
     def __init__(self, args, tokenizer, tag="0000", description=False, mode='train'):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
 
         self.tag = tag
@@ -831,6 +832,7 @@ class SegDataset(Dataset):
         self.dataset_info = dataset_info
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         root_path = args.seg_data_path
         if mode == "train":
@@ -893,6 +895,9 @@ class SegDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [data['image'] for data in self.data_list]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -901,8 +906,8 @@ class SegDataset(Dataset):
             image_path = data['image']
             seg_path = data['label']
 
-            image_array = np.load(image_path) #1*32*256*256, normalized
-            seg_array = np.load(seg_path)
+            image_array = self.volumes.load(image_path) #1*32*256*256, normalized
+            seg_array = self.volumes.load(seg_path)
             cls_id = int(os.path.basename(seg_path).split('_')[1].split('.')[0])
 
             try:
@@ -941,10 +946,7 @@ class SegDataset(Dataset):
                         question = self.image_tokens + ' ' + question
                         answer = random.choice(self.des_no_answers).format(cls_list[cls_id])
 
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length",
-                    return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -953,10 +955,7 @@ class SegDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -988,10 +987,12 @@ class SegDataset(Dataset):
 class RefSegDataset(Dataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
+        self.volumes = VolumeProvider.from_args(args)
         self.tokenizer = tokenizer
         self.mode = mode
 
         self.image_tokens = "<im_patch>" * args.proj_out_num
+        self.prompt_tokenizer = ImagePromptTokenizer(tokenizer, args.proj_out_num)
 
         train_transform = mtf.Compose(
             [
@@ -1027,6 +1028,9 @@ class RefSegDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def volume_paths(self):
+        return [os.path.join(self.args.data_root, path) for path in self.data_list["Image"]]
+
     def __getitem__(self, idx):
         max_attempts = 100
         for _ in range(max_attempts):
@@ -1034,10 +1038,10 @@ class RefSegDataset(Dataset):
                 data = self.data_list.iloc[idx]
                 image_path = os.path.join(self.args.data_root, data["Image"])
 
-                image_array = np.load(image_path)  # 1*32*256*256, normalized
+                image_array = self.volumes.load(image_path)  # 1*32*256*256, normalized
 
                 seg_path = os.path.join(self.args.data_root, data["Mask"])
-                seg_array = np.load(seg_path)
+                seg_array = self.volumes.load(seg_path)
                 seg_array = (seg_array == data["Mask_ID"]).astype(np.int8)
 
                 item = {
@@ -1056,9 +1060,7 @@ class RefSegDataset(Dataset):
                 answer = data["Answer"]
 
                 self.tokenizer.padding_side = "right"
-                text_tensor = self.tokenizer(
-                    question + ' ' + answer, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
+                text_tensor = self.prompt_tokenizer.encode(question + ' ' + answer, self.args.max_length)
 
                 input_id = text_tensor["input_ids"][0]
                 attention_mask = text_tensor["attention_mask"][0]
@@ -1067,10 +1069,7 @@ class RefSegDataset(Dataset):
                 if valid_len < len(input_id):
                     input_id[valid_len] = self.tokenizer.eos_token_id
 
-                question_tensor = self.tokenizer(
-                    question, max_length=self.args.max_length, truncation=True, padding="max_length", return_tensors="pt"
-                )
-                question_len = torch.sum(question_tensor["attention_mask"][0])
+                question_len = self.prompt_tokenizer.length(question, self.args.max_length)
 
                 label = input_id.clone()
                 label[:question_len] = -100
@@ -1197,4 +1196,11 @@ class UniDatasets(Dataset):
         return self.dataset[idx]
 
 
-
+def volume_paths(dataset):
+    """
+    Path of the volume that every item of dataset reads, for VolumeGroupedSampler. The combined datasets
+    (UniDatasets, TextDatasets, ...) concatenate the paths of their ds_list.
+    """
+    if hasattr(dataset, 'ds_list'):
+        return [path for ds in dataset.ds_list for path in volume_paths(ds)]
+    return dataset.volume_paths()
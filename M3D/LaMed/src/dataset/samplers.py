@@ -0,0 +1,118 @@
+from collections import OrderedDict
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler for evaluation that puts prompts of similar length in the same batch,
+    so that left padding wastes as little compute as possible.
+
+    Indices are sorted by length (stable, so ties keep dataset order) and cut into batches of batch_size.
+    """
+    def __init__(self, lengths, batch_size):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        order = np.argsort(self.lengths, kind='stable')
+        self.batches = [order[i:i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def group_by_volume(volume_names, shuffle=False, seed=0):
+    """
+    Dataset indices with the questions about the same volume next to each other.
+
+    Without shuffle, volumes are visited in order of first appearance and the questions of a volume keep dataset
+    order. With shuffle, both the order of the volumes and the order of the questions in every volume are random
+    (drawn from seed), so a training epoch is as random as a plain shuffle except that a volume is not revisited.
+    """
+    groups = {}
+    for i, name in enumerate(volume_names):
+        groups.setdefault(name, []).append(i)
+    groups = list(groups.values())
+    if not shuffle:
+        return [i for indices in groups for i in indices]
+    generator = np.random.default_rng(seed)
+    order = []
+    for g in generator.permutation(len(groups)):
+        order.extend(np.asarray(groups[g])[generator.permutation(len(groups[g]))].tolist())
+    return order
+
+
+def volume_reads(volume_names, order, cache_size=1):
+    """
+    How often the volumes are read when the dataset is visited in order (dataset indices), with the last cache_size
+    volumes still cached (page cache, feature cache, prefix cache). cache_size=1 only counts the questions that follow
+    a question about the same volume as free. Returns the number of reads, the number of volumes and reads per volume.
+    """
+    cache = OrderedDict()
+    reads = 0
+    for i in order:
+        name = volume_names[i]
+        if name in cache:
+            cache.move_to_end(name)
+            continue
+        reads += 1
+        cache[name] = None
+        if len(cache) > cache_size:
+            cache.popitem(last=False)
+    volumes = len({volume_names[i] for i in order})
+    return reads, volumes, reads / max(volumes, 1)
+
+
+class VolumeGroupedSampler(Sampler):
+    """
+    Training sampler that shuffles at the level of the volumes: every epoch visits the volumes in a new random order
+    and all the questions about a volume one after the other, in random order too (see group_by_volume). The order
+    depends on seed and the epoch (set_epoch, called by the Trainer), so it is the same on every rank.
+    """
+    def __init__(self, volume_names, shuffle=True, seed=0):
+        self.volume_names = list(volume_names)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        return iter(group_by_volume(self.volume_names, self.shuffle, self.seed + self.epoch))
+
+    def __len__(self):
+        return len(self.volume_names)
+
+
+class VolumeGroupedBatchSampler(Sampler):
+    """
+    Batch sampler for evaluation that keeps the questions about the same volume next to each other,
+    so per-volume caches (image features, image prefix key/values) are reused right away.
+
+    Volumes are visited in order of first appearance and the questions of a volume keep dataset order,
+    unless shuffle is set (see group_by_volume).
+    """
+    def __init__(self, volume_names, batch_size, shuffle=False, seed=0):
+        self.volume_names = list(volume_names)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def order(self):
+        return group_by_volume(self.volume_names, self.shuffle, self.seed + self.epoch)
+
+    def __iter__(self):
+        order = self.order
+        return iter([order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)])
+
+    def __len__(self):
+        return (len(self.volume_names) + self.batch_size - 1) // self.batch_size
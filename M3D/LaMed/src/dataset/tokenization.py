@@ -0,0 +1,84 @@
+import torch
+from transformers import AddedToken, AutoTokenizer
+
+
+LAMED_SPECIAL_TOKENS = ["<im_patch>", "<bx_start>", "<bx_end>"]
+SEG_TOKEN = "[SEG]"
+
+
+def add_lamed_tokens(tokenizer):
+    """
+    Add the LaMed image, box and [SEG] tokens (a no-op for the ids of checkpoints that already have them).
+
+    [SEG] is a plain added token. A slow tokenizer matches it on the raw text, a fast one only does so when it is
+    unnormalized, so on fast tokenizers it is (re-)registered with normalized=False to give the same ids.
+    """
+    tokenizer.add_special_tokens({"additional_special_tokens": LAMED_SPECIAL_TOKENS},
+                                 replace_additional_special_tokens=False)
+    if getattr(tokenizer, "is_fast", False):
+        tokenizer.add_tokens(AddedToken(SEG_TOKEN, special=False, normalized=False))
+    else:
+        tokenizer.add_tokens(SEG_TOKEN)
+    return tokenizer
+
+
+def load_tokenizer(name_or_path, use_fast=False, **kwargs):
+    """
+    AutoTokenizer with the LaMed tokens. use_fast=True loads the Rust tokenizer (converted from the SentencePiece
+    model when the checkpoint has no tokenizer.json); check it with Bench/dataset/tokenizer_parity.py before switching a model.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path, use_fast=use_fast, **kwargs)
+    return add_lamed_tokens(tokenizer)
+
+
+class ImagePromptTokenizer:
+    """
+    Tokenizes "<im_patch>" * num_image_tokens + text prompts without running the tokenizer over the image tokens.
+
+    The image tokens are special tokens, so a slow tokenizer splits the text around each of them and their ids do not
+    depend on the text: only one image token plus the text is tokenized and the block of image token ids is spliced in.
+    Truncation, special tokens and padding then go through tokenizer.prepare_for_model, as in tokenizer(text, ...),
+    so the tensors are identical to tokenizing the full prompt. Fast tokenizers and texts without the image prefix
+    take the plain tokenizer path.
+    """
+    def __init__(self, tokenizer, num_image_tokens, image_token="<im_patch>"):
+        self.tokenizer = tokenizer
+        self.num_image_tokens = num_image_tokens
+        self.image_token = image_token
+        self.image_tokens = image_token * num_image_tokens
+        self.image_token_id = tokenizer.convert_tokens_to_ids(image_token)
+        self.splice = not getattr(tokenizer, "is_fast", False) and image_token in tokenizer.all_special_tokens
+
+    def input_ids(self, text):
+        """Same as tokenizer(text, add_special_tokens=False)['input_ids']."""
+        if not (self.splice and self.num_image_tokens > 0 and text.startswith(self.image_tokens)):
+            return self.tokenizer(text, add_special_tokens=False)['input_ids']
+        ids = self.tokenizer(text[len(self.image_tokens) - len(self.image_token):], add_special_tokens=False)['input_ids']
+        pos = ids.index(self.image_token_id)
+        return ids[:pos + 1] + [self.image_token_id] * (self.num_image_tokens - 1) + ids[pos + 1:]
+
+    def encode(self, text, max_length):
+        """Same as tokenizer(text, max_length=max_length, truncation=True, padding="max_length", return_tensors="pt")."""
+        return self.tokenizer.prepare_for_model(
+            self.input_ids(text), max_length=max_length, truncation=True, padding="max_length",
+            return_tensors="pt", prepend_batch_axis=True,
+        )
+
+    def length(self, text, max_length):
+        """Number of tokens of text with special tokens and truncation, the sum of the attention mask of encode()."""
+        return min(len(self.input_ids(text)) + self.tokenizer.num_special_tokens_to_add(), max_length)
+
+    def batch_encode(self, texts, padding_side="right"):
+        """
+        Same as tokenizer(texts, padding=True, return_tensors="pt") with tokenizer.padding_side = padding_side, without
+        changing the tokenizer, so it can run on a prefetch thread while the tokenizer is used elsewhere.
+        """
+        rows = [self.tokenizer.prepare_for_model(self.input_ids(text))['input_ids'] for text in texts]
+        width = max(len(row) for row in rows)
+        input_ids = torch.full((len(rows), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, row in enumerate(rows):
+            start = width - len(row) if padding_side == "left" else 0
+            input_ids[i, start:start + len(row)] = torch.tensor(row, dtype=torch.long)
+            attention_mask[i, start:start + len(row)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
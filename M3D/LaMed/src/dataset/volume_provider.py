@@ -0,0 +1,35 @@
+import numpy as np
+
+from .volume_shards import ShardReader
+
+
+class VolumeProvider:
+    """
+    Loads the .npy volumes and masks of the datasets.
+
+    With mmap=True the files are opened with mmap_mode='c' instead of being read into every worker: the pages come
+    from the page cache, so a volume is read from disk and held in memory once per node however many DataLoader
+    workers or questions touch it, and each worker only pays for the pages it reads. The mapping is copy-on-write,
+    a transform that writes to the array gets private pages and never changes the file. A mapping is released with
+    the last array or tensor that references it. With mmap=False every load is a plain np.load.
+
+    shards is a directory of packed volumes (volume_shards.py), paths found in them are read from the shards
+    (memory-mapped, whatever mmap is) and the others from their files. shard_root is the --root they were packed with.
+    """
+    def __init__(self, mmap=False, shards=None, shard_root=None):
+        self.mmap = mmap
+        self.shards = ShardReader(shards, shard_root) if shards is not None else None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(getattr(args, 'volume_mmap', False), getattr(args, 'volume_shards', None),
+                   getattr(args, 'volume_shard_root', None))
+
+    def load(self, path):
+        if self.shards is not None:
+            volume = self.shards.get(path)
+            if volume is not None:
+                return volume
+        if self.mmap and str(path).endswith(".npy"):
+            return np.load(path, mmap_mode='c')
+        return np.load(path)
@@ -0,0 +1,193 @@
+"""
+Packed volume shards: many .npy volumes in a few large files, read back memory-mapped without copies.
+
+    python -m LaMed.src.dataset.volume_shards --valid_path ../valid_path.csv --output_dir ../3DRAD/shards
+    python -m LaMed.src.dataset.volume_shards --glob "./Data/data/M3D_Seg_npy/**/*.npy" --root ./Data/data --output_dir ./Data/data/M3D_Seg_shards
+
+A shard starts with MAGIC, the length of its JSON header (little-endian uint64) and the header:
+{"alignment": A, "volumes": {key: {"offset", "shape", "dtype", ...}}}. Every volume is stored C-contiguous at an
+offset aligned to A bytes from the start of the file, encoded with --codec and --compression (volume_codecs.py).
+Keys are the volume paths relative to --root (normalized), so datasets keep building the same paths and the reader
+maps them to their shard.
+"""
+import os
+import glob
+import json
+import shutil
+import struct
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from .volume_codecs import CODECS, encode_volume, decode_volume, stored_size
+
+
+MAGIC = b"VSHARD01"
+SHARD_SUFFIX = ".vshard"
+ALIGNMENT = 4096
+
+
+def volume_key(path, root=None):
+    path = os.path.normpath(path)
+    if root is not None:
+        path = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    return path
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def write_shard(path, items, alignment=ALIGNMENT, codec="raw", compression=None):
+    """
+    Write one shard. items are (key, array or .npy path) pairs, every volume is read and encoded once.
+
+    The encoded volumes go to a temporary data file first, so the header index with their sizes can come first.
+    """
+    volumes = {}
+    data_path = f"{path}.{os.getpid()}.data"
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(data_path, 'wb') as f:
+            for key, value in items:
+                if key in volumes:
+                    raise ValueError(f"Duplicate volume key {key} in {path}")
+                array = np.load(value, mmap_mode='r') if isinstance(value, str) else np.asarray(value)
+                chunks, entry = encode_volume(array, codec, compression)
+                # Offsets are relative to the data start until the header size is known.
+                entry['offset'] = f.seek(_align(f.tell(), alignment))
+                for chunk in chunks:
+                    f.write(chunk)
+                volumes[key] = entry
+            data_len = _align(f.tell(), alignment)
+
+        # Offsets grow the header by a few digits each, leave room for that.
+        header_len = len(json.dumps({'alignment': alignment, 'volumes': volumes}).encode("utf-8"))
+        data_start = _align(len(MAGIC) + 8 + header_len + 24 * len(volumes), alignment)
+        for entry in volumes.values():
+            entry['offset'] += data_start
+        header = json.dumps({'alignment': alignment, 'volumes': volumes}).encode("utf-8")
+        assert len(MAGIC) + 8 + len(header) <= data_start
+
+        with open(tmp_path, 'wb') as f, open(data_path, 'rb') as data:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.seek(data_start)
+            shutil.copyfileobj(data, f, 16 << 20)
+            f.truncate(data_start + data_len)
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (data_path, tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return volumes
+
+
+def read_shard_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a volume shard")
+        header_len, = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(header_len).decode("utf-8"))
+
+
+class ShardReader:
+    """
+    Volumes of all the shards in shard_dir, by key (see volume_key).
+
+    get() reads from a copy-on-write memory map of the shard, without a file open per volume: raw volumes are a
+    view of the map (no copy), float16/uint8 and compressed ones are decoded to a new array when they are read. The
+    pages come from the page cache and are shared by every process that reads the shard. Each process maps a shard
+    the first time it reads from it, so a reader built before the DataLoader workers fork is safe to use in them.
+    """
+    def __init__(self, shard_dir, root=None):
+        self.root = root
+        self.index = {}
+        self.shard_paths = sorted(glob.glob(os.path.join(shard_dir, "*" + SHARD_SUFFIX)))
+        for shard_id, path in enumerate(self.shard_paths):
+            for key, entry in read_shard_header(path)['volumes'].items():
+                self.index[key] = (shard_id, entry)
+        self._maps = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return volume_key(path, self.root) in self.index
+
+    def _map(self, shard_id):
+        if self._pid != os.getpid():
+            self._maps, self._pid = {}, os.getpid()
+        if shard_id not in self._maps:
+            self._maps[shard_id] = np.memmap(self.shard_paths[shard_id], dtype=np.uint8, mode='c')
+        return self._maps[shard_id]
+
+    def get(self, path):
+        """The volume stored for path, None when it is not in the shards."""
+        entry = self.index.get(volume_key(path, self.root))
+        if entry is None:
+            return None
+        shard_id, entry = entry
+        return decode_volume(self._map(shard_id)[entry['offset']:entry['offset'] + stored_size(entry)], entry)
+
+    def __getstate__(self):
+        # The maps are reopened in the process that unpickles the reader.
+        state = self.__dict__.copy()
+        state['_maps'], state['_pid'] = {}, None
+        return state
+
+
+def pack_volumes(paths, output_dir, root=None, shard_size=4 << 30, alignment=ALIGNMENT, codec="raw", compression=None):
+    """
+    Pack .npy files into shards of about shard_size bytes (before encoding), returns the number of shards written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards, shard, size = [], [], 0
+    for path in paths:
+        nbytes = _align(np.load(path, mmap_mode='r').nbytes, alignment)
+        if shard and size + nbytes > shard_size:
+            shards.append(shard)
+            shard, size = [], 0
+        shard.append((volume_key(path, root), path))
+        size += nbytes
+    if shard:
+        shards.append(shard)
+    for i, items in enumerate(shards):
+        path = os.path.join(output_dir, f"shard-{i:05d}{SHARD_SUFFIX}")
+        write_shard(path, items, alignment, codec, compression)
+        print(f"{path}: {len(items)} volumes")
+    return len(shards)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Pack .npy volumes into memory-mappable shards.")
+    parser.add_argument('--valid_path', type=str, default=None, help="CSV with a Path column (3D-RAD valid_path.csv).")
+    parser.add_argument('--glob', type=str, default=None, help="Pattern of the .npy files to pack (recursive **).")
+    parser.add_argument('--root', type=str, default=None,
+                        help="Keys are the paths relative to this directory, pass the same root to the reader.")
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--shard_size_gb', type=float, default=4)
+    parser.add_argument('--codec', type=str, default="raw", choices=CODECS,
+                        help="float16 and uint8 are lossy, check them with Bench/eval/codec_fidelity.py.")
+    parser.add_argument('--compression', type=str, default=None, choices=["zstd"])
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    paths = []
+    if args.valid_path is not None:
+        paths += pd.read_csv(args.valid_path)['Path'].tolist()
+    if args.glob is not None:
+        paths += sorted(glob.glob(args.glob, recursive=True))
+    paths = [path for path in dict.fromkeys(paths) if path.endswith(".npy")]
+    num_shards = pack_volumes(paths, args.output_dir, args.root, int(args.shard_size_gb * (1 << 30)),
+                              codec=args.codec, compression=args.compression)
+    print(f"{len(paths)} volumes in {num_shards} shards")
+
+
+if __name__ == "__main__":
+    main()
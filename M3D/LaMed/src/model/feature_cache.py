@@ -0,0 +1,83 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class VisionFeatureCache:
+    """
+    Cache of projected image features (the output of vision_tower + mm_projector), keyed by volume name.
+
+    Two tiers:
+        - memory: LRU of up to max_items tensors, kept on the device they were computed on.
+        - disk (optional): one .npy file per volume under cache_dir, read back with mmap_mode='r'.
+
+    Features depend on the checkpoint, so either use a cache_dir per model or set namespace (e.g. the model path).
+    Only use it for inference: cached features are detached.
+    """
+    def __init__(self, max_items=256, cache_dir=None, namespace=""):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1((self.namespace + "\0" + key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".npy")
+
+    def _put_memory(self, key, features):
+        if self.max_items <= 0:
+            return
+        self.memory[key] = features
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key, device=None, dtype=None):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                features = torch.from_numpy(np.load(path))
+                features = features.to(device=device, dtype=dtype)
+                self._put_memory(key, features)
+                self.disk_hits += 1
+                return features
+
+        self.misses += 1
+        return None
+
+    def put(self, key, features):
+        features = features.detach().clone()
+        self._put_memory(key, features)
+
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            if not os.path.exists(path):
+                # numpy has no bfloat16, store float32 on disk and cast back on load.
+                array = features.float().cpu().numpy()
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def report(self):
+        total = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / total if total > 0 else 0.0
+        return (f"vision feature cache: {self.hits} memory hits, {self.disk_hits} disk hits, "
+                f"{self.misses} misses, hit rate {hit_rate:.2%}")
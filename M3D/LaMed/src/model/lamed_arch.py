@@ -6,6 +6,7 @@ import torch.nn as nn
 from .multimodal_encoder.builder import build_vision_tower
 from .multimodal_projector.builder import build_mm_projector
 from .segmentation_module.builder import build_segmentation_module
+from .prefix_cache import stack_past_key_values
 from LaMed.src.model.loss import BCELoss, BinaryDiceLoss
 
 
@@ -112,23 +113,113 @@ class LamedMetaForCausalLM(ABC):
     def get_vision_tower(self):
         return self.get_model().get_vision_tower()
 
-    def encode_images(self, images):
-        image_features = self.get_model().get_vision_tower()(images)
-        image_features = self.get_model().mm_projector(image_features)
-        return image_features
+    def set_feature_cache(self, feature_cache):
+        # A VisionFeatureCache used by encode_images when image_keys are given, None disables it.
+        self.feature_cache = feature_cache
+
+    def encode_images(self, images, image_keys=None):
+        feature_cache = getattr(self, 'feature_cache', None)
+        if feature_cache is None or image_keys is None:
+            image_features = self.get_model().get_vision_tower()(images)
+            image_features = self.get_model().mm_projector(image_features)
+            return image_features
+
+        # Only run the vision tower and projector for the images that are not cached yet.
+        dtype = next(self.get_model().mm_projector.parameters()).dtype
+        image_features = [feature_cache.get(key, device=images.device, dtype=dtype) for key in image_keys]
+        missing = [i for i, features in enumerate(image_features) if features is None]
+        if missing:
+            new_features = self.get_model().get_vision_tower()(images[missing])
+            new_features = self.get_model().mm_projector(new_features)
+            for i, features in zip(missing, new_features):
+                feature_cache.put(image_keys[i], features)
+                image_features[i] = features
+        return torch.stack(image_features, dim=0)
+
+    def set_prefix_cache(self, prefix_cache):
+        # A PrefixKVCache used by generate when image_keys are given, None disables it.
+        self.prefix_cache = prefix_cache
+
+    def image_prefix_past(self, images, bos_ids, image_keys):
+        """
+        Key/value states of BOS + image tokens for every row, as batch-size-1 legacy caches.
+        The prefill only runs once for each volume that is not in self.prefix_cache.
+        """
+        entries = [self.prefix_cache.get(key) for key in image_keys]
+        missing = {}
+        for i, entry in enumerate(entries):
+            if entry is None and image_keys[i] not in missing:
+                missing[image_keys[i]] = i
+
+        if missing:
+            rows = list(missing.values())
+            image_features = self.encode_images(images[rows], [image_keys[i] for i in rows])
+            bos_embeds = self.get_model().embed_tokens(bos_ids[rows])
+            inputs_embeds = torch.cat((bos_embeds, image_features.to(dtype=bos_embeds.dtype)), dim=1)
+            past_key_values = self.get_model()(inputs_embeds=inputs_embeds, use_cache=True, return_dict=True).past_key_values
+            if hasattr(past_key_values, "to_legacy_cache"):
+                past_key_values = past_key_values.to_legacy_cache()
+
+            computed = {}
+            for j, i in enumerate(rows):
+                computed[image_keys[i]] = tuple((k[j:j + 1].clone(), v[j:j + 1].clone()) for k, v in past_key_values)
+                self.prefix_cache.put(image_keys[i], computed[image_keys[i]])
+            entries = [entry if entry is not None else computed[key] for entry, key in zip(entries, image_keys)]
+        return entries
+
+    def generate_with_prefix_cache(self, images, inputs, image_keys, attention_mask=None, **kwargs):
+        """
+        Same output as generate() with images, but the BOS + image token prefix of each prompt comes from
+        self.prefix_cache, so the prefill only runs over the question tokens. Rows may be left padded.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(inputs)
+        num_pads = (attention_mask == 0).sum(dim=1).tolist()
+        rows = torch.arange(inputs.shape[0], device=inputs.device)
+        bos_ids = inputs[rows, torch.tensor(num_pads, device=inputs.device)][:, None]
+
+        entries = self.image_prefix_past(images, bos_ids, image_keys)
+        num_prefix = entries[0][0][0].shape[2]
+        if inputs.shape[1] - max(num_pads) <= num_prefix:
+            raise ValueError(f"Prompts must be longer than the {num_prefix} prefix tokens (BOS + image tokens).")
+
+        # Move every row's prefix in front of its left padding: [BOS, image tokens, pads, question].
+        # Pads are masked and position ids follow the attention mask, so each row is still a contiguous prompt.
+        input_ids, prefix_mask = [], []
+        for i, pads in enumerate(num_pads):
+            order = list(range(pads, pads + num_prefix)) + list(range(pads)) + list(range(pads + num_prefix, inputs.shape[1]))
+            input_ids.append(inputs[i, order])
+            prefix_mask.append(attention_mask[i, order])
+
+        # The model only embeds the tokens after the cached prefix, the image token ids are never looked up.
+        output_ids = super(LamedMetaForCausalLM, self).generate(
+            inputs=torch.stack(input_ids, dim=0),
+            attention_mask=torch.stack(prefix_mask, dim=0),
+            past_key_values=stack_past_key_values(entries),
+            **kwargs
+        )
+        # Unlike generation from inputs_embeds, the output starts with the prompt.
+        return output_ids[:, inputs.shape[1]:]
 
     def prepare_inputs_for_multimodal(
         self, input_ids, position_ids, attention_mask, past_key_values, labels,
-        images,
+        images, image_keys=None,
     ):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
         else:
-            image_features = self.encode_images(images)
+            image_features = self.encode_images(images, image_keys)
             inputs_embeds = self.get_model().embed_tokens(input_ids)
-            inputs_embeds = torch.cat(
-                (inputs_embeds[:, :1, :], image_features, inputs_embeds[:, (image_features.shape[1] + 1):, :]), dim=1)
+            if attention_mask is not None and not bool(attention_mask[:, 0].all()):
+                # Left padded batch (batched generation): the image tokens of each row start right after its BOS token.
+                num_pads = (attention_mask == 0).sum(dim=1)
+                positions = num_pads[:, None] + 1 + torch.arange(image_features.shape[1], device=input_ids.device)[None, :]
+                rows = torch.arange(input_ids.shape[0], device=input_ids.device)[:, None]
+                inputs_embeds[rows, positions] = image_features.to(dtype=inputs_embeds.dtype)
+            else:
+                inputs_embeds = torch.cat(
+                    (inputs_embeds[:, :1, :], image_features, inputs_embeds[:, (image_features.shape[1] + 1):, :]), dim=1)
         return None, position_ids, attention_mask, past_key_values, inputs_embeds, labels
 
     def initialize_vision_tokenizer(self, model_args, tokenizer):
@@ -154,9 +154,14 @@ class LamedLlamaForCausalLM(LamedMetaForCausalLM, LlamaForCausalLM):
     ) -> Union[GenerateOutput, torch.LongTensor, Any]:
         position_ids = kwargs.pop("position_ids", None)
         attention_mask = kwargs.pop("attention_mask", None)
+        image_keys = kwargs.pop("image_keys", None)
         if "inputs_embeds" in kwargs:
             raise NotImplementedError("`inputs_embeds` is not supported")
 
+        if images is not None and image_keys is not None and not seg_enable \
+                and getattr(self, 'prefix_cache', None) is not None:
+            return self.generate_with_prefix_cache(images, inputs, image_keys, attention_mask, **kwargs)
+
         if images is not None:
             (
                 inputs,
@@ -172,10 +177,14 @@ class LamedLlamaForCausalLM(LamedMetaForCausalLM, LlamaForCausalLM):
                 None,
                 None,
                 images,
+                image_keys,
             )
         else:
             inputs_embeds = self.get_model().embed_tokens(inputs)
 
+        if attention_mask is not None:
+            kwargs["attention_mask"] = attention_mask
+
         if seg_enable:
             outputs = super().generate(
                 inputs_embeds=inputs_embeds,
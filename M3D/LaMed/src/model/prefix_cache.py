@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+import torch
+
+
+class PrefixKVCache:
+    """
+    LRU cache of the key/value states of the image prefix (BOS + image tokens), keyed by volume name.
+
+    Every question about a volume starts with the same prefix, so its prefill only has to run once per volume.
+    Each entry is a legacy past_key_values tuple with batch size 1, one (key, value) pair per layer. They are large
+    (layers x 2 x prefix length x hidden size), so keep max_items small and evaluate questions grouped by volume.
+    Only use it for inference: cached states are detached.
+    """
+    def __init__(self, max_items=2):
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, past_key_values):
+        if self.max_items <= 0:
+            return
+        self.memory[key] = tuple((k.detach(), v.detach()) for k, v in past_key_values)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        return f"prefix kv cache: {self.hits} hits, {self.misses} misses, hit rate {hit_rate:.2%}"
+
+
+def stack_past_key_values(entries):
+    # Concatenate batch-size-1 legacy caches along the batch dimension.
+    return tuple(
+        (torch.cat([entry[layer][0] for entry in entries], dim=0),
+         torch.cat([entry[layer][1] for entry in entries], dim=0))
+        for layer in range(len(entries[0]))
+    )
@@ -4,10 +4,23 @@ from transformers import Trainer
 from transformers.utils import logging, SAFE_WEIGHTS_NAME, WEIGHTS_NAME
 from typing import Optional
 
+from LaMed.src.dataset.multi_dataset import volume_paths
+from LaMed.src.dataset.samplers import VolumeGroupedSampler, volume_reads
+
 logger = logging.get_logger(__name__)
 TRAINING_ARGS_NAME = "training_args.bin"
 
 class LaMedTrainer(Trainer):
+    def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        if getattr(self.args, 'group_by_volume', False) and self.train_dataset is not None:
+            # Random volume order every epoch, the questions about a volume are read one after the other.
+            paths = volume_paths(self.train_dataset)
+            sampler = VolumeGroupedSampler(paths, shuffle=True, seed=self.args.seed)
+            reads, volumes, per_volume = volume_reads(paths, list(sampler))
+            logger.info(f"Grouped by volume: {reads} volume reads per epoch for {volumes} volumes ({per_volume:.2f} per volume)")
+            return sampler
+        return super()._get_train_sampler()
+
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         # If we are executing this function, we are the process zero, so we don't check for that.
         output_dir = output_dir if output_dir is not None else self.args.output_dir
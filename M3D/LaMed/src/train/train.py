@@ -4,9 +4,10 @@ from typing import Optional, List, Dict
 import numpy as np
 import torch
 import transformers
-from transformers import AutoTokenizer, LlamaForCausalLM
+from transformers import LlamaForCausalLM
 from dataclasses import dataclass, field
 from LaMed.src.dataset.multi_dataset import UniDatasets, CapDataset, TextDatasets, VQADataset
+from LaMed.src.dataset.tokenization import load_tokenizer
 from LaMed.src.model.language_model import LamedLlamaForCausalLM, LamedPhi3ForCausalLM
 from LaMed.src.train.lamed_trainer import LaMedTrainer
 
@@ -22,6 +23,7 @@ class ModelArguments:
     version: Optional[str] = field(default="v0")
     model_name_or_path: Optional[str] = field(default="microsoft/Phi-3-mini-4k-instruct", metadata={"help": "Path to the LLM or MLLM."})
     model_type: Optional[str] = field(default=None, metadata={"help": "llama2, phi3"})
+    use_fast_tokenizer: bool = field(default=False, metadata={"help": "Use the fast (Rust) tokenizer, check it with Bench/dataset/tokenizer_parity.py first."})
 
     freeze_backbone: bool = field(default=False)
     pretrain_mllm: Optional[str] = field(default=None)
@@ -73,6 +75,10 @@ class DataArguments:
     refseg_data_train_path: str = field(default="./Data/data/M3D_RefSeg_npy/M3D_RefSeg.csv", metadata={"help": "Path to refering segmentation data."})
     refseg_data_test_path: str = field(default="./Data/data/M3D_RefSeg_npy/M3D_RefSeg_test.csv", metadata={"help": "Path to refering segmentation data."})
 
+    volume_mmap: bool = field(default=False, metadata={"help": "Memory-map the .npy volumes, so dataloader workers share them through the page cache."})
+    volume_shards: Optional[str] = field(default=None, metadata={"help": "Directory of packed volumes (LaMed/src/dataset/volume_shards.py)."})
+    volume_shard_root: Optional[str] = field(default=None, metadata={"help": "The --root the shards were packed with."})
+
 
 @dataclass
 class TrainingArguments(transformers.TrainingArguments):
@@ -120,6 +126,7 @@ class TrainingArguments(transformers.TrainingArguments):
     gradient_checkpointing: bool = False # train fast
     dataloader_pin_memory: bool = True # fast
     dataloader_num_workers: int = 0
+    group_by_volume: bool = field(default=False, metadata={"help": "Shuffle by volume, so the questions about a volume are read one after the other."})
     report_to: str = "tensorboard"
 
 
@@ -269,20 +276,14 @@ def main():
 
     rank0_print("="*20 + " Tokenizer preparation " + "="*20)
     # Load tokenizer from the given path with specified configurations
-    tokenizer = AutoTokenizer.from_pretrained(
+    # The image, box and [SEG] tokens are added by load_tokenizer
+    tokenizer = load_tokenizer(
         model_args.model_name_or_path,
+        use_fast=model_args.use_fast_tokenizer,
         cache_dir=training_args.cache_dir,
         model_max_length=training_args.model_max_length,
         padding_side="right",
-        use_fast=False,
-    )
-
-    # Define and add special tokens
-    special_token = {"additional_special_tokens": ["<im_patch>", "<bx_start>", "<bx_end>"]}
-    tokenizer.add_special_tokens(
-        special_token
     )
-    tokenizer.add_tokens("[SEG]")
 
     if tokenizer.unk_token is not None and tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.unk_token
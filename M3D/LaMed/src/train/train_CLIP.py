@@ -40,6 +40,9 @@ class DataArguments:
     # caption data
     cap_data_path: str = field(default="./Data/data/M3D_Cap_npy/M3D_Cap.json", metadata={"help": "Path to caption data."})
     max_length: int = field(default=512)
+    volume_mmap: bool = field(default=False, metadata={"help": "Memory-map the .npy volumes, so dataloader workers share them through the page cache."})
+    volume_shards: Optional[str] = field(default=None, metadata={"help": "Directory of packed volumes (LaMed/src/dataset/volume_shards.py)."})
+    volume_shard_root: Optional[str] = field(default=None, metadata={"help": "The --root the shards were packed with."})
 
 
 @dataclass
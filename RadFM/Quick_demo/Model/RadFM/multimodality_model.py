@@ -116,13 +116,15 @@ class MultiLLaMAForCausalLM(nn.Module):
         #    self.embedding_layer.flag = 'Seg'
         #    input_embedding = self.embedding_layer(lang_x, vision_x)
     
-    def generate(self, lang_x, vision_x):
+    def generate(self, lang_x, vision_x, max_new_tokens=200, stopping_criteria=None):
         """
         Generate text based on language and vision inputs.
         
         Args:
             lang_x: Language input tokens
             vision_x: Vision input features
+            max_new_tokens: Maximum number of generated tokens
+            stopping_criteria: Optional StoppingCriteriaList to end generation early
             
         Returns:
             Generated token sequence
@@ -137,7 +139,8 @@ class MultiLLaMAForCausalLM(nn.Module):
             # Generate text using language model
             generation = self.lang_model.generate(
                 inputs_embeds=input_embedding, 
-                max_new_tokens=200,
+                max_new_tokens=max_new_tokens,
+                stopping_criteria=stopping_criteria,
                 top_k=50
             )
             
@@ -15,6 +15,31 @@ from torch.autograd import Variable
 import random
 from transformers import AutoTokenizer, AutoModel
 
+def multimodal_embedding(text_input, embedding_weight, vision_x):
+    """
+    Embed token ids where ids below len(embedding_weight) are text/figure tokens and the <imageN> ids after them
+    index the vision embeddings of the same sample.
+
+    Same values as one-hot(text_input) @ cat([embedding_weight, vision_x[b]]) per sample, but only the used rows are
+    gathered: a text embedding lookup and a gather of the vision rows, selected per position. Nothing is read back
+    to the host, so the forward does not wait for the GPU; out-of-range ids fail in the lookup or the gather.
+
+    Args:
+        text_input: Token indices [B, L]
+        embedding_weight: Text and figure token embeddings [V, D]
+        vision_x: Vision embeddings [B, T, D]
+
+    Returns:
+        Embeddings [B, L, D] in the dtype of vision_x
+    """
+    num_text = embedding_weight.shape[0]
+    is_vision = text_input >= num_text
+    text = F.embedding(text_input.masked_fill(is_vision, 0), embedding_weight).to(vision_x.dtype)
+    vision_index = (text_input - num_text).clamp(min=0)
+    vision = vision_x.gather(1, vision_index.unsqueeze(-1).expand(-1, -1, vision_x.shape[-1]))
+    return torch.where(is_vision.unsqueeze(-1), vision, text)
+
+
 class MyEmbedding(nn.Module):
     """
     Custom embedding layer for multimodal inputs that combines text and vision features.
@@ -202,12 +227,7 @@ class MyEmbedding(nn.Module):
             
             # Combine text and vision embeddings
             embedding_weight = torch.cat([self.weight, self.figure_token_weight], dim=0)
-            embedding_weight = embedding_weight.unsqueeze(0).repeat(B, 1, 1)
-            embedding_weight = torch.cat([embedding_weight, vision_x], dim=1)
-            
-            # Convert text indices to one-hot and compute final embeddings
-            text_input = F.one_hot(text_input, embedding_weight.shape[1]).to(vision_x.dtype).to(vision_x.device)
-            out_put = torch.matmul(text_input, embedding_weight)
+            out_put = multimodal_embedding(text_input.to(vision_x.device), embedding_weight, vision_x)
             
         ## useless for now. ignore the folowing code##    
         # if self.flag == 'Seg':
@@ -1,8 +1,12 @@
 # Import necessary libraries for data processing, model loading, and inference
+import os
+import json
+import shutil
+import hashlib
 import tqdm.auto as tqdm
 import torch.nn.functional as F
 from typing import Optional, Dict, Sequence
-from typing import List, Optional, Tuple, Union
+from typing import List, Tuple, Union
 import transformers
 from dataclasses import dataclass, field
 from Model.RadFM.multimodality_model import MultiLLaMAForCausalLM
@@ -11,7 +15,12 @@ from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizer
 from torchvision import transforms
 from PIL import Image   
 
-def get_tokenizer(tokenizer_path, max_img_size=100, image_num=32):
+# Augmented tokenizers are saved here (same layout as RadFM/src/Dataset/tokenization.py), RADFM_TOKENIZER_CACHE overrides it.
+TOKENIZER_CACHE_DIR = os.environ.get(
+    "RADFM_TOKENIZER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "radfm", "tokenizers")
+)
+
+def get_tokenizer(tokenizer_path, max_img_size=100, image_num=32, cache_dir=TOKENIZER_CACHE_DIR):
     '''
     Initialize the tokenizer with special tokens for image handling
     
@@ -19,40 +28,52 @@ def get_tokenizer(tokenizer_path, max_img_size=100, image_num=32):
         tokenizer_path: Path to the base tokenizer
         max_img_size: Maximum number of images supported in a prompt
         image_num: Number of token embeddings per image
+        cache_dir: Directory where the augmented tokenizer is saved after the first build (None disables it)
         
     Returns:
         Tuple of (tokenizer, image_padding_tokens)
     '''
     if isinstance(tokenizer_path, str):
-        image_padding_tokens = []
-        # Load the base tokenizer from the provided path
-        text_tokenizer = LlamaTokenizer.from_pretrained(
-            tokenizer_path,
-        )
-        # Define initial special tokens for image markup
-        special_token = {"additional_special_tokens": ["<image>", "</image>"]}
+        # Concatenated tokens for each image
+        image_padding_tokens = [
+            "".join("<image" + str(i * image_num + j) + ">" for j in range(image_num)) for i in range(max_img_size)
+        ]
         
-        # Generate unique tokens for each image position and patch
-        for i in range(max_img_size):
-            image_padding_token = ""
-            
-            for j in range(image_num):
-                image_token = "<image" + str(i * image_num + j) + ">"
-                image_padding_token = image_padding_token + image_token
-                special_token["additional_special_tokens"].append("<image" + str(i * image_num + j) + ">")
-            
-            # Store the concatenated tokens for each image
-            image_padding_tokens.append(image_padding_token)
-            
-            # Add all special tokens to the tokenizer
+        cache_path = None
+        if cache_dir is not None:
+            base = os.path.abspath(tokenizer_path) if os.path.isdir(tokenizer_path) else tokenizer_path
+            key = json.dumps([base, max_img_size, image_num, "slow", transformers.__version__])
+            cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+        
+        if cache_path is not None and os.path.exists(os.path.join(cache_path, "tokenizer_config.json")):
+            text_tokenizer = LlamaTokenizer.from_pretrained(cache_path)
+        else:
+            # Load the base tokenizer from the provided path
+            text_tokenizer = LlamaTokenizer.from_pretrained(
+                tokenizer_path,
+            )
+            # Image markup tokens and one token per image position and patch, added in a single call
+            special_token = {"additional_special_tokens": ["<image>", "</image>"]}
+            special_token["additional_special_tokens"] += ["<image" + str(i) + ">" for i in range(max_img_size * image_num)]
             text_tokenizer.add_special_tokens(
                 special_token
             )
             
-            # Configure standard special tokens for LLaMA models
-            text_tokenizer.pad_token_id = 0
-            text_tokenizer.bos_token_id = 1
-            text_tokenizer.eos_token_id = 2    
+            if cache_path is not None:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    text_tokenizer.save_pretrained(tmp_path)
+                    os.rename(tmp_path, cache_path)
+                except OSError as e:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    if not os.path.exists(cache_path):
+                        print(f"Could not cache the tokenizer in {cache_dir}: {e}")
+        
+        # Configure standard special tokens for LLaMA models
+        text_tokenizer.pad_token_id = 0
+        text_tokenizer.bos_token_id = 1
+        text_tokenizer.eos_token_id = 2    
     
     return text_tokenizer, image_padding_tokens    
 
@@ -26,6 +26,59 @@ from PIL import Image
 import math
 
 
+VOLUME_STATS_COLUMNS = ["VolumeName", "Min", "Max", "HasNaN"]
+
+_valid_paths = {}
+
+
+def normalize_volume(image, image_min=None, image_max=None):
+    # Min-max normalization of a raw volume, with the precomputed min/max when given
+    if image_min is None:
+        image_min, image_max = image.min(), image.max()
+    return (image-image_min)/(image_max-image_min)
+
+
+def volume_stats(image):
+    """Min, max and whether the normalized volume contains NaN (a NaN voxel or a constant volume)."""
+    image_min, image_max = image.min(), image.max()
+    has_nan = bool(np.isnan(normalize_volume(image, image_min, image_max)).any())
+    return image_min.item(), image_max.item(), has_nan
+
+
+def load_volume(img_path, stats=None, shards=None):
+    """
+    Memory-mapped load and min-max normalization of one volume, None when the normalized volume contains NaN.
+
+    stats is the (min, max, has_nan) of the volume from the volume stats index (python -m Dataset.volume_stats).
+    With it the volume is read once by the normalization, volumes with NaN are not read at all.
+    shards is a ShardReader (Dataset/volume_shards.py), volumes packed in it are read from there.
+    """
+    if stats is not None and stats[2]:
+        return None
+    image = shards.get(img_path) if shards is not None else None
+    if image is None:
+        image = np.load(img_path, mmap_mode='r')
+    if stats is None:
+        image = normalize_volume(image)
+        return None if np.isnan(image).any() else image
+    # In the dtype of the volume, so the result is the same as with the min/max computed here.
+    return normalize_volume(image, image.dtype.type(stats[0]), image.dtype.type(stats[1]))
+
+
+def read_valid_paths(valid_path):
+    # VolumeName -> Path, read once per process
+    key = os.path.abspath(valid_path)
+    if key not in _valid_paths:
+        _valid_paths[key] = pd.read_csv(valid_path).set_index('VolumeName')['Path'].to_dict()
+    return _valid_paths[key]
+
+
+def read_volume_stats(stats_path):
+    """VolumeName -> (min, max, has_nan) from a volume stats index."""
+    df = pd.read_csv(stats_path, float_precision='round_trip')
+    return {name: (lo, hi, bool(has_nan)) for name, lo, hi, has_nan in zip(df['VolumeName'], df['Min'], df['Max'], df['HasNaN'])}
+
+
 class RAD_Dataset(Dataset):
     """_summary_
 
@@ -33,6 +86,12 @@ class RAD_Dataset(Dataset):
         Dataset (_type_): _description_: caption task formulated as vqa task for Radiopaedia dataset
         csv_path (_type_): path to csv file
         prompt_json_file (_type_): path to json file containing caption prompts
+        volume_cache (VolumeCache): pre-resized volumes (Dataset/volume_cache.py), the images of cached volumes
+            come out float16 and already resized as stack_images does
+        volume_stats (str): path to the volume stats index (Dataset/volume_stats.py), None computes the min/max of
+            every volume on every read
+        valid_path (str): csv with the VolumeName and Path of every volume
+        volume_shards (ShardReader): packed volumes (Dataset/volume_shards.py), read instead of the Path files
     Output:
         Dict: {
              "image_dict": {"image": image, "position": {"question": 0}}, # image is a tensor of shape [s,c,w,h,d] like, [1,3,512,512,1], position is a dict, random choice of 0 or len(question)
@@ -40,12 +99,14 @@ class RAD_Dataset(Dataset):
             "answer":answer, # caption
             }
     """
-    def __init__(self, csv_path):
+    def __init__(self, csv_path, volume_cache=None, volume_stats=None, valid_path="../../valid_path.csv", volume_shards=None):
         data_info = pd.read_csv(csv_path)
         # npy_path,image_caption,question,answer
         self.data_list = data_info
-        self.data_root_df = pd.read_csv("../../valid_path.csv")
-        self.data_root_df.set_index('VolumeName', inplace=True)
+        self.volume_paths = read_valid_paths(valid_path)
+        self.volume_cache = volume_cache
+        self.volume_stats = read_volume_stats(volume_stats) if volume_stats else {}
+        self.volume_shards = volume_shards
         # self.img_path_list = np.asarray(data_info['image_path'])
         # self.question_list = np.asarray(data_info['question'])
         # self.answer_list = np.asarray(data_info['answer'])
@@ -54,18 +115,16 @@ class RAD_Dataset(Dataset):
         # return len(self.img_path_list)
         return len(self.data_list)
 
-    def __getitem__(self, index):
-        data = self.data_list.iloc[index]
-        volume_name = data['VolumeName']
-        img_path = self.data_root_df.at[volume_name, 'Path']
-        image = np.load(img_path)
+    def build_prompt(self, data):
+        """
+        Build the question text (with choices) and the answer of one CSV row
 
-        image = (image-image.min())/(image.max()-image.min())
-        contain_nan = (True in np.isnan(image))
-        if contain_nan:
-            image = np.random.randn(3,512,512,4)
+        Args:
+            data: Row of the 3D-RAD csv file
 
-        image = torch.from_numpy(image).float()
+        Returns:
+            Tuple of (question, answer)
+        """
         question = data["Question"]
 
         # 判断是否有选项
@@ -86,6 +145,22 @@ class RAD_Dataset(Dataset):
             question = question + '\n' + choices + '\n' + 'Answer:'
         else:
             question = question + '\nAnswer:'
+        return question, answer
+
+    def __getitem__(self, index):
+        data = self.data_list.iloc[index]
+        volume_name = data['VolumeName']
+        image = None
+        if self.volume_cache is not None:
+            image = self.volume_cache.get(volume_name)
+        if image is None:
+            img_path = self.volume_paths[volume_name]
+            image = load_volume(img_path, self.volume_stats.get(volume_name), self.volume_shards)
+            if image is None:
+                image = np.random.randn(3,512,512,4)
+
+            image = torch.from_numpy(image).float()
+        question, answer = self.build_prompt(data)
 
         image_dict = {
             "image": image,
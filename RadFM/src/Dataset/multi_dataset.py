@@ -13,8 +13,9 @@ import json
 from PIL import Image
 import math
 import torchvision
-from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from .dataset import *
+from .tokenization import build_text_tokenizer, text_add_image, segment_input_ids
 import spacy
 from spacy.tokens import Span
 from scispacy.abbreviation import AbbreviationDetector
@@ -117,7 +118,7 @@ class multi_dataset(Dataset):
     A dataset class that combines multiple medical imaging datasets
     for training a multimodal model
     """
-    def __init__(self, text_tokenizer, max_seq=2048, max_img_size=100, image_num=32, voc_size=32000):
+    def __init__(self, text_tokenizer, max_seq=2048, max_img_size=100, image_num=32, voc_size=32000, use_fast_tokenizer=False):
         """
         Initialize the multimodal dataset
         
@@ -127,6 +128,7 @@ class multi_dataset(Dataset):
             max_img_size: Maximum number of images to process
             image_num: Number of image tokens per image
             voc_size: Vocabulary size for the tokenizer
+            use_fast_tokenizer: Build the fast (Rust) tokenizer when text_tokenizer is a path
         """
         self.text_tokenizer = text_tokenizer
         self.max_img_size = max_img_size
@@ -140,26 +142,9 @@ class multi_dataset(Dataset):
         
         # Initialize tokenizer if path is provided
         if isinstance(self.text_tokenizer, str):
-            self.text_tokenizer = LlamaTokenizer.from_pretrained(
-                self.text_tokenizer,
+            self.text_tokenizer, self.image_padding_tokens = build_text_tokenizer(
+                self.text_tokenizer, max_img_size, image_num, use_fast=use_fast_tokenizer,
             )
-            
-            # Add special tokens for image references
-            special_token = {"additional_special_tokens": ["<image>", "</image>"]}
-            for i in range(max_img_size):
-                image_padding_token = ""
-                for j in range(image_num):
-                    image_token = "<image" + str(i * image_num + j) + ">"
-                    image_padding_token = image_padding_token + image_token
-                    special_token["additional_special_tokens"].append("<image" + str(i * image_num + j) + ">")
-                self.image_padding_tokens.append(image_padding_token)
-                
-            self.text_tokenizer.add_special_tokens(
-                special_token
-            )
-            self.text_tokenizer.pad_token_id = 0
-            self.text_tokenizer.bos_token_id = 1
-            self.text_tokenizer.eos_token_id = 2
 
         # Initialize empty lists for dataset tracking
         self.data_whole_2D = []
@@ -368,7 +353,9 @@ class multi_dataset(Dataset):
         answer = sample["answer"]
         
         # Process text and images together
-        images, question, answer = self.text_add_image(images, question, answer)
+        images, question, answer, question_segments, answer_segments = text_add_image(
+            images, question, answer, self.image_padding_tokens, return_segments=True
+        )
         
         # Stack images into a single tensor
         try:
@@ -378,8 +365,10 @@ class multi_dataset(Dataset):
         
         # Tokenize combined question and answer text
         self.text_tokenizer.padding_side = "right"
-        text_tensor = self.text_tokenizer(
-            question + ' ' + answer, max_length=self.max_seq, truncation=True, padding="max_length", return_tensors="pt"
+        # Same as tokenizing question + ' ' + answer, the image token ids are not run through the tokenizer
+        text_ids = segment_input_ids(self.text_tokenizer, question_segments + [' '] + answer_segments, self.image_padding_tokens)
+        text_tensor = self.text_tokenizer.prepare_for_model(
+            text_ids, max_length=self.max_seq, truncation=True, padding="max_length", return_tensors="pt", prepend_batch_axis=True
         )
         lang_x = text_tensor["input_ids"][0]
         attention_mask = text_tensor["attention_mask"][0]
@@ -402,11 +391,9 @@ class multi_dataset(Dataset):
         else:
             key_embeddings = []
             
-        # Tokenize question to determine its length
-        question_tensor = self.text_tokenizer(
-            question, max_length=self.max_seq, truncation=True, padding="max_length", return_tensors="pt"
-        )
-        question_length = torch.sum(question_tensor["attention_mask"][0])
+        # Question length in tokens (with special tokens, truncated), the sum of its attention mask
+        question_ids = segment_input_ids(self.text_tokenizer, question_segments, self.image_padding_tokens)
+        question_length = min(len(question_ids) + self.text_tokenizer.num_special_tokens_to_add(), self.max_seq)
         
         # Create labels for training (ignore question tokens, padding, and special tokens)
         labels = lang_x.clone()
@@ -443,63 +430,7 @@ class multi_dataset(Dataset):
         Returns:
             Tuple of (processed_images, question_with_image_tokens, answer_with_image_tokens)
         """
-        ref_image = []
-        question = str(question)
-        answer = str(answer)
-        
-        # Initialize lists to track image insertion positions
-        question_list = [[] for _ in range(len(str(question)))]
-        answer_list = [[] for _ in range(len(str(answer)))]
-        
-        # Process each image and its position
-        for index, image in enumerate(images):
-            ref_image.append(image["image"])
-            position = image["position"]
-            position = list(position.items())[0]
-            
-            # Store image indices at their insertion positions
-            if position[0] == 'question':
-                insert_loc = position[1] - 1
-                if insert_loc < 0:
-                    insert_loc = 0
-                question_list[insert_loc].append(index)
-            if position[0] == 'answer':
-                insert_loc = position[1] - 1
-                if insert_loc < 0:
-                    insert_loc = 0
-                answer_list[insert_loc].append(index)
-                
-        # Build new question text with image tokens
-        new_question = ''
-        new_answer = ''
-        question = str(question)
-        for char_i in range(len(question)):
-            if question_list[char_i] == []:
-                new_question = new_question + question[char_i]
-            if question_list[char_i] != []:
-                for img_index in question_list[char_i]:
-                    try:
-                        new_question = new_question + '<image>' + self.image_padding_tokens[img_index] + '</image>'
-                    except:
-                        print("Error: out of max image input size")
-                new_question = new_question + question[char_i]
-                
-        # Build new answer text with image tokens
-        answer = str(answer)
-        for char_i in range(len(str(answer))):
-            if answer_list[char_i] == []:
-                new_answer = new_answer + answer[char_i]
-            if answer_list[char_i] != []:
-                for img_index in answer_list[char_i]:
-                    try:
-                        new_answer = new_answer + '<image>' + self.image_padding_tokens[img_index] + '</image>'
-                    except:
-                        print("Error: out of max image input size")
-                new_answer = new_answer + answer[char_i]
-                
-        # Remove bullet points for cleaner text
-        new_answer = new_answer.replace('•', '')
-        return ref_image, new_question, new_answer
+        return text_add_image(images, question, answer, self.image_padding_tokens)
                 
         
         
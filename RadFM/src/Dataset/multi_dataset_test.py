@@ -13,8 +13,11 @@ import json
 from PIL import Image
 import math
 import torchvision
-from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from .dataset import *
+from .tokenization import build_text_tokenizer, text_add_image
+from .volume_cache import VolumeCache
+from .volume_shards import ShardReader
 
 
 def stack_images(images):
@@ -56,15 +59,20 @@ def stack_images(images):
     # Process each image to the target dimensions
     stack_images = []
     for s in images:
-        s = torch.tensor(s)
+        s = torch.as_tensor(s)
         if len(s.shape) == 3:
             # For 2D images, add depth dimension
             stack_images.append(torch.nn.functional.interpolate(s.unsqueeze(0).unsqueeze(-1), size=(target_H, target_W, target_D)))
+        elif tuple(s.shape[-3:]) == (target_H, target_W, target_D):
+            # Volumes from the volume cache are already resized (nearest interpolation to the same size is a copy)
+            stack_images.append(s.unsqueeze(0))
         else:
             # For 3D images
             stack_images.append(torch.nn.functional.interpolate(s.unsqueeze(0), size=(target_H, target_W, target_D)))
     
     # Concatenate all processed images
+    if len(stack_images) == 1:
+        return stack_images[0]
     images = torch.cat(stack_images, dim=0)
     return images
 
@@ -72,7 +80,7 @@ class multi_dataset(Dataset):
     """
     Dataset class for testing multimodal models on different medical imaging tasks
     """
-    def __init__(self, text_tokenizer, file_path=None, test_split='close', max_seq=2048, max_img_size=10, image_num=32, voc_size=32000):
+    def __init__(self, text_tokenizer, file_path=None, test_split='close', max_seq=2048, max_img_size=10, image_num=32, voc_size=32000, use_fast_tokenizer=False, volume_cache=None, volume_stats=None, volume_shards=None):
         """
         Initialize the test dataset
         
@@ -83,6 +91,10 @@ class multi_dataset(Dataset):
             max_img_size: Maximum number of images to process
             image_num: Number of image tokens per image
             voc_size: Vocabulary size
+            use_fast_tokenizer: Build the fast (Rust) tokenizer when text_tokenizer is a path
+            volume_cache: Directory of pre-resized 3D-RAD volumes (Dataset/volume_cache.py), None reads the original volumes
+            volume_stats: Normalization stats of the 3D-RAD volumes (Dataset/volume_stats.py)
+            volume_shards: Directory of packed 3D-RAD volumes (Dataset/volume_shards.py)
         """
         self.text_tokenizer = text_tokenizer
         self.max_img_size = max_img_size
@@ -96,28 +108,9 @@ class multi_dataset(Dataset):
         
         # Initialize tokenizer with special tokens for images
         if isinstance(self.text_tokenizer, str):
-            self.text_tokenizer = LlamaTokenizer.from_pretrained(
-                self.text_tokenizer,
+            self.text_tokenizer, self.image_padding_tokens = build_text_tokenizer(
+                self.text_tokenizer, max_img_size, image_num, use_fast=use_fast_tokenizer,
             )
-            special_token = {"additional_special_tokens": ["<image>", "</image>"]}
-            
-            # Create special tokens for each image position and patch
-            for i in range(max_img_size):
-                image_padding_token = ""
-                for j in range(image_num):
-                    image_token = "<image" + str(i * image_num + j) + ">"
-                    image_padding_token = image_padding_token + image_token
-                    special_token["additional_special_tokens"].append("<image" + str(i * image_num + j) + ">")
-                self.image_padding_tokens.append(image_padding_token)
-                
-            # Add special tokens to tokenizer
-            self.text_tokenizer.add_special_tokens(
-                special_token
-            )
-            # Set standard special tokens for LLaMA
-            self.text_tokenizer.pad_token_id = 0
-            self.text_tokenizer.bos_token_id = 1
-            self.text_tokenizer.eos_token_id = 2
 
         # Initialize dataset tracking variables
         self.data_whole_2D = []
@@ -271,7 +264,8 @@ class multi_dataset(Dataset):
             print('radiofeatures_dataset loaded')
 
         if self.test_split == '3drad':
-            rad_dataset = RAD_Dataset(file_path)
+            rad_dataset = RAD_Dataset(file_path, volume_cache=VolumeCache(volume_cache) if volume_cache else None, volume_stats=volume_stats,
+                                      volume_shards=ShardReader(volume_shards) if volume_shards else None)
             self.dataset_reflect['rad_dataset'] = rad_dataset
             self.data_whole_3D = self.data_whole_3D + [{'rad_dataset': i} for i in range(len(rad_dataset))]
             self.data_ours = [{'rad_dataset': i} for i in range(len(rad_dataset))]
@@ -336,6 +330,7 @@ class multi_dataset(Dataset):
             'question': question, 
             'answer': answer, 
             'belong_to': belong_to,
+            'index': idx,
         }
     
     def text_add_image(self, images, question, answer):
@@ -350,58 +345,7 @@ class multi_dataset(Dataset):
         Returns:
             Tuple of (processed_images, question_with_image_tokens, answer_with_image_tokens)
         """
-        ref_image = []
-        # Initialize lists to track image insertion positions
-        question_list = [[] for _ in range(len(str(question)))]
-        answer_list = [[] for _ in range(len(str(answer)))]
-        
-        # Process each image and its position
-        for index, image in enumerate(images):
-            ref_image.append(image["image"])
-            position = image["position"]
-            position = list(position.items())[0]
-            
-            # Record image indices at their insertion positions
-            if position[0] == 'question':
-                insert_loc = position[1] - 1
-                if insert_loc < 0:
-                    insert_loc = 0
-                question_list[insert_loc].append(index)
-            if position[0] == 'answer':
-                insert_loc = position[1] - 1
-                if insert_loc < 0:
-                    insert_loc = 0
-                answer_list[insert_loc].append(index)
-                
-        # Build new question text with image tokens
-        new_question = ''
-        new_answer = ''
-        for char_i in range(len(question)):
-            if question_list[char_i] == []:
-                new_question = new_question + question[char_i]
-            if question_list[char_i] != []:
-                for img_index in question_list[char_i]:
-                    try:
-                        new_question = new_question + '<image>' + self.image_padding_tokens[img_index] + '</image>'
-                    except:
-                        print("Error: out of max image input size")
-                new_question = new_question + question[char_i]
-        
-        # Build new answer text with image tokens
-        for char_i in range(len(answer)):
-            if answer_list[char_i] == []:
-                new_answer = new_answer + answer[char_i]
-            if answer_list[char_i] != []:
-                for img_index in answer_list[char_i]:
-                    try:
-                        new_answer = new_answer + '<image>' + self.image_padding_tokens[img_index] + '</image>'
-                    except:
-                        print("Error: out of max image input size")
-                new_answer = new_answer + answer[char_i]
-        
-        # Clean up text formatting
-        new_answer = new_answer.replace('•', '')
-        return ref_image, new_question, new_answer
+        return text_add_image(images, question, answer, self.image_padding_tokens)
                 
         
         
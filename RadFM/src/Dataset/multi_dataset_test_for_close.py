@@ -12,8 +12,9 @@ import json
 from PIL import Image
 import math
 import torchvision
-from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from .dataset import *
+from .tokenization import build_text_tokenizer, text_add_image
 
 
 def find_position(label, key_embeddings):
@@ -59,7 +60,7 @@ def stack_images(images):
     return images
 
 class multi_dataset_close(Dataset):
-    def __init__(self, text_tokenizer, test_split = 'close', max_seq = 2048, max_img_size = 10, image_num=32,voc_size =32000, down_sample_ratio = 100):
+    def __init__(self, text_tokenizer, test_split = 'close', max_seq = 2048, max_img_size = 10, image_num=32,voc_size =32000, down_sample_ratio = 100, use_fast_tokenizer=False):
         
         self.down_sample_ratio = down_sample_ratio
         self.text_tokenizer = text_tokenizer
@@ -70,24 +71,10 @@ class multi_dataset_close(Dataset):
         self.H = 512
         self.W = 512
         self.image_padding_tokens = []
-        if isinstance(self.text_tokenizer,str):
-            self.text_tokenizer = LlamaTokenizer.from_pretrained(
-                self.text_tokenizer,
+        if isinstance(self.text_tokenizer, str):
+            self.text_tokenizer, self.image_padding_tokens = build_text_tokenizer(
+                self.text_tokenizer, max_img_size, image_num, use_fast=use_fast_tokenizer,
             )
-            special_token = {"additional_special_tokens": ["<image>","</image>"]}
-            for i in range(max_img_size):
-                image_padding_token = ""
-                for j in range(image_num):
-                    image_token = "<image"+str(i*image_num+j)+">"
-                    image_padding_token = image_padding_token + image_token
-                    special_token["additional_special_tokens"].append("<image"+str(i*image_num+j)+">")
-                self.image_padding_tokens.append(image_padding_token)
-            self.text_tokenizer.add_special_tokens(
-                special_token
-            )
-            self.text_tokenizer.pad_token_id = 0
-            self.text_tokenizer.bos_token_id = 1
-            self.text_tokenizer.eos_token_id = 2
 
 
         self.data_whole_2D = []
@@ -244,52 +231,8 @@ class multi_dataset_close(Dataset):
         # print(labels,key_embeddings,reweight_tensor)
         return {'vision_x': vision_x,'lang_x':lang_x, 'attention_mask': attention_mask, 'labels':labels, 'loss_reweight': reweight_tensor, 'key_words_query': emphasize_words}
     
-    def text_add_image(self,images,question,answer):
-        question = str(question)
-        answer = str(answer)
-        ref_image = []
-        question_list = [[] for _ in range(len(str(question)))]
-        answer_list = [[] for _ in range(len(str(answer)))]
-        for index, image in enumerate(images):
-            ref_image.append(image["image"])
-            position = image["position"]
-            position = list(position.items())[0]
-            if position[0] == 'question':
-                insert_loc = position[1] -1
-                if insert_loc < 0:
-                    insert_loc = 0
-                question_list[insert_loc].append(index)
-            if position[0] == 'answer':
-                insert_loc = position[1] -1
-                if insert_loc < 0:
-                    insert_loc = 0
-                answer_list[insert_loc].append(index)
-        new_question = ''
-        new_answer = ''
-        for char_i in range(len(question)):
-            if question_list[char_i] == []:
-                new_question = new_question + question[char_i]
-            if question_list[char_i] != []:
-                for img_index in question_list[char_i]:
-                    try:
-                        new_question = new_question + '<image>' + self.image_padding_tokens[img_index] + '</image>'
-                    except:
-                        print("Error: out of max image input size")
-                new_question = new_question + question[char_i]
-        
-        for char_i in range(len(answer)):
-            if answer_list[char_i] == []:
-                new_answer = new_answer + answer[char_i]
-            if answer_list[char_i] != []:
-                for img_index in answer_list[char_i]:
-                    try:
-                        new_answer = new_answer + '<image>' + self.image_padding_tokens[img_index] + '</image>'
-                    except:
-                        print("Error: out of max image input size")
-                new_answer = new_answer + answer[char_i]
-                
-        new_answer = new_answer.replace('•','')
-        return ref_image,new_question,new_answer
+    def text_add_image(self, images, question, answer):
+        return text_add_image(images, question, answer, self.image_padding_tokens)
                 
         
         
@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+
+import transformers
+from transformers import LlamaTokenizer, LlamaTokenizerFast
+
+
+# Augmented tokenizers are saved here, RADFM_TOKENIZER_CACHE overrides it.
+DEFAULT_CACHE_DIR = os.environ.get(
+    "RADFM_TOKENIZER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "radfm", "tokenizers")
+)
+
+_IMAGE_TOKEN_RE = re.compile(r'<image\d+>')
+
+
+def image_padding_tokens(max_img_size, image_num):
+    """Token string of every image slot: "<image{i*image_num}>...<image{i*image_num+image_num-1}>"."""
+    return ["".join("<image" + str(i * image_num + j) + ">" for j in range(image_num)) for i in range(max_img_size)]
+
+
+def tokenizer_cache_path(cache_dir, tokenizer_path, max_img_size, image_num, use_fast=False):
+    # One directory per (base tokenizer, image slots, tokens per image, slow/fast, transformers version).
+    base = os.path.abspath(tokenizer_path) if os.path.isdir(tokenizer_path) else tokenizer_path
+    key = json.dumps([base, max_img_size, image_num, "fast" if use_fast else "slow", transformers.__version__])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+
+def _set_special_token_ids(text_tokenizer):
+    text_tokenizer.pad_token_id = 0
+    text_tokenizer.bos_token_id = 1
+    text_tokenizer.eos_token_id = 2
+
+
+def _augment_tokenizer(tokenizer_path, max_img_size, image_num, use_fast):
+    if use_fast:
+        # The RadFM tokenizer config has empty bos/eos/unk strings, the fast tokenizer needs the real ones
+        # to build its post-processor. They are the same tokens as the ids set below. LlamaTokenizerFast
+        # pads on the left by default, the slow tokenizer on the right.
+        text_tokenizer = LlamaTokenizerFast.from_pretrained(
+            tokenizer_path, bos_token="<s>", eos_token="</s>", unk_token="<unk>", padding_side="right",
+        )
+    else:
+        text_tokenizer = LlamaTokenizer.from_pretrained(
+            tokenizer_path,
+        )
+    # All image tokens in a single call: every add_special_tokens call rebuilds the added-token trie.
+    special_token = {"additional_special_tokens": ["<image>", "</image>"]}
+    special_token["additional_special_tokens"] += ["<image" + str(i) + ">" for i in range(max_img_size * image_num)]
+    text_tokenizer.add_special_tokens(
+        special_token
+    )
+    _set_special_token_ids(text_tokenizer)
+    return text_tokenizer
+
+
+def build_text_tokenizer(tokenizer_path, max_img_size, image_num, use_fast=False, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    LLaMA tokenizer with the <image>, </image> and <image0>..<imageN> special tokens.
+
+    The augmented tokenizer is built once and saved under cache_dir (None disables the cache); later calls with
+    the same base tokenizer, max_img_size and image_num load it from there. use_fast=True builds the Rust tokenizer
+    from the same SentencePiece model, which gives the same ids (check with tokenizer_parity.py).
+    Returns the tokenizer and the padding string of every image slot.
+    """
+    if cache_dir is None:
+        return _augment_tokenizer(tokenizer_path, max_img_size, image_num, use_fast), \
+            image_padding_tokens(max_img_size, image_num)
+
+    path = tokenizer_cache_path(cache_dir, tokenizer_path, max_img_size, image_num, use_fast)
+    if os.path.exists(os.path.join(path, "tokenizer_config.json")):
+        if use_fast:
+            # The saved config has add_prefix_space set, which would convert the slow tokenizer again instead of
+            # reading the saved tokenizer.json. The image tokens are already in tokenizer.json, re-registering
+            # them from the config's added_tokens_decoder is quadratic in their number.
+            text_tokenizer = LlamaTokenizerFast.from_pretrained(path, add_prefix_space=None, added_tokens_decoder={})
+        else:
+            text_tokenizer = LlamaTokenizer.from_pretrained(path)
+        _set_special_token_ids(text_tokenizer)
+        return text_tokenizer, image_padding_tokens(max_img_size, image_num)
+
+    text_tokenizer = _augment_tokenizer(tokenizer_path, max_img_size, image_num, use_fast)
+    # Saved to a temporary directory and renamed, a concurrent builder that loses the race just drops its copy.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        text_tokenizer.save_pretrained(tmp_path)
+        os.rename(tmp_path, path)
+    except OSError as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(path):
+            print(f"Could not cache the tokenizer in {cache_dir}: {e}")
+    return text_tokenizer, image_padding_tokens(max_img_size, image_num)
+
+
+def text_add_image(images, question, answer, image_padding_tokens, return_segments=False):
+    """
+    Insert the image tokens of every image into the question or answer, as RadFM datasets do.
+
+    An image at {"question": p} (or "answer") goes before character max(p - 1, 0) of that text, images at the same
+    offset in list order; an image without a padding slot is skipped with a message and an offset past the end
+    raises IndexError. '•' is removed from the answer. The texts are cut at the sorted offsets and joined once.
+
+    Returns (images, question, answer) and, with return_segments=True, also the question and answer as segments:
+    text pieces (str) and image slot indices (int), for segment_input_ids.
+    """
+    question = str(question)
+    answer = str(answer)
+    ref_image = []
+    insertions = {'question': [], 'answer': []}
+    for index, image in enumerate(images):
+        ref_image.append(image["image"])
+        target, position = list(image["position"].items())[0]
+        if target in insertions:
+            insertions[target].append((max(position - 1, 0), index))
+
+    question_segments = _image_segments(question, insertions['question'], image_padding_tokens)
+    answer_segments = [s.replace('•', '') if isinstance(s, str) else s
+                       for s in _image_segments(answer, insertions['answer'], image_padding_tokens)]
+    new_question = segments_to_text(question_segments, image_padding_tokens)
+    new_answer = segments_to_text(answer_segments, image_padding_tokens)
+    if return_segments:
+        return ref_image, new_question, new_answer, question_segments, answer_segments
+    return ref_image, new_question, new_answer
+
+
+def _image_segments(text, insertions, image_padding_tokens):
+    segments = []
+    start = 0
+    for offset, index in sorted(insertions):
+        if offset >= len(text):
+            raise IndexError(f"image position {offset + 1} is past the end of a text of length {len(text)}")
+        if offset > start:
+            segments.append(text[start:offset])
+            start = offset
+        if index < len(image_padding_tokens):
+            segments.append(index)
+        else:
+            print("Error: out of max image input size")
+    if start < len(text):
+        segments.append(text[start:])
+    return segments
+
+
+def segments_to_text(segments, image_padding_tokens):
+    return "".join(s if isinstance(s, str) else '<image>' + image_padding_tokens[s] + '</image>' for s in segments)
+
+
+def segment_input_ids(text_tokenizer, segments, image_padding_tokens):
+    """
+    Same ids as text_tokenizer(segments_to_text(segments), add_special_tokens=False)["input_ids"].
+
+    The image tokens are special tokens, so the slow tokenizer splits the text at them and tokenizes every text
+    piece on its own: only the text pieces go through the tokenizer, the image ids are looked up. Fast tokenizers
+    tokenize the joined text, as does the non-legacy slow LLaMA tokenizer, which treats the first piece differently.
+    """
+    if getattr(text_tokenizer, "is_fast", False) or getattr(text_tokenizer, "legacy", True) is False:
+        return text_tokenizer(segments_to_text(segments, image_padding_tokens), add_special_tokens=False)["input_ids"]
+    ids = []
+    text = ""
+    for segment in segments:
+        if isinstance(segment, str):
+            text += segment
+            continue
+        if text:
+            ids += text_tokenizer(text, add_special_tokens=False)["input_ids"]
+            text = ""
+        ids += text_tokenizer.convert_tokens_to_ids(['<image>'] + _IMAGE_TOKEN_RE.findall(image_padding_tokens[segment]) + ['</image>'])
+    if text:
+        ids += text_tokenizer(text, add_special_tokens=False)["input_ids"]
+    return ids
@@ -0,0 +1,158 @@
+"""
+Pre-resized 3D-RAD volumes, so the datasets and the collator do not interpolate every volume on every question.
+
+    python -m Dataset.volume_cache --valid_path ../../valid_path.csv --rad_root ../../3DRAD --cache_dir ../../3DRAD/volume_cache
+
+Every volume is normalized as RAD_Dataset does and resized once with the nearest interpolation of stack_images
+(512 x 512 x the depth it picks). The volumes are saved as float16 .npy files and read back memory-mapped, so
+stack_images and the collators only stack them; index.csv maps (VolumeName, H, W) to the depth and file.
+"""
+import os
+import csv
+import glob
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import torch
+
+from .dataset.rad_dataset import load_volume
+
+
+INDEX_NAME = "index.csv"
+INDEX_COLUMNS = ["VolumeName", "H", "W", "D", "File"]
+D_LIST = list(range(4, 65, 4))
+
+
+def target_depth(max_d, d_list=D_LIST, target_d=4):
+    """Depth of d_list closest to max_d (the first one on ties), as stack_images and the collators pick it."""
+    for temp_d in d_list:
+        if abs(temp_d - max_d) < abs(target_d - max_d):
+            target_d = temp_d
+    return target_d
+
+
+def resize_volume(image, size):
+    """stack_images resize of one [C, H, W, D] volume, returns [C, *size]."""
+    if tuple(image.shape[-3:]) == tuple(size):
+        return image
+    return torch.nn.functional.interpolate(image.unsqueeze(0), size=size)[0]
+
+
+class VolumeCache:
+    """
+    Read side of the cache: get() returns the [C, H, W, D] float16 tensor of a volume, or None when it is not cached.
+
+    The tensor wraps a copy-on-write memory map, pages are read on first access and shared between the DataLoader
+    workers through the page cache.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index = {}
+        path = os.path.join(cache_dir, INDEX_NAME)
+        if os.path.exists(path):
+            for row in read_index(path):
+                self.index[(row['VolumeName'], int(row['H']), int(row['W']))] = (int(row['D']), row['File'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, volume_name, H=512, W=512):
+        entry = self.index.get((volume_name, H, W))
+        if entry is None:
+            return None
+        return torch.from_numpy(np.load(os.path.join(self.cache_dir, entry[1]), mmap_mode='c'))
+
+
+def read_index(path):
+    with open(path, mode='r', encoding="utf-8", newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def write_index(path, rows):
+    # Written to a temporary file and renamed, readers never see a half-written index.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode='w', encoding="utf-8", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def cache_file_name(volume_name, H, W, D):
+    return os.path.join(f"{H}x{W}", f"{volume_name}_{H}x{W}x{D}.npy")
+
+
+def cache_volume(task):
+    """Normalize, resize and save one volume. Returns its index rows, none for volumes that contain NaN."""
+    volume_name, img_path, cache_dir = task
+    image = load_volume(img_path)
+    if image is None:
+        # RAD_Dataset replaces these by random noise on every read, they stay uncached.
+        return []
+    image = torch.from_numpy(image).float()
+    D = target_depth(max(image.shape[3], 4)) if image.dim() > 3 else 4
+    if image.dim() == 3:
+        image = image.unsqueeze(-1)
+
+    H = W = 512
+    volume = resize_volume(image, (H, W, D))
+    file_name = cache_file_name(volume_name, H, W, D)
+    path = os.path.join(cache_dir, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, volume.to(torch.float16).numpy())
+    os.replace(tmp_path, path)
+    return [{'VolumeName': volume_name, 'H': H, 'W': W, 'D': D, 'File': file_name}]
+
+
+def rad_volume_names(rad_root, splits):
+    names = set()
+    for split in splits:
+        for path in glob.glob(os.path.join(rad_root, split, 'Task*', '**', '*.csv'), recursive=True):
+            names.update(pd.read_csv(path, usecols=['VolumeName'])['VolumeName'])
+    return sorted(names)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Pre-resize the 3D-RAD volumes into a float16 memory-mapped cache.")
+    parser.add_argument('--valid_path', type=str, default="../../valid_path.csv")
+    parser.add_argument('--rad_root', type=str, default="../../3DRAD")
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "test"])
+    parser.add_argument('--cache_dir', type=str, default="../../3DRAD/volume_cache")
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    paths = pd.read_csv(args.valid_path).set_index('VolumeName')['Path']
+    cache = VolumeCache(args.cache_dir)
+    rows = [{'VolumeName': name, 'H': H, 'W': W, 'D': D, 'File': file_name}
+            for (name, H, W), (D, file_name) in cache.index.items()]
+
+    tasks = []
+    for name in rad_volume_names(args.rad_root, args.splits):
+        if (name, 512, 512) not in cache:
+            tasks.append((name, paths[name], args.cache_dir))
+    print(f"{len(tasks)} volumes to cache, {len(cache)} entries already in {args.cache_dir}")
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    skipped = 0
+    with multiprocessing.Pool(args.num_workers) as pool:
+        for i, volume_rows in enumerate(pool.imap_unordered(cache_volume, tasks), 1):
+            skipped += not volume_rows
+            rows.extend(volume_rows)
+            if i % 100 == 0 or i == len(tasks):
+                write_index(os.path.join(args.cache_dir, INDEX_NAME), rows)
+                print(f"{i}/{len(tasks)} volumes")
+    if skipped:
+        print(f"{skipped} volumes contain NaN and are read from the original files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Storage codecs of the volume shards (volume_shards.py).
+
+    raw      the array as it is, read back zero-copy
+    float16  half precision, 2x smaller than float32
+    uint8    (x - min) / scale rounded to 0..255, 4x smaller than float32, max error scale / 2
+
+Any codec can be combined with zstd compression (pip install zstandard) of fixed-size blocks, so a volume is
+decompressed block by block into its output buffer. float16 and uint8 volumes are expanded back to float32 when
+they are read.
+"""
+import numpy as np
+import torch
+
+
+CODECS = ("raw", "float16", "uint8")
+COMPRESSIONS = (None, "zstd")
+BLOCK_SIZE = 1 << 20
+
+
+def _require_zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compressed volume shards need zstandard: pip install zstandard") from e
+    return zstandard
+
+
+def encode_volume(array, codec="raw", compression=None, level=3, block_size=BLOCK_SIZE):
+    """
+    Encode one volume. Returns the stored bytes as a list of chunks and the entry fields that describe them:
+    shape, dtype (of the stored array), codec, scale/min (uint8), compression and the compressed size of every block.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown volume codec {codec}, expected one of {CODECS}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown volume compression {compression}, expected one of {COMPRESSIONS}")
+    entry = {'shape': list(array.shape), 'codec': codec, 'compression': compression}
+    if codec == "float16":
+        stored = np.ascontiguousarray(array, dtype=np.float16)
+    elif codec == "uint8":
+        image_min, image_max = float(array.min()), float(array.max())
+        scale = (image_max - image_min) / 255 if image_max > image_min else 1.0
+        stored = np.rint((np.asarray(array, dtype=np.float64) - image_min) / scale).clip(0, 255).astype(np.uint8)
+        entry['scale'], entry['min'] = scale, image_min
+    else:
+        stored = np.ascontiguousarray(array)
+    entry['dtype'] = stored.dtype.str
+    entry['nbytes'] = stored.nbytes
+
+    data = memoryview(stored.reshape(-1)).cast("B")
+    if compression is None:
+        return [data], entry
+    compressor = _require_zstd().ZstdCompressor(level=level)
+    chunks = [compressor.compress(data[start:start + block_size]) for start in range(0, len(data), block_size)]
+    entry['blocks'] = [len(chunk) for chunk in chunks]
+    entry['block_size'] = block_size
+    return chunks, entry
+
+
+def decode_volume(buffer, entry):
+    """
+    Array of a shard entry from its stored bytes (a uint8 array). Uncompressed raw volumes are a view of buffer,
+    float16 and uint8 volumes are expanded to float32.
+    """
+    shape = tuple(entry['shape'])
+    dtype = np.dtype(entry['dtype'])
+    if entry.get('compression') is None:
+        stored = buffer[:entry['nbytes']]
+    else:
+        decompressor = _require_zstd().ZstdDecompressor()
+        stored = np.empty(entry['nbytes'], dtype=np.uint8)
+        start = position = 0
+        for size in entry['blocks']:
+            block = decompressor.decompress(buffer[position:position + size],
+                                            max_output_size=entry['block_size'])
+            stored[start:start + len(block)] = np.frombuffer(block, dtype=np.uint8)
+            start += len(block)
+            position += size
+    stored = stored.view(dtype).reshape(shape)
+
+    codec = entry.get('codec', "raw")
+    if codec == "float16":
+        # torch converts half to float several times faster than numpy, the values are the same.
+        return torch.from_numpy(stored).float().numpy()
+    if codec == "uint8":
+        volume = stored.astype(np.float32)
+        volume *= np.float32(entry['scale'])
+        volume += np.float32(entry['min'])
+        return volume
+    return stored
+
+
+def stored_size(entry):
+    """Bytes the entry takes in the shard, without alignment padding."""
+    return sum(entry['blocks']) if entry.get('compression') is not None else entry['nbytes']
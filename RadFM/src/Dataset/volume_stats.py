@@ -0,0 +1,50 @@
+"""
+Per-volume normalization stats for RAD_Dataset, so a question reads its volume once instead of four times
+(min, max, normalization and the NaN check).
+
+    python -m Dataset.volume_stats --valid_path ../../valid_path.csv --output ../../3DRAD/volume_stats.csv
+
+Rebuild it when the volumes change, stale stats give wrongly normalized volumes.
+"""
+import os
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from .dataset.rad_dataset import VOLUME_STATS_COLUMNS, volume_stats
+from .volume_cache import rad_volume_names
+
+
+def compute_stats(task):
+    volume_name, img_path = task
+    image_min, image_max, has_nan = volume_stats(np.load(img_path, mmap_mode='r'))
+    return {'VolumeName': volume_name, 'Min': image_min, 'Max': image_max, 'HasNaN': int(has_nan)}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Precompute the min/max and NaN flag of the 3D-RAD volumes.")
+    parser.add_argument('--valid_path', type=str, default="../../valid_path.csv")
+    parser.add_argument('--rad_root', type=str, default="../../3DRAD")
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "test"])
+    parser.add_argument('--output', type=str, default="../../3DRAD/volume_stats.csv")
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    paths = pd.read_csv(args.valid_path).set_index('VolumeName')['Path']
+    tasks = [(name, paths[name]) for name in rad_volume_names(args.rad_root, args.splits)]
+    with multiprocessing.Pool(args.num_workers) as pool:
+        rows = pool.map(compute_stats, tasks, chunksize=4)
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    pd.DataFrame(rows, columns=VOLUME_STATS_COLUMNS).to_csv(args.output, index=False)
+    print(f"{len(rows)} volumes, {sum(row['HasNaN'] for row in rows)} with NaN -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
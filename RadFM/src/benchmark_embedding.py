@@ -0,0 +1,127 @@
+"""
+CPU time and memory of the RadFM token embedding: the previous one-hot matmul against the gather/scatter
+multimodal_embedding used by MyEmbedding.
+
+    python benchmark_embedding.py --seq_lens 512 1024 2048 --batch_size 1 --dim 5120
+
+Only the embedding step is measured (no vision encoder): text/figure embedding [V + 2, D] and Perceiver outputs
+[B, S * 32, D] in, embeddings [B, L, D] out, forward and backward. Every run is a separate process so the peak RSS
+of one implementation does not hide the other's (peak RSS above the inputs, from /proc on Linux).
+"""
+import time
+import argparse
+import resource
+import multiprocessing
+
+import torch
+import torch.nn.functional as F
+
+from Model.RadFM.my_embedding_layer import multimodal_embedding
+
+
+def onehot_embedding(text_input, embedding_weight, vision_x):
+    # The previous MyEmbedding implementation.
+    B = vision_x.shape[0]
+    embedding_weight = embedding_weight.unsqueeze(0).repeat(B, 1, 1)
+    embedding_weight = torch.cat([embedding_weight, vision_x], dim=1)
+    text_input = F.one_hot(text_input, embedding_weight.shape[1]).to(vision_x.dtype).to(vision_x.device)
+    return torch.matmul(text_input, embedding_weight)
+
+
+IMPLEMENTATIONS = {'onehot': onehot_embedding, 'gather': multimodal_embedding}
+
+
+def make_inputs(batch_size, seq_len, dim, num_images, image_num=32, vocab_size=32000, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    num_text = vocab_size + 2
+    num_vision = num_images * image_num
+    embedding_weight = torch.randn(num_text, dim, generator=generator, requires_grad=True)
+    vision_x = torch.randn(batch_size, num_vision, dim, generator=generator, requires_grad=True)
+    # Text ids with the <imageN> ids of every image after the first token, as text_add_image places them.
+    text_input = torch.randint(0, num_text, (batch_size, seq_len), generator=generator)
+    text_input[:, 1:1 + num_vision] = num_text + torch.arange(num_vision)
+    return text_input, embedding_weight, vision_x
+
+
+def _rss_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+
+def _reset_peak_rss():
+    # Linux only: VmHWM (peak RSS) restarts from the current RSS, ru_maxrss cannot be reset.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def run(name, args, seq_len):
+    text_input, embedding_weight, vision_x = make_inputs(args.batch_size, seq_len, args.dim, args.num_images)
+    if _reset_peak_rss():
+        baseline, peak_rss = _rss_kb("VmRSS"), lambda: _rss_kb("VmHWM")
+    else:
+        baseline, peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+            lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(args.repeats):
+        embedding_weight.grad = None
+        vision_x.grad = None
+        start = time.perf_counter()
+        out_put = IMPLEMENTATIONS[name](text_input, embedding_weight, vision_x)
+        out_put.sum().backward()
+        times.append(time.perf_counter() - start)
+    return min(times), (peak_rss() - baseline) / 1024
+
+
+def _worker(queue, name, args, seq_len):
+    torch.set_num_threads(args.threads)
+    queue.put(run(name, args, seq_len))
+
+
+def check_equal(args, seq_len):
+    """Max abs difference of outputs and gradients between the two implementations."""
+    text_input, embedding_weight, vision_x = make_inputs(args.batch_size, seq_len, args.dim, args.num_images)
+    grad = torch.randn(args.batch_size, seq_len, args.dim, generator=torch.Generator().manual_seed(1))
+    results = []
+    for name in IMPLEMENTATIONS:
+        embedding_weight.grad = None
+        vision_x.grad = None
+        out_put = IMPLEMENTATIONS[name](text_input, embedding_weight, vision_x)
+        out_put.backward(grad)
+        results.append((out_put.detach(), embedding_weight.grad.clone(), vision_x.grad.clone()))
+    (out_a, weight_a, vision_a), (out_b, weight_b, vision_b) = results
+    return ((out_a - out_b).abs().max().item(), (weight_a - weight_b).abs().max().item(),
+            (vision_a - vision_b).abs().max().item())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RadFM token embedding on CPU.")
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[512, 1024, 2048])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--dim', type=int, default=5120)
+    parser.add_argument('--num_images', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'seq_len':>8} {'impl':>7} {'time (s)':>10} {'peak RSS (MB)':>14}")
+    for seq_len in args.seq_lens:
+        for name in IMPLEMENTATIONS:
+            queue = context.Queue()
+            process = context.Process(target=_worker, args=(queue, name, args, seq_len))
+            process.start()
+            seconds, megabytes = queue.get()
+            process.join()
+            print(f"{seq_len:>8} {name:>7} {seconds:>10.4f} {megabytes:>14.1f}")
+        out_diff, weight_diff, vision_diff = check_equal(args, seq_len)
+        print(f"{seq_len:>8} max abs diff: output {out_diff:.3g}, weight grad {weight_diff:.3g}, vision grad {vision_diff:.3g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,21 @@ import random
 import torch
 from Dataset.multi_dataset import multi_dataset
 
+def group_by_volume(volume_names):
+    """Indices with the questions about the same volume next to each other, volumes in order of first appearance."""
+    groups = {}
+    for i, name in enumerate(volume_names):
+        groups.setdefault(name, []).append(i)
+    return [i for indices in groups.values() for i in indices]
+
+
+def volume_reads(volume_names, order):
+    """Reads, volumes and reads per volume when the indices in order are visited, a volume read by the previous index is not read again."""
+    reads = sum(1 for k, i in enumerate(order) if k == 0 or volume_names[order[k - 1]] != volume_names[i])
+    volumes = len({volume_names[i] for i in order})
+    return reads, volumes, reads / max(volumes, 1)
+
+
 def make_batch(index_list, batch_size, drop_last):  
     if drop_last:
         batches = []
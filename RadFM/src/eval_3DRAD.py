@@ -1,17 +1,19 @@
 # Import necessary libraries for data processing, modeling, and utilities
-import tqdm.auto as tqdm
 import torch.nn.functional as F
 from typing import Optional, Dict, Sequence
-from typing import List, Optional, Tuple, Union
+from typing import List, Tuple, Union
 import transformers
 from My_Trainer.trainer import Trainer
 from dataclasses import dataclass, field
 from Dataset.multi_dataset_test import multi_dataset
 from Model.RadFM.multimodality_model import MultiLLaMAForCausalLM
-from datasampler import My_DistributedBatchSampler
+from datasampler import My_DistributedBatchSampler, group_by_volume, volume_reads
+from resumable_csv import ResumableCSVWriter, question_hash
+from decoding import get_decoding_profile, infer_task, stopping_criteria, truncate_at_stop
+from prefetch import Prefetcher
 import torch
-from torch.utils.data import DataLoader  
-import csv
+from torch.utils.data import DataLoader, Subset
+import os
 import random
 import numpy as np
 
@@ -39,6 +41,7 @@ class ModelArguments:
     """
     lang_encoder_path: Optional[str] = field(default="/home/cs/leijiayu/wuchaoyi/book_pretrain/Results/Book_mix_2048_13B_full/checkpoint-45800")
     tokenizer_path: str = field(default='/home/cs/leijiayu/wuchaoyi/Finetune_LLAMA/LLAMA_Model/tokenizer', metadata={"help": "Path to the tokenizer data."})   
+    use_fast_tokenizer: bool = field(default=False, metadata={"help": "Use the fast (Rust) tokenizer, check it with tokenizer_parity.py first."})
     #vision_encoder_path: str = field(default='/home/cs/leijiayu/wuchaoyi/multi_modal/src/PMC-CLIP/checkpoint.pt', metadata={"help": "Path to the vision_encoder."})   
     
 
@@ -51,6 +54,15 @@ class DataArguments:
     test_split: Optional[str] = field(default="3drad")
     file_path: Optional[str] = field(default="../../3DRAD/test/task6/b.csv")
     output_path: Optional[str] = field(default="../../3DRAD/radfm/task6/b.csv")
+    resume: bool = field(default=True, metadata={"help": "Skip the rows a previous (killed) run already wrote to output_path."})
+    decoding_profile: str = field(default="auto", metadata={"help": "auto (token budget and stop strings of the task), none or a profile name in decoding.py."})
+    task: Optional[str] = field(default=None, metadata={"help": "Task key (task1..task6), inferred from the file_path directory when not given."})
+    max_new_tokens: int = field(default=200, metadata={"help": "Token budget when decoding_profile is none."})
+    volume_cache: Optional[str] = field(default=None, metadata={"help": "Directory of pre-resized volumes built by python -m Dataset.volume_cache."})
+    volume_stats: Optional[str] = field(default=None, metadata={"help": "Volume normalization stats built by python -m Dataset.volume_stats."})
+    volume_shards: Optional[str] = field(default=None, metadata={"help": "Directory of packed volumes built by python -m Dataset.volume_shards."})
+    group_by_volume: bool = field(default=True, metadata={"help": "Evaluate the questions about the same volume one after the other instead of in file order."})
+    prefetch_depth: int = field(default=2, metadata={"help": "Samples tokenized and copied to the GPU ahead of the model on a background thread, 0 disables."})
     
 @dataclass
 class TrainingArguments(transformers.TrainingArguments):
@@ -117,7 +129,12 @@ class DataCollator(object):
                 target_D = temp_D
 
         # Resize all vision inputs to target dimensions
-        vision_xs = [torch.nn.functional.interpolate(s, size=(target_H, target_W, target_D)) for s in vision_xs]
+        # (pre-resized volumes that already have them are only stacked)
+        vision_xs = [
+            s if tuple(s.shape[-3:]) == (target_H, target_W, target_D)
+            else torch.nn.functional.interpolate(s, size=(target_H, target_W, target_D))
+            for s in vision_xs
+        ]
         
         # Pad sequence for variable-length vision inputs
         vision_xs = torch.nn.utils.rnn.pad_sequence(
@@ -146,19 +163,18 @@ def main():
     
     print("Setup Data")
     # Initialize test dataset with specified split
-    Test_dataset = multi_dataset(text_tokenizer=model_args.tokenizer_path, test_split=data_args.test_split)
+    Test_dataset = multi_dataset(text_tokenizer=model_args.tokenizer_path, file_path=data_args.file_path, test_split=data_args.test_split, use_fast_tokenizer=model_args.use_fast_tokenizer, volume_cache=data_args.volume_cache, volume_stats=data_args.volume_stats, volume_shards=data_args.volume_shards)
     
-    # Configure DataLoader for test dataset
-    Test_dataloader = DataLoader(
-            Test_dataset,
-            batch_size=1,
-            num_workers=1,
-            pin_memory=True,
-            sampler=None,
-            shuffle=True,
-            collate_fn=None,
-            drop_last=False,
-    )  
+    # Hash every question so that a resumed run only skips rows of the same test file
+    rad_dataset = Test_dataset.dataset_reflect['rad_dataset']
+    question_hashes = [
+        question_hash(rad_dataset.build_prompt(rad_dataset.data_list.iloc[i])[0]) for i in range(len(Test_dataset))
+    ]
+    
+    # Pick the token budget and stop strings of the task
+    task = data_args.task if data_args.task is not None else infer_task(data_args.file_path)
+    profile = get_decoding_profile(data_args.decoding_profile, task, data_args.max_new_tokens)
+    print(f"Decoding: max_new_tokens={profile['max_new_tokens']}, stop_strings={profile['stop_strings']}")
     
     print("Setup Model")
     # Initialize the multimodal model
@@ -173,39 +189,73 @@ def main():
     model = model.to('cuda')
     model.eval()  # Set model to evaluation mode
     
-    # Create output CSV file for results
-    with open('output_whole_2_epoch' + data_args.test_split + '.csv', mode='w') as outfile:
-        writer = csv.writer(outfile)
-        writer.writerow(["Question", "Ground Truth", "Pred", 'belong_to'])
-        cc = 0
+    # Create (or resume) the output CSV file for results
+    output_dir = os.path.dirname(data_args.output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with ResumableCSVWriter(data_args.output_path, ["Question", "Ground Truth", "Pred", 'belong_to'], resume=data_args.resume, question_hashes=question_hashes) as outfile:
+        indices = [i for i in range(len(Test_dataset)) if not outfile.is_done(i, question_hashes[i])]
+        if len(indices) < len(Test_dataset):
+            print(f"Resuming {data_args.output_path}: {len(Test_dataset) - len(indices)} rows done, {len(indices)} left")
+        
+        # Visit the questions about a volume together, so its pages are still cached when the next one reads it
+        all_volume_names = rad_dataset.data_list['VolumeName'].tolist()
+        volume_names = [all_volume_names[i] for i in indices]
+        order = group_by_volume(volume_names) if data_args.group_by_volume else list(range(len(indices)))
+        reads, volumes, per_volume = volume_reads(volume_names, order)
+        print(f"Volume reads: {reads} for {volumes} volumes ({per_volume:.2f} per volume)")
+        
+        # Configure DataLoader for the rows that are not done yet
+        Test_dataloader = DataLoader(
+                Subset(Test_dataset, [indices[i] for i in order]),
+                batch_size=1,
+                num_workers=1,
+                pin_memory=True,
+                sampler=None,
+                shuffle=False,
+                collate_fn=None,
+                drop_last=False,
+        )
+        
+        # Tokenize the question and copy the sample to the GPU on a background thread, ahead of the model
+        def tokenize_question(sample):
+            sample["lang_x"] = Test_dataset.text_tokenizer(
+                sample["question"], max_length=2048, truncation=True, return_tensors="pt"
+            )['input_ids']
+            return sample
+        prefetcher = Prefetcher(Test_dataloader, 'cuda', data_args.prefetch_depth, prepare=tokenize_question, keys=("vision_x", "lang_x"))
         
         # Process each sample in the test dataset
-        for sample in tqdm.tqdm(Test_dataloader):
+        for sample in prefetcher:
             question = sample["question"]
             belong_to = sample['belong_to']
+            index = int(sample['index'][0])
             # img_pp = sample['img_path']
             
-            # Tokenize the question text
-            lang_x = Test_dataset.text_tokenizer(
-                question, max_length=2048, truncation=True, return_tensors="pt"
-            )['input_ids'].to('cuda')
+            # Tokenized question, already on the GPU
+            lang_x = sample["lang_x"]
             
             # Get vision input
-            vision_x = sample["vision_x"].to('cuda')
+            # Cached volumes are float16, cast on the GPU
+            vision_x = sample["vision_x"].to('cuda').float()
             answer = sample['answer']
             
             try:
                 # Generate text based on text and vision inputs
-                generation = model.generate(lang_x, vision_x)
+                generation = model.generate(
+                    lang_x, vision_x, max_new_tokens=profile['max_new_tokens'],
+                    stopping_criteria=stopping_criteria(Test_dataset.text_tokenizer, profile)
+                )
                 generated_texts = Test_dataset.text_tokenizer.batch_decode(generation, skip_special_tokens=True) 
+                if profile['stop_strings']:
+                    generated_texts = [truncate_at_stop(text, profile['stop_strings']) for text in generated_texts]
                 
-                # Write results to CSV
-                writer.writerow([question, answer, generated_texts, belong_to])
-                cc = cc + 1
-                # if cc >= 10000:
-                #     break
+                # Write results to CSV, each row is fsynced so a killed job can resume after it
+                outfile.writerow([index, question_hashes[index], question, answer, generated_texts, belong_to])
+                outfile.flush()
             except:
                 continue
+        print(prefetcher.report())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
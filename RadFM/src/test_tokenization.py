@@ -0,0 +1,76 @@
+"""
+segment_input_ids against plain tokenizer calls, on a tiny SentencePiece LLaMA tokenizer trained in the test, so it
+runs without the RadFM Language_files. test_tokenizer_parity.py compares slow and fast tokenizers of the real files.
+"""
+import io
+
+import pytest
+
+from Dataset.tokenization import build_text_tokenizer, segment_input_ids, segments_to_text
+
+
+spm = pytest.importorskip("sentencepiece")
+
+MAX_IMG_SIZE = 2
+IMAGE_NUM = 4
+
+PROMPTS = [
+    ("What abnormality is seen in the left lung?", "Ground-glass opacity in the lower lobe."),
+    ("What is the diameter of the ascending aorta?", "38 mm"),
+    ("Is there  arterial wall calcification? Choices: A. Yes B. No", "A. Yes"),
+    ("How has the nodule changed since the previous scan (12.03.2021)? "
+     "Choices: A. Increased B. Decreased C. Stable D. Resolved", "C. Stable"),
+    ("Which lobe contains the 4x5 cm mass?\n", "Right upper lobe"),
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    corpus = [text for prompt in PROMPTS for text in prompt] * 4
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(corpus), model_writer=model, vocab_size=400, hard_vocab_limit=False,
+        model_type="bpe", byte_fallback=True, unk_id=0, bos_id=1, eos_id=2, pad_id=-1, minloglevel=2,
+    )
+    path = tmp_path_factory.mktemp("tokenizer")
+    (path / "tokenizer.model").write_bytes(model.getvalue())
+    return build_text_tokenizer(str(path), MAX_IMG_SIZE, IMAGE_NUM, cache_dir=None)
+
+
+def segment_lists(question, answer):
+    # The image before the question (slot 0, as in RAD_Dataset), inside it and after the answer (last slot).
+    middle = len(question) // 2
+    return [[0, question, ' ', answer], [question[:middle], 0, question[middle:], ' ', answer],
+            [question, ' ', answer, MAX_IMG_SIZE - 1], [answer]]
+
+
+def test_segment_ids_match_the_tokenizer(tokenizer):
+    text_tokenizer, image_padding_tokens = tokenizer
+    for question, answer in PROMPTS:
+        for segments in segment_lists(question, answer):
+            text = segments_to_text(segments, image_padding_tokens)
+            expected = text_tokenizer(text, add_special_tokens=False)['input_ids']
+            assert segment_input_ids(text_tokenizer, segments, image_padding_tokens) == expected
+
+
+def test_padded_ids_and_question_length(tokenizer):
+    # As the RadFM datasets build lang_x, attention_mask and question_length, including at the truncation boundary.
+    text_tokenizer, image_padding_tokens = tokenizer
+    for question, answer in PROMPTS:
+        question_segments = [0, question]
+        segments = question_segments + [' ', answer]
+        text = segments_to_text(segments, image_padding_tokens)
+        question_text = segments_to_text(question_segments, image_padding_tokens)
+        ids = segment_input_ids(text_tokenizer, segments, image_padding_tokens)
+        question_ids = segment_input_ids(text_tokenizer, question_segments, image_padding_tokens)
+        length = len(ids) + text_tokenizer.num_special_tokens_to_add()
+        question_length = len(question_ids) + text_tokenizer.num_special_tokens_to_add()
+        for max_seq in [2, IMAGE_NUM, question_length - 1, question_length, length - 1, length, length + 8]:
+            expected = text_tokenizer(text, max_length=max_seq, truncation=True, padding="max_length", return_tensors="pt")
+            encoded = text_tokenizer.prepare_for_model(
+                ids, max_length=max_seq, truncation=True, padding="max_length", return_tensors="pt", prepend_batch_axis=True
+            )
+            assert encoded['input_ids'].tolist() == expected['input_ids'].tolist()
+            assert encoded['attention_mask'].tolist() == expected['attention_mask'].tolist()
+            expected_question = text_tokenizer(question_text, max_length=max_seq, truncation=True)['attention_mask']
+            assert min(question_length, max_seq) == sum(expected_question)
@@ -0,0 +1,75 @@
+"""
+Slow vs fast RadFM tokenizer on a fixed set of 3D-RAD prompts.
+
+    RADFM_TOKENIZER_PATH=<Language_files> python -m pytest test_tokenizer_parity.py
+
+Skipped when RADFM_TOKENIZER_PATH is not set or has no tokenizer files. Run tokenizer_parity.py for the whole dataset.
+"""
+import os
+
+import pytest
+
+from Dataset.tokenization import build_text_tokenizer, segment_input_ids
+
+
+TOKENIZER_PATH = os.environ.get("RADFM_TOKENIZER_PATH")
+MAX_IMG_SIZE = 10
+IMAGE_NUM = 32
+MAX_SEQ = 2048
+
+# (question, answer) as RAD_Dataset renders them: open-ended, yes/no and four choices, plus spacing, digits and units.
+PROMPTS = [
+    ("What abnormality is seen in the left lung?", "Ground-glass opacity in the lower lobe."),
+    ("What is the diameter of the ascending aorta?", "38 mm"),
+    ("Is there  arterial wall calcification? Choices: A. Yes B. No", "A. Yes"),
+    ("How has the nodule changed since the previous scan (12.03.2021)? "
+     "Choices: A. Increased B. Decreased C. Stable D. Resolved", "C. Stable"),
+    ("Which lobe contains the 4x5 cm mass?\n", "Right upper lobe"),
+]
+
+
+def has_tokenizer_files(path):
+    return path is not None and os.path.isdir(path) and any(
+        os.path.exists(os.path.join(path, name)) for name in ("tokenizer.model", "tokenizer.json"))
+
+
+pytestmark = pytest.mark.skipif(not has_tokenizer_files(TOKENIZER_PATH),
+                                reason="set RADFM_TOKENIZER_PATH to a local directory with the LLaMA tokenizer files")
+
+
+@pytest.fixture(scope="module")
+def tokenizers():
+    slow, image_padding_tokens = build_text_tokenizer(TOKENIZER_PATH, MAX_IMG_SIZE, IMAGE_NUM, cache_dir=None)
+    fast, _ = build_text_tokenizer(TOKENIZER_PATH, MAX_IMG_SIZE, IMAGE_NUM, use_fast=True, cache_dir=None)
+    return slow, fast, image_padding_tokens
+
+
+def question_length(tokenizer, segments, image_padding_tokens):
+    # As in the RadFM datasets: with special tokens, truncated to MAX_SEQ.
+    ids = segment_input_ids(tokenizer, segments, image_padding_tokens)
+    return min(len(ids) + tokenizer.num_special_tokens_to_add(), MAX_SEQ)
+
+
+def test_special_token_ids(tokenizers):
+    slow, fast, _ = tokenizers
+    assert len(slow) == len(fast)
+    assert (slow.pad_token_id, slow.bos_token_id, slow.eos_token_id) == (fast.pad_token_id, fast.bos_token_id, fast.eos_token_id)
+
+
+def test_input_ids(tokenizers):
+    slow, fast, image_padding_tokens = tokenizers
+    for question, answer in PROMPTS:
+        # The image goes before the question (slot 0), as in RAD_Dataset, or at the end (last slot).
+        for segments in ([0, question, ' ', answer], [question, len(image_padding_tokens) - 1], [answer]):
+            slow_ids = slow.prepare_for_model(segment_input_ids(slow, segments, image_padding_tokens),
+                                              max_length=MAX_SEQ, truncation=True)["input_ids"]
+            fast_ids = fast.prepare_for_model(segment_input_ids(fast, segments, image_padding_tokens),
+                                              max_length=MAX_SEQ, truncation=True)["input_ids"]
+            assert slow_ids == fast_ids
+
+
+def test_question_lengths(tokenizers):
+    slow, fast, image_padding_tokens = tokenizers
+    for question, _ in PROMPTS:
+        segments = [0, question]
+        assert question_length(slow, segments, image_padding_tokens) == question_length(fast, segments, image_padding_tokens)
@@ -0,0 +1,71 @@
+"""
+Check that the fast RadFM tokenizer gives the same ids as the slow one on the 3D-RAD questions.
+
+    python tokenizer_parity.py --tokenizer_path <Language_files> --rad_root ../../3DRAD
+
+Exits with 1 when any text differs.
+"""
+import os
+import sys
+import glob
+import argparse
+
+import pandas as pd
+
+from Dataset.dataset.rad_dataset import RAD_Dataset
+from Dataset.tokenization import build_text_tokenizer
+
+
+def rad_corpus(rad_root, splits, max_per_subtask=None):
+    corpus = []
+    for split in splits:
+        for path in sorted(glob.glob(os.path.join(rad_root, split, 'Task*', '**', '*.csv'), recursive=True)):
+            df = pd.read_csv(path, nrows=max_per_subtask)
+            # build_prompt does not use the dataset state
+            corpus.extend(RAD_Dataset.build_prompt(None, row) for _, row in df.iterrows())
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tokenizer_path', type=str, required=True)
+    parser.add_argument('--rad_root', type=str, default="../../3DRAD")
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "test"])
+    parser.add_argument('--max_per_subtask', type=int, default=None)
+    parser.add_argument('--max_img_size', type=int, default=100, help="100 as in training, 10 as in the test datasets.")
+    parser.add_argument('--image_num', type=int, default=32)
+    parser.add_argument('--max_seq', type=int, default=2048)
+    args = parser.parse_args()
+
+    slow, image_padding_tokens = build_text_tokenizer(args.tokenizer_path, args.max_img_size, args.image_num)
+    fast, _ = build_text_tokenizer(args.tokenizer_path, args.max_img_size, args.image_num, use_fast=True)
+    assert len(slow) == len(fast), f"vocab size differs: slow {len(slow)}, fast {len(fast)}"
+    assert (slow.pad_token_id, slow.bos_token_id, slow.eos_token_id) == (fast.pad_token_id, fast.bos_token_id, fast.eos_token_id)
+
+    corpus = rad_corpus(args.rad_root, args.splits, args.max_per_subtask)
+    # The image goes before the question (position 0), as in RAD_Dataset
+    image = '<image>' + image_padding_tokens[0] + '</image>'
+    last_image = '<image>' + image_padding_tokens[-1] + '</image>'
+    texts = {
+        'question + answer': [image + question + ' ' + answer for question, answer in corpus],
+        'question': [image + question for question, _ in corpus],
+        'answer': [answer for _, answer in corpus],
+        'last image slot': [question + last_image for question, _ in corpus],
+    }
+
+    failed = False
+    for name, items in texts.items():
+        mismatches = [text for text in items
+                      if slow(text, max_length=args.max_seq, truncation=True)['input_ids']
+                      != fast(text, max_length=args.max_seq, truncation=True)['input_ids']]
+        print(f"{name}: {len(items) - len(mismatches)}/{len(items)} identical")
+        if mismatches:
+            failed = True
+            print("  first mismatch:", repr(mismatches[0][-200:]))
+            print("  slow:", slow.convert_ids_to_tokens(slow(mismatches[0])['input_ids'])[-20:])
+            print("  fast:", fast.convert_ids_to_tokens(fast(mismatches[0])['input_ids'])[-20:])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
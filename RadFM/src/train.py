@@ -39,6 +39,7 @@ class ModelArguments:
     lang_encoder_path: Optional[str] = field(default="/home/cs/leijiayu/wuchaoyi/book_pretrain/Results/Book_mix_2048_13B_full/checkpoint-45800")
     tokenizer_path: str = field(default='/home/cs/leijiayu/wuchaoyi/Finetune_LLAMA/LLAMA_Model/tokenizer', 
                                 metadata={"help": "Path to the tokenizer data."})   
+    use_fast_tokenizer: bool = field(default=False, metadata={"help": "Use the fast (Rust) tokenizer, check it with tokenizer_parity.py first."})
     
     
 
@@ -116,7 +117,12 @@ class DataCollator(object):
             target_W = 256
             
         # Resize all vision inputs to target dimensions
-        vision_xs = [torch.nn.functional.interpolate(s, size=(target_H, target_W, target_D)) for s in vision_xs]
+        # (pre-resized volumes that already have them are only stacked)
+        vision_xs = [
+            s if tuple(s.shape[-3:]) == (target_H, target_W, target_D)
+            else torch.nn.functional.interpolate(s, size=(target_H, target_W, target_D))
+            for s in vision_xs
+        ]
         
         # Pad sequence for variable-length vision inputs
         vision_xs = torch.nn.utils.rnn.pad_sequence(
@@ -148,8 +154,8 @@ def main():
     
     print("Setup Data")
     # Initialize training and evaluation datasets
-    Train_dataset = multi_dataset(text_tokenizer=model_args.tokenizer_path)
-    Eval_dataset = multi_dataset_close(text_tokenizer=model_args.tokenizer_path)
+    Train_dataset = multi_dataset(text_tokenizer=model_args.tokenizer_path, use_fast_tokenizer=model_args.use_fast_tokenizer)
+    Eval_dataset = multi_dataset_close(text_tokenizer=model_args.tokenizer_path, use_fast_tokenizer=model_args.use_fast_tokenizer)
     
     print("Setup Model")
     # Initialize the multimodal model
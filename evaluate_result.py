@@ -1,4 +1,6 @@
 import os
+import sys
+import argparse
 
 import numpy as np
 
@@ -7,6 +9,10 @@ import pandas as pd
 import json
 import evaluate
 
+# BLEU-1/ROUGE-1 kernels and the BERTScore embedding cache are shared with the M3D eval scripts.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'M3D'))
+from Bench.eval.text_metrics import corpus_bleu1, rouge1_scores
+
 model = '4b'
 path_dir = f"results/{model}"
 
@@ -22,9 +28,63 @@ TASK = {
         'task6': ['b', 'c', 'd', 'e', 'f', 'g', 'h'],
 }
 
-def evaluate_open_subtask(task, subtask):
-
-    print(f"-----------Evaluate {task} {subtask}------------")
+OPEN_TASKS = ['task1', 'task2', 'task3', 'task4']
+
+
+class MetricEngine:
+    """
+    Loads BERTScore once and scores the open-ended subtasks of a model in one pass.
+
+    BLEU-1 (corpus score of each subtask) and ROUGE-1 come from the offline kernels of M3D/Bench/eval/text_metrics.py,
+    with the values of evaluate's bleu (max_order=1) and rouge. BERTScore (no idf, no baseline rescaling) scores each
+    (pred, ref) pair independently, so it runs once over the unique pairs of all subtasks in large batches. ROUGE-1
+    is the exact mean of the per-row F1 instead of the bootstrap estimate of evaluate's aggregator, which can differ
+    in the 4th decimal.
+    """
+    def __init__(self, bert_batch_size=256, bertscore_cache_dir=None):
+        self.bert_batch_size = bert_batch_size
+        if bertscore_cache_dir is not None:
+            # Same embedding cache as the M3D eval scripts, strings scored there are not encoded again.
+            from Bench.eval.bertscore_cache import BERTScoreCache
+            self.bertscore = BERTScoreCache(bertscore_cache_dir)
+        else:
+            self.bertscore = evaluate.load('bertscore')
+
+    def score(self, subtasks):
+        """
+        subtasks: {(task, subtask): (preds, answers)}
+        Returns {(task, subtask): {"bleu", "rouge1", "f1"}}
+        """
+        all_preds = [p for preds, _ in subtasks.values() for p in preds]
+        all_answers = [a for _, answers in subtasks.values() for a in answers]
+
+        pairs = list(dict.fromkeys(zip(all_preds, all_answers)))
+        print(f"BERTScore over {len(pairs)} unique pairs ({len(all_preds)} rows)")
+        bert_f1 = {}
+        if pairs:
+            f1 = self.bertscore.compute(predictions=[p for p, _ in pairs], references=[[a] for _, a in pairs],
+                                        lang="en", batch_size=self.bert_batch_size)['f1']
+            bert_f1 = dict(zip(pairs, f1))
+            if hasattr(self.bertscore, "report"):
+                print(self.bertscore.report())
+
+        rouge1 = rouge1_scores(all_preds, all_answers)
+
+        results = {}
+        offset = 0
+        for key, (preds, answers) in subtasks.items():
+            n = len(preds)
+            # BLEU-1 is a corpus score of the subtask.
+            results[key] = {
+                "bleu": corpus_bleu1(preds, answers),
+                "rouge1": float(np.mean(rouge1[offset:offset + n])),
+                "f1": float(np.mean([bert_f1[pair] for pair in zip(preds, answers)])),
+            }
+            offset += n
+        return results
+
+
+def load_open_subtask(task, subtask):
     csv_path = f"{path_dir}/{task}/{subtask}/eval_open_vqa.csv"
 
     df = pd.read_csv(csv_path)
@@ -34,35 +94,37 @@ def evaluate_open_subtask(task, subtask):
 
     preds = [str(p).strip() for p in preds]
     answers = [str(a).strip() for a in answers]
+    return preds, answers
 
-    bleu = evaluate.load('bleu')
-    bleu_result = bleu.compute(predictions=preds, references=[[a] for a in answers], max_order=1)
-
-    rouge = evaluate.load('rouge')
-    rouge_result = rouge.compute(predictions=preds, references=[[a] for a in answers], rouge_types=['rouge1'])
-
-    bertscore = evaluate.load('bertscore')
-    bert_result = bertscore.compute(predictions=preds, references=[[a] for a in answers], lang="en")
 
+def save_open_subtask(task, subtask, results):
+    print(f"-----------Evaluate {task} {subtask}------------")
     print("Overall Metrics:")
-    print(f"BLEU-1: {bleu_result['bleu']:.4f}")
-    print(f"ROUGE-1: {rouge_result['rouge1']:.4f}")
-    print(f"BERTScore F1: {sum(bert_result['f1'])/len(bert_result['f1']):.4f}")
-
-    results = {
-        "bleu": bleu_result['bleu'],
-        "rouge1": rouge_result['rouge1'],
-        "f1": sum(bert_result['f1']) / len(bert_result['f1'])
-    }
+    print(f"BLEU-1: {results['bleu']:.4f}")
+    print(f"ROUGE-1: {results['rouge1']:.4f}")
+    print(f"BERTScore F1: {results['f1']:.4f}")
 
     result_path = f"{path_dir}/{task}/{subtask}/result.json"
 
     with open(result_path, 'w') as json_file:
         json.dump(results, json_file, indent=4)
 
+
+def evaluate_open_subtasks(subtask_keys, engine=None):
+    # Read every subtask CSV first, then score them all in one pass.
+    if engine is None:
+        engine = MetricEngine()
+    subtasks = {(task, subtask): load_open_subtask(task, subtask) for task, subtask in subtask_keys}
+    results = engine.score(subtasks)
+    for (task, subtask), result in results.items():
+        save_open_subtask(task, subtask, result)
     return results
 
 
+def evaluate_open_subtask(task, subtask, engine=None):
+    return evaluate_open_subtasks([(task, subtask)], engine)[(task, subtask)]
+
+
 def evaluate_close_subtask(task, subtask):
     print(f"-----------Evaluate {task} {subtask}------------")
     file_path = f"{path_dir}/{task}/{subtask}/eval_close_vqa.csv"
@@ -86,30 +148,30 @@ def evaluate_close_subtask(task, subtask):
 
     return results
 
-def evaluate_open_task(task):
-    bleus, rouge1s, f1s = [], [], []
-    for subtask in TASK[task]:
-        result = evaluate_open_subtask(task, subtask)
-        bleus.append(result["bleu"])
-        rouge1s.append(result["rouge1"])
-        f1s.append(result["f1"])
-    bleu = np.mean(np.array(bleus))
-    rouge1 = np.mean(np.array(rouge1s))
-    f1 = np.mean(np.array(f1s))
-    print(f"-----------Evaluate {task}------------")
-    print(f"Average Metrics {task}:")
-    print(f"BLEU-1: {bleu:.4f}")
-    print(f"ROUGE-1: {rouge1:.4f}")
-    print(f"BERTScore F1: {f1:.4f}")
-    results = {
-        "bleu": bleu,
-        "rouge1": rouge1,
-        "f1": f1
-    }
-
-    result_path = f"{path_dir}/{task}/result.json"
-    with open(result_path, 'w') as json_file:
-        json.dump(results, json_file, indent=4)
+def evaluate_open_tasks(tasks, engine=None):
+    results = evaluate_open_subtasks([(task, subtask) for task in tasks for subtask in TASK[task]], engine)
+    for task in tasks:
+        bleu = np.mean(np.array([results[(task, subtask)]["bleu"] for subtask in TASK[task]]))
+        rouge1 = np.mean(np.array([results[(task, subtask)]["rouge1"] for subtask in TASK[task]]))
+        f1 = np.mean(np.array([results[(task, subtask)]["f1"] for subtask in TASK[task]]))
+        print(f"-----------Evaluate {task}------------")
+        print(f"Average Metrics {task}:")
+        print(f"BLEU-1: {bleu:.4f}")
+        print(f"ROUGE-1: {rouge1:.4f}")
+        print(f"BERTScore F1: {f1:.4f}")
+        task_results = {
+            "bleu": bleu,
+            "rouge1": rouge1,
+            "f1": f1
+        }
+
+        result_path = f"{path_dir}/{task}/result.json"
+        with open(result_path, 'w') as json_file:
+            json.dump(task_results, json_file, indent=4)
+
+
+def evaluate_open_task(task, engine=None):
+    evaluate_open_tasks([task], engine)
 
 def evaluate_close_task(task):
     accs = []
@@ -128,21 +190,48 @@ def evaluate_close_task(task):
         json.dump(results, json_file, indent=4)
 
 
-def evaluate_task(task):
-    if task in ['task1', 'task2', 'task3', 'task4']:
-        evaluate_open_task(task)
+def evaluate_task(task, engine=None):
+    if task in OPEN_TASKS:
+        evaluate_open_task(task, engine)
     else:
         evaluate_close_task(task)
 
 
-def evaluate_subtask(task, subtask):
-    if task in ['task1', 'task2', 'task3', 'task4']:
-        evaluate_open_subtask(task, subtask)
+def evaluate_subtask(task, subtask, engine=None):
+    if task in OPEN_TASKS:
+        evaluate_open_subtask(task, subtask, engine)
     else:
         evaluate_close_subtask(task, subtask)
 
 
-if __name__ == '__main__':
+def parse_args():
+    parser = argparse.ArgumentParser(description="Aggregate the 3D-RAD results of one model.")
+    parser.add_argument('--model', type=str, default=model, help="Results are read from results/{model}/.")
+    parser.add_argument('--tasks', type=str, nargs='+', default=list(TASK.keys()))
+    parser.add_argument('--bert_batch_size', type=int, default=256)
+    parser.add_argument('--bertscore_cache_dir', type=str, default=None,
+                        help="Directory of the BERTScore embedding cache shared with the eval scripts.")
+    parser.add_argument('--store', type=str, default=None,
+                        help="Print the leaderboard of a results store (M3D/Bench/eval/results_store.py) instead of "
+                             "scoring the CSVs under results/.")
+    return parser.parse_args()
+
 
-    for task in TASK.keys():
-        evaluate_task(task)
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    path_dir = f"results/{args.model}"
+
+    if args.store is not None:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'M3D'))
+        from Bench.eval.results_store import ResultsStore
+        print(ResultsStore(args.store).leaderboard(tasks=args.tasks).round(4))
+        sys.exit(0)
+
+    # All open-ended tasks are scored together, so every metric is loaded once.
+    open_tasks = [task for task in args.tasks if task in OPEN_TASKS]
+    if open_tasks:
+        evaluate_open_tasks(open_tasks, MetricEngine(bert_batch_size=args.bert_batch_size,
+                                                     bertscore_cache_dir=args.bertscore_cache_dir))
+    for task in args.tasks:
+        if task not in OPEN_TASKS:
+            evaluate_close_task(task)